@@ -0,0 +1,163 @@
+from sqlalchemy import text
+import logging
+
+logger = logging.getLogger("app")
+
+# Ключ advisory-блокировки PostgreSQL, чтобы несколько воркеров uvicorn
+# не применяли миграции одновременно
+MIGRATIONS_LOCK_KEY = 7310452
+
+# Упорядоченный список миграций: (имя, список SQL-выражений).
+# Каждая миграция применяется ровно один раз и фиксируется в schema_migration_table.
+MIGRATIONS = [
+    ("0001_post_likes_count", [
+        "ALTER TABLE post_table ADD COLUMN IF NOT EXISTS likes_count BIGINT NOT NULL DEFAULT 0",
+        """
+        UPDATE post_table SET likes_count = counts.likes_count
+        FROM (SELECT post_id, count(*) AS likes_count FROM like_table GROUP BY post_id) AS counts
+        WHERE counts.post_id = post_table.post_id
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_like_table_post_id ON like_table (post_id)",
+        "CREATE INDEX IF NOT EXISTS ix_like_table_user_id_post_id ON like_table (user_id, post_id)",
+    ]),
+    ("0002_user_tag_weight", [
+        "ALTER TABLE tags_for_user_table ADD COLUMN IF NOT EXISTS weight BIGINT NOT NULL DEFAULT 1",
+        """
+        UPDATE tags_for_user_table SET weight = (
+            SELECT count(*) FROM like_table
+            JOIN tags_for_post_table ON tags_for_post_table.post_id = like_table.post_id
+            WHERE like_table.user_id = tags_for_user_table.user_id
+              AND tags_for_post_table.tag_id = tags_for_user_table.tag_id
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_tags_for_user_table_user_id ON tags_for_user_table (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_tags_for_post_table_tag_id_post_id ON tags_for_post_table (tag_id, post_id)",
+    ]),
+    ("0003_post_embeddings", [
+        """
+        CREATE TABLE IF NOT EXISTS post_embedding_table (
+            post_id BIGINT PRIMARY KEY REFERENCES post_table (post_id),
+            vector BYTEA NOT NULL
+        )
+        """,
+    ]),
+    ("0004_post_popularity", [
+        "ALTER TABLE like_table ADD COLUMN IF NOT EXISTS creation_date TIMESTAMP WITH TIME ZONE",
+        # Для старых лайков время неизвестно, берем время создания поста
+        """
+        UPDATE like_table SET creation_date = post_table.creation_date
+        FROM post_table
+        WHERE post_table.post_id = like_table.post_id AND like_table.creation_date IS NULL
+        """,
+        "ALTER TABLE like_table ALTER COLUMN creation_date SET DEFAULT now()",
+        "ALTER TABLE like_table ALTER COLUMN creation_date SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_like_table_creation_date ON like_table (creation_date)",
+        """
+        CREATE TABLE IF NOT EXISTS post_popularity_table (
+            post_id BIGINT PRIMARY KEY REFERENCES post_table (post_id),
+            score DOUBLE PRECISION NOT NULL,
+            rank BIGINT NOT NULL,
+            refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_post_popularity_table_rank ON post_popularity_table (rank)",
+    ]),
+    ("0005_user_counters", [
+        "ALTER TABLE user_table ADD COLUMN IF NOT EXISTS post_count BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE user_table ADD COLUMN IF NOT EXISTS received_likes_count BIGINT NOT NULL DEFAULT 0",
+        """
+        UPDATE user_table SET post_count = counts.post_count, received_likes_count = counts.likes_count
+        FROM (
+            SELECT user_id, count(*) AS post_count, sum(likes_count) AS likes_count
+            FROM post_table GROUP BY user_id
+        ) AS counts
+        WHERE counts.user_id = user_table.user_id
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_post_table_user_id ON post_table (user_id)",
+    ]),
+    ("0006_user_search_indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_user_table_login_prefix ON user_table (lower(login) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_user_table_name_prefix ON user_table (lower(name) text_pattern_ops)",
+        # Для расширения pg_trgm нужны права; без них поиск по подстроке работает без индекса
+        """
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            EXECUTE 'CREATE INDEX IF NOT EXISTS ix_user_table_login_trgm ON user_table USING gin (lower(login) gin_trgm_ops)';
+            EXECUTE 'CREATE INDEX IF NOT EXISTS ix_user_table_name_trgm ON user_table USING gin (lower(name) gin_trgm_ops)';
+        EXCEPTION WHEN insufficient_privilege OR undefined_file THEN
+            RAISE NOTICE 'pg_trgm недоступно, триграммные индексы пользователей не созданы';
+        END
+        $$
+        """,
+    ]),
+    ("0007_user_rating_index", [
+        "CREATE INDEX IF NOT EXISTS ix_user_table_rating ON user_table (rating DESC, user_id)",
+    ]),
+    ("0008_image_variants", [
+        "ALTER TABLE post_table ADD COLUMN IF NOT EXISTS media_variants JSON",
+        "ALTER TABLE user_table ADD COLUMN IF NOT EXISTS image_variants JSON",
+    ]),
+    ("0009_media_files", [
+        """
+        CREATE TABLE IF NOT EXISTS media_file_table (
+            link VARCHAR PRIMARY KEY,
+            size BIGINT,
+            ref_count BIGINT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+        """,
+        # Учитываем ссылки на файлы, загруженные до появления счетчиков
+        """
+        INSERT INTO media_file_table (link, ref_count)
+        SELECT link, count(*) FROM (
+            SELECT media_link AS link FROM post_table WHERE media_link LIKE '/uploads/%'
+            UNION ALL
+            SELECT image_link AS link FROM user_table WHERE image_link LIKE '/uploads/%'
+        ) AS links
+        GROUP BY link
+        ON CONFLICT (link) DO NOTHING
+        """,
+    ]),
+    ("0010_recommendation_snapshots", [
+        """
+        CREATE TABLE IF NOT EXISTS recommendation_snapshot_table (
+            user_id BIGINT PRIMARY KEY REFERENCES user_table (user_id),
+            token VARCHAR NOT NULL,
+            post_ids BYTEA NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+    ]),
+    ("0011_user_rating_updated_at", [
+        "ALTER TABLE user_table ADD COLUMN IF NOT EXISTS rating_updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+        "CREATE INDEX IF NOT EXISTS ix_user_table_rating_updated_at ON user_table (rating_updated_at)",
+    ]),
+]
+
+
+def apply_migrations(engine):
+    """
+    Применяет к БД миграции, которые еще не были применены.
+
+    Args:
+        engine: Движок SQLAlchemy
+    """
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migration_table ("
+            "name VARCHAR PRIMARY KEY, "
+            "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        applied = {name for (name,) in conn.execute(text("SELECT name FROM schema_migration_table"))}
+
+        for name, statements in MIGRATIONS:
+            if name in applied:
+                continue
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(text("INSERT INTO schema_migration_table (name) VALUES (:name)"), {"name": name})
+            logger.info(f"Применена миграция БД: {name}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, BigInteger, ForeignKey, Date, DateTime, Text, func
+from sqlalchemy import Column, Integer, String, Float, BigInteger, ForeignKey, Date, DateTime, Text, LargeBinary, JSON, func
 from sqlalchemy.orm import relationship
 from app.db.database import Base
 from datetime import datetime
@@ -19,8 +19,11 @@ class Post(Base):
     child_id = Column(BigInteger, nullable=True)
     user_id = Column(BigInteger, ForeignKey("user_table.user_id"), nullable=False)
     media_link = Column(String, nullable=True)
+    # Уменьшенные варианты изображения: {"ширина": "/uploads/..."}
+    media_variants = Column(JSON, nullable=True)
     creation_date = Column(DateTime(timezone=True), nullable=False, default=datetime.now)
     views_count = Column(BigInteger, nullable=False, default=0)
+    likes_count = Column(BigInteger, nullable=False, default=0, server_default="0")
     post_type_id = Column(BigInteger, ForeignKey("post_type_table.post_type_id"), nullable=False)
     
     user = relationship("User", back_populates="posts")
@@ -28,6 +31,13 @@ class Post(Base):
     likes = relationship("Like", back_populates="post")
     tags = relationship("TagForPost", back_populates="post")
 
+class PostEmbedding(Base):
+    __tablename__ = "post_embedding_table"
+
+    post_id = Column(BigInteger, ForeignKey("post_table.post_id"), primary_key=True)
+    # Нормированный вектор float32 (среднее эмбеддингов лемм текста поста)
+    vector = Column(LargeBinary, nullable=False)
+
 class TagType(Base):
     __tablename__ = "tag_type_table"
 
@@ -63,6 +73,8 @@ class TagForUser(Base):
     id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey("user_table.user_id"), nullable=False)
     tag_id = Column(BigInteger, ForeignKey("tag_table.tag_id"), nullable=False)
+    # Сколько лайкнутых пользователем постов имеют этот тег
+    weight = Column(BigInteger, nullable=False, default=1, server_default="1")
     
     user = relationship("User", back_populates="tags")
     tag = relationship("Tag", back_populates="user_tags")
@@ -73,10 +85,37 @@ class Like(Base):
     like_id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
     post_id = Column(BigInteger, ForeignKey("post_table.post_id"), nullable=False)
     user_id = Column(BigInteger, ForeignKey("user_table.user_id"), nullable=False)
+    creation_date = Column(DateTime(timezone=True), nullable=False, default=datetime.now, server_default=func.now())
     
     post = relationship("Post", back_populates="likes")
     user = relationship("User", back_populates="likes")
 
+class PostPopularity(Base):
+    __tablename__ = "post_popularity_table"
+
+    post_id = Column(BigInteger, ForeignKey("post_table.post_id"), primary_key=True)
+    score = Column(Float, nullable=False)
+    rank = Column(BigInteger, nullable=False, index=True)
+    refreshed_at = Column(DateTime(timezone=True), nullable=False)
+
+class MediaFile(Base):
+    __tablename__ = "media_file_table"
+
+    # Файлы в uploads адресуются хешем содержимого; ref_count - число постов и пользователей, ссылающихся на файл
+    link = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=True)
+    ref_count = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class RecommendationSnapshot(Base):
+    __tablename__ = "recommendation_snapshot_table"
+
+    # Ранжированные post_id хранятся как массив int64 (array('q').tobytes())
+    user_id = Column(BigInteger, ForeignKey("user_table.user_id"), primary_key=True)
+    token = Column(String, nullable=False)
+    post_ids = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
 class ProfileType(Base):
     __tablename__ = "profile_type_table"
 
@@ -94,8 +133,14 @@ class User(Base):
     type_id = Column(BigInteger, ForeignKey("profile_type_table.type_id"), nullable=False)
     name = Column(String, nullable=False)
     image_link = Column(String, nullable=True)
+    image_variants = Column(JSON, nullable=True)
     description = Column(String, nullable=True)
     rating = Column(Float, nullable=False, default=0.0)
+    # Время последнего изменения рейтинга: по нему воркеры догружают изменения в рейтинг пользователей
+    rating_updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # Денормализованные счетчики профиля: все посты пользователя и лайки, полученные ими
+    post_count = Column(BigInteger, nullable=False, default=0, server_default="0")
+    received_likes_count = Column(BigInteger, nullable=False, default=0, server_default="0")
     
     profile_type = relationship("ProfileType", back_populates="users")
     posts = relationship("Post", back_populates="user")
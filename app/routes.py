@@ -1,18 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Response, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Literal, Optional
 from app.db.database import get_db
 from app.services.post_service import PostService
+from app.services.recommendation_service import RecommendationService
 from app.schemas.post_schemas import (
     Post, PostCreate, PostUpdate, PostDetail, 
     Like, LikeCreate, Comment, CommentCreate, Tag,
-    UserDetail, UserCreate, UserUpdate, UserUpdateProfile, UserUpdateAvatar,
-    UserAvatarResponse
+    UserDetail, UserCreate, UserUpdate, UserUpdateProfile,
+    UserAvatarResponse, UserCard, LeaderboardEntry, UserRank
 )
 from app.utils.init_data import initialize_db
 from app.utils.create_test_user import create_test_user
 from app.models.models import User, PostType
 from app.services.user_service import UserService
+from app.utils.popularity import PopularityRanking
+from app.utils.leaderboard import RatingLeaderboard
 import logging
 
 logger = logging.getLogger(__name__)
@@ -73,15 +77,75 @@ def get_post_types(db: Session = Depends(get_db)):
     post_types = db.query(PostType).all()
     return [{"id": pt.post_type_id, "name": pt.name} for pt in post_types]
 
+@router.post("/system/refresh-user-tags", tags=["Система"])
+def refresh_user_tags(db: Session = Depends(get_db)):
+    """
+    Пересчет тегов всех пользователей на основе их лайков.
+
+    Выполняется одним проходом по БД, предназначен для ночных задач.
+    """
+    try:
+        links_count = PostService.update_all_user_tags_from_likes(db)
+        return {"status": "success", "user_tag_links": links_count}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при пересчете тегов пользователей: {str(e)}"
+        )
+
+@router.post("/system/refresh-popularity", tags=["Система"])
+def refresh_popularity(db: Session = Depends(get_db)):
+    """
+    Немедленный пересчет рейтинга популярных постов.
+    
+    Обычно рейтинг пересчитывается в фоне, эндпоинт полезен после массового импорта данных.
+    """
+    try:
+        PopularityRanking.recompute(db)
+        PopularityRanking.load(db)
+        return {"status": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при пересчете рейтинга популярных постов: {str(e)}"
+        )
+
 @router.get("/system/users", tags=["Система"])
-def get_users(db: Session = Depends(get_db)):
+def get_users(
+    response: Response,
+    after_id: int = 0,
+    limit: int = Query(100, ge=1, le=1000),
+    q: Optional[str] = None,
+    mode: Literal["prefix", "contains", "fuzzy"] = "prefix",
+    db: Session = Depends(get_db)
+):
     """
-    Получение списка пользователей.
+    Получение списка пользователей постранично.
     
     Полезно для выбора правильного user_id при создании поста.
+    Пользователи упорядочены по ID; для следующей страницы передайте after_id
+    из заголовка X-Next-After-Id. Параметр q ищет по login и name: по началу
+    строки (prefix), по подстроке (contains) или по триграммному сходству (fuzzy).
+    """
+    try:
+        users = UserService.list_users(db, after_id=after_id, limit=limit, query=q, mode=mode)
+        if len(users) == limit and mode != "fuzzy":
+            response.headers["X-Next-After-Id"] = str(users[-1]["id"])
+        return users
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при получении списка пользователей: {str(e)}"
+        )
+
+@router.get("/system/users/export", tags=["Система"])
+def export_users(q: Optional[str] = None, mode: Literal["prefix", "contains", "fuzzy"] = "prefix"):
+    """
+    Выгрузка пользователей в формате NDJSON (один JSON-объект на строку).
+    
+    Ответ передается потоком, пользователи читаются из БД пачками.
     """
-    users = db.query(User).all()
-    return [{"id": u.user_id, "login": u.login, "name": u.name, "image_link": u.image_link} for u in users]
+    return StreamingResponse(UserService.export_users_ndjson(query=q, mode=mode), media_type="application/x-ndjson")
 
 # Маршруты для постов
 @router.post("/posts/", response_model=Post, tags=["Посты"])
@@ -132,24 +196,37 @@ async def create_post(
         )
 
 @router.get("/posts/", response_model=List[PostDetail], tags=["Посты"])
-def read_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_posts(skip: int = 0, limit: int = 100, viewer_id: Optional[int] = None, db: Session = Depends(get_db)):
     """
     Получить список постов.
     
     Возвращает пагинированный список постов с информацией о пользователе, лайках и комментариях.
+    Если передан viewer_id, для каждого поста и комментария заполняется флаг liked_by_viewer.
     """
-    posts = PostService.get_posts_with_details(db, skip=skip, limit=limit)
+    posts = PostService.get_posts_with_details(db, skip=skip, limit=limit, viewer_id=viewer_id)
     return posts
 
+@router.get("/posts/popular", response_model=List[PostDetail], tags=["Посты"])
+def read_popular_posts(skip: int = 0, limit: int = 10, viewer_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    Получить популярные посты.
+    
+    Возвращает основные посты по убыванию популярности: учитываются лайки
+    за последнюю неделю, причем более свежие лайки весят больше.
+    Рейтинг пересчитывается периодически в фоне.
+    """
+    return PostService.get_popular_posts(db, skip=skip, limit=limit, viewer_id=viewer_id)
+
 @router.get("/posts/{post_id}", response_model=PostDetail, tags=["Посты"])
-def read_post(post_id: int, db: Session = Depends(get_db)):
+def read_post(post_id: int, viewer_id: Optional[int] = None, db: Session = Depends(get_db)):
     """
     Получить детальную информацию о посте.
     
     Возвращает пост с дополнительной информацией, такой как количество лайков и теги.
     При просмотре увеличивается счетчик просмотров.
+    Если передан viewer_id, для поста и комментариев заполняется флаг liked_by_viewer.
     """
-    post = PostService.get_post_with_details(db, post_id=post_id)
+    post = PostService.get_post_with_details(db, post_id=post_id, viewer_id=viewer_id)
     if post is None:
         raise HTTPException(status_code=404, detail="Пост не найден")
     return post
@@ -281,13 +358,26 @@ def delete_like(post_id: int, user_id: int, db: Session = Depends(get_db)):
 
 # Маршруты для рекомендаций и тегов пользователя
 @router.get("/users/{user_id}/recommended-posts", response_model=List[PostDetail], tags=["Рекомендации"])
-def get_recommended_posts(user_id: int, skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+def get_recommended_posts(
+    user_id: int,
+    response: Response,
+    skip: int = 0,
+    limit: int = 10,
+    viewer_id: Optional[int] = None,
+    snapshot: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
     """
     Получить рекомендованные посты для пользователя.
     
     Возвращает список постов, наиболее соответствующих интересам пользователя,
     основываясь на его тегах и лайках. Учитывает также популярность постов
     и их новизну.
+    Если передан viewer_id, для каждого поста и комментария заполняется флаг liked_by_viewer.
+    
+    Токен снимка выдачи возвращается в заголовке X-Recommendation-Snapshot.
+    Передавайте его в параметре snapshot при запросе следующих страниц,
+    чтобы листать одну и ту же выдачу без повторов и пропусков.
     """
     try:
         # Проверяем существование пользователя
@@ -296,7 +386,10 @@ def get_recommended_posts(user_id: int, skip: int = 0, limit: int = 10, db: Sess
             raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
         
         # Получаем рекомендованные посты
-        posts = PostService.get_recommended_posts(db, user_id=user_id, skip=skip, limit=limit)
+        posts, snapshot_token = RecommendationService.get_recommended_posts(
+            db, user_id=user_id, skip=skip, limit=limit, viewer_id=viewer_id, snapshot=snapshot
+        )
+        response.headers["X-Recommendation-Snapshot"] = snapshot_token
         return posts
     except Exception as e:
         raise HTTPException(
@@ -304,6 +397,38 @@ def get_recommended_posts(user_id: int, skip: int = 0, limit: int = 10, db: Sess
             detail=f"Ошибка при получении рекомендаций: {str(e)}"
         )
 
+@router.get("/users/{user_id}/semantic-recommended-posts", response_model=List[PostDetail], tags=["Рекомендации"])
+def get_semantic_recommended_posts(
+    user_id: int,
+    skip: int = 0,
+    limit: int = 10,
+    viewer_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Получить семантически похожие посты для пользователя.
+    
+    Ищет посты, чьи эмбеддинги текста ближе всего к среднему эмбеддингу
+    постов, лайкнутых пользователем. Не требует точного совпадения тегов.
+    Если у пользователя еще нет лайков, возвращает обычные рекомендации.
+    """
+    try:
+        # Проверяем существование пользователя
+        user = db.query(User).filter(User.user_id == user_id).first()
+        if not user:
+            raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
+        
+        return RecommendationService.get_semantic_recommended_posts(
+            db, user_id=user_id, skip=skip, limit=limit, viewer_id=viewer_id
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при получении семантических рекомендаций: {str(e)}"
+        )
+
 @router.get("/users/{user_id}/tags", response_model=List[Tag], tags=["Пользователи"])
 def get_user_tags(user_id: int, db: Session = Depends(get_db)):
     """
@@ -328,6 +453,88 @@ def get_user_tags(user_id: int, db: Session = Depends(get_db)):
             detail=f"Ошибка при получении тегов пользователя: {str(e)}"
         )
 
+@router.get("/users/leaderboard", response_model=List[LeaderboardEntry], tags=["Пользователи"])
+def get_leaderboard(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(10, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """
+    Получить рейтинг пользователей по убыванию rating.
+    
+    Пользователи с одинаковым рейтингом делят одно место.
+    """
+    try:
+        RatingLeaderboard.ensure_fresh(db)
+        entries = RatingLeaderboard.top(skip=skip, limit=limit)
+        cards = PostService.get_users_cards(db, [user_id for _, user_id, _ in entries])
+        for _, user_id, _ in entries:
+            if user_id not in cards:
+                # Пользователь удален в другом воркере
+                RatingLeaderboard.remove(user_id)
+        return [
+            {**cards[user_id], "rank": rank, "rating": rating}
+            for rank, user_id, rating in entries
+            if user_id in cards
+        ]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при получении рейтинга пользователей: {str(e)}"
+        )
+
+@router.get("/users/{user_id}/rank", response_model=UserRank, tags=["Пользователи"])
+def get_user_rank(user_id: int, db: Session = Depends(get_db)):
+    """
+    Получить место пользователя в рейтинге.
+    """
+    try:
+        RatingLeaderboard.ensure_fresh(db)
+        rank = RatingLeaderboard.rank(user_id)
+        if rank is None and UserService.get_user(db, user_id) is not None:
+            # Пользователь создан в другом воркере после последней догрузки рейтинга
+            RatingLeaderboard.refresh(db)
+            rank = RatingLeaderboard.rank(user_id)
+        if rank is None:
+            raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
+        
+        place, rating, total_users = rank
+        return {"user_id": user_id, "rating": rating, "rank": place, "total_users": total_users}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при получении места пользователя в рейтинге: {str(e)}"
+        )
+
+# Максимальное количество ID в одном запросе карточек пользователей
+USER_CARDS_LIMIT = 500
+
+@router.get("/users", response_model=List[UserCard], tags=["Пользователи"])
+def get_user_cards(ids: str, db: Session = Depends(get_db)):
+    """
+    Получить краткие карточки нескольких пользователей.
+    
+    Принимает ID через запятую (ids=1,2,3) и возвращает карточки в том же порядке.
+    Несуществующие пользователи пропускаются, повторяющиеся ID возвращаются один раз.
+    """
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in ids.split(",") if user_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Параметр ids должен содержать целые числа через запятую")
+    if len(user_ids) > USER_CARDS_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Можно запросить не больше {USER_CARDS_LIMIT} пользователей")
+    
+    try:
+        cards = PostService.get_users_cards(db, user_ids)
+        return [cards[user_id] for user_id in user_ids if user_id in cards]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка при получении карточек пользователей: {str(e)}"
+        )
+
 @router.get("/users/{user_id}", response_model=UserDetail, tags=["Пользователи"])
 def get_user_details(user_id: int, db: Session = Depends(get_db)):
     """
@@ -343,6 +550,8 @@ def get_user_details(user_id: int, db: Session = Depends(get_db)):
             raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
         
         return user_details
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -358,13 +567,13 @@ async def create_user(
     type_id: int = Form(...),
     description: Optional[str] = Form(None),
     rating: float = Form(0.0),
-    image: Optional[bytes] = File(None),
+    image: Optional[UploadFile] = File(default=None),
     db: Session = Depends(get_db)
 ):
     """
     Создать нового пользователя.
     
-    Можно загрузить аватар пользователя в бинарном формате.
+    Можно загрузить аватар пользователя (файл изображения).
     """
     try:
         user_data = UserCreate(
@@ -373,13 +582,14 @@ async def create_user(
             password=password,
             type_id=type_id,
             description=description,
-            rating=rating,
-            image=image
+            rating=rating
         )
-        user = await UserService.create_user(db, user_data=user_data)
+        user = await UserService.create_user(db, user_data=user_data, image=image)
         return user
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -392,7 +602,7 @@ async def update_user(
     name: Optional[str] = Form(None),
     description: Optional[str] = Form(None),
     rating: Optional[float] = Form(None),
-    image: Optional[bytes] = File(None),
+    image: Optional[UploadFile] = File(default=None),
     db: Session = Depends(get_db)
 ):
     """
@@ -405,10 +615,9 @@ async def update_user(
         user_data = UserUpdate(
             name=name,
             description=description,
-            rating=rating,
-            image=image
+            rating=rating
         )
-        user = await UserService.update_user(db, user_id=user_id, user_data=user_data)
+        user = await UserService.update_user(db, user_id=user_id, user_data=user_data, image=image)
         if not user:
             raise HTTPException(status_code=404, detail=f"Пользователь с ID {user_id} не найден")
         return user
@@ -473,15 +682,14 @@ async def update_user_avatar(
     Обновляет аватар пользователя.
     """
     try:
-        # Читаем содержимое файла
-        image_data = await image.read()
-        
-        # Обновляем аватар
-        updated_user = await UserService.update_avatar(db, user_id, image_data)
+        # Обновляем аватар (файл копируется из загрузки частями, без чтения в память)
+        updated_user = await UserService.update_avatar(db, user_id, image)
         if not updated_user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
             
         return updated_user
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при обновлении аватара пользователя {user_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера") 
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, validator
-from typing import Optional, List, Union, ForwardRef
+from typing import Optional, List, Dict, Union, ForwardRef
 from datetime import datetime, date
 from fastapi import UploadFile
 
@@ -59,6 +59,7 @@ class Post(PostBase):
     user_id: int
     creation_date: datetime
     views_count: int
+    media_variants: Optional[Dict[str, str]] = None
 
     class Config:
         orm_mode = True
@@ -92,6 +93,7 @@ class Comment(CommentBase):
     user_id: int
     creation_date: datetime
     views_count: int
+    media_variants: Optional[Dict[str, str]] = None
 
     class Config:
         orm_mode = True
@@ -101,6 +103,7 @@ CommentWithRepliesRef = ForwardRef("CommentWithReplies")
 
 class CommentWithReplies(Comment):
     replies: List[CommentWithRepliesRef] = []
+    liked_by_viewer: bool = False
 
     class Config:
         orm_mode = True
@@ -112,6 +115,8 @@ class PostDetail(Post):
     comments: List[CommentWithReplies] = []
     user_name: str
     user_image: Optional[str] = None
+    user_image_variants: Optional[Dict[str, str]] = None
+    liked_by_viewer: bool = False
 
     class Config:
         orm_mode = True
@@ -134,16 +139,15 @@ class UserBase(BaseModel):
 
 class UserCreate(UserBase):
     password: str
-    image: Optional[bytes] = None
 
 class UserUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     rating: Optional[float] = None
-    image: Optional[bytes] = None
 
 class UserDetail(UserBase):
     user_id: int
+    image_variants: Optional[Dict[str, str]] = None
     tags: List[Tag] = []
     post_count: int = 0
     likes_count: int = 0
@@ -157,19 +161,37 @@ class UserDetail(UserBase):
             return []
         return v
 
+# Краткая карточка пользователя для упоминаний и списков участников
+class UserCard(BaseModel):
+    user_id: int
+    login: str
+    name: str
+    image_link: Optional[str] = None
+    image_variants: Optional[Dict[str, str]] = None
+    profile_type: Optional[str] = None
+    rating: float
+
+# Строка рейтинга пользователей
+class LeaderboardEntry(UserCard):
+    rank: int
+
+class UserRank(BaseModel):
+    user_id: int
+    rating: float
+    rank: int
+    total_users: int
+
 class UserUpdateProfile(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     rating: Optional[float] = None
 
-class UserUpdateAvatar(BaseModel):
-    image: bytes
-
 class UserAvatarResponse(BaseModel):
     user_id: int
     login: str
     name: str
     image_link: Optional[str] = None
+    image_variants: Optional[Dict[str, str]] = None
 
     class Config:
         from_attributes = True
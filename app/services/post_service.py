@@ -1,25 +1,36 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func, text, desc, and_, or_, distinct
-from app.models.models import Post, Like, TagForPost, Tag, User, PostType, TagForUser, ProfileType, TagType
+from sqlalchemy import func, text, desc, and_, or_, distinct, select, insert, literal
+from app.models.models import Post, Like, TagForPost, Tag, User, PostType, TagForUser, ProfileType, TagType, PostEmbedding, PostPopularity
 from app.schemas.post_schemas import PostCreate, PostUpdate, LikeCreate, CommentWithReplies
 import sys
 import os
 import logging
-from collections import Counter
 from datetime import datetime, timedelta
 from fastapi import UploadFile, HTTPException
 from app.utils.image_handler import ImageHandler
+from app.utils.like_counter import LikeCounter
+from app.utils.tag_index import TagPostIndex
+from app.utils.seen_set import SeenSetCache
+from app.utils.embedding_index import PostEmbeddingIndex
+from app.utils.popularity import PopularityRanking
+from app.utils.recommendation_cache import RecommendationCache
+from app.utils.profile_cache import UserProfileCache
+from app.utils.image_variants import ImageVariants
 
 # Добавляем корневую директорию проекта в sys.path для импорта tokens.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
-from tokens import extract_topic_tokens
+from tokens import analyze_text
 
 # Получаем логгер
 logger = logging.getLogger("app")
 
+# Количество самых частых тегов из лайков, которые сохраняются в профиле пользователя
+USER_TAGS_LIMIT = 10
+
 class PostService:
     @staticmethod
     async def create_post(db: Session, post_data: PostCreate, image: UploadFile = None):
+        acquired_link = None
         try:
             # Проверяем существование пользователя
             user = db.query(User).filter(User.user_id == post_data.user_id).first()
@@ -44,13 +55,20 @@ class PostService:
             media_link = post_data.media_link
             if image:
                 # Сохраняем изображение и получаем путь к нему
-                success, file_path, error_message = ImageHandler.save_image(image, prefix="post_")
+                success, file_path, error_message = await ImageHandler.save_image(image)
                 if not success:
                     logger.error(f"Ошибка при сохранении изображения для поста: {error_message}")
                     raise HTTPException(status_code=400, detail=error_message)
                 
                 # Заменяем ссылку на медиа-контент путем к сохраненному изображению
                 media_link = file_path
+                acquired_link = file_path
+            elif media_link and media_link.startswith("/uploads/"):
+                # Пост ссылается на уже загруженный файл - учитываем ссылку на него;
+                # ссылки на неучтенные файлы (варианты, копии, чужие пути) не принимаем
+                if not ImageHandler.retain(media_link):
+                    raise HTTPException(status_code=400, detail=f"Загруженный файл {media_link} не найден")
+                acquired_link = media_link
             
             # Получаем максимальное значение post_id и прибавляем 1
             max_id = db.query(func.max(Post.post_id)).scalar() or 0
@@ -67,15 +85,25 @@ class PostService:
             )
             
             db.add(db_post)
+            db.query(User).filter(User.user_id == post_data.user_id).update(
+                {User.post_count: User.post_count + 1},
+                synchronize_session=False
+            )
             db.commit()
             db.refresh(db_post)
+            acquired_link = None
+            UserProfileCache.invalidate(post_data.user_id)
+            if image:
+                ImageVariants.schedule_post(db_post.post_id, media_link)
             
             # Логируем успешное создание
             logger.info(f"Created post with ID: {db_post.post_id}")
             
-            # Генерируем тэги для поста
-            tokens = extract_topic_tokens(post_data.content)
+            # Генерируем тэги и эмбеддинг для поста за один разбор текста
+            tokens, embedding = analyze_text(post_data.content)
+            PostService._save_post_embedding(db, db_post, embedding)
             if tokens:
+                tag_ids = []
                 # Создаем или получаем существующие тэги
                 for token in tokens:
                     # Ищем тэг в БД или создаем новый
@@ -90,6 +118,7 @@ class PostService:
                         db.add(tag)
                         db.commit()
                         db.refresh(tag)
+                    tag_ids.append(tag.tag_id)
                     
                     # Проверяем существование связи между постом и тегом
                     existing_tag_for_post = db.query(TagForPost).filter(
@@ -117,14 +146,42 @@ class PostService:
                     db.commit()
                 
                 logger.info(f"Added tags to post ID: {db_post.post_id}")
+                
+                # Добавляем основной пост в индекс тегов для рекомендаций
+                if db_post.child_id is None and db_post.post_type_id == 1:
+                    TagPostIndex.add_post(db_post.post_id, tag_ids)
             
             return db_post
             
         except Exception as e:
             db.rollback()
+            # Пост не сохранен - снимаем ссылку на файл
+            if acquired_link:
+                ImageHandler.delete_image(acquired_link)
             logger.error(f"Error creating post: {str(e)}")
             raise
     
+    @staticmethod
+    def _save_post_embedding(db: Session, db_post: Post, embedding):
+        """
+        Сохраняет эмбеддинг поста в БД и в матрицу семантического поиска.
+        
+        Args:
+            db (Session): Сессия базы данных
+            db_post (Post): Пост
+            embedding: Нормированный вектор float32 или None, если текст не удалось векторизовать
+        """
+        if embedding is None:
+            db.query(PostEmbedding).filter(PostEmbedding.post_id == db_post.post_id).delete()
+            db.commit()
+            PostEmbeddingIndex.remove_post(db_post.post_id)
+            return
+        
+        db.merge(PostEmbedding(post_id=db_post.post_id, vector=PostEmbeddingIndex.to_bytes(embedding)))
+        db.commit()
+        if db_post.child_id is None and db_post.post_type_id == 1:
+            PostEmbeddingIndex.add_post(db_post.post_id, embedding)
+    
     @staticmethod
     def get_post(db: Session, post_id: int):
         return db.query(Post).filter(Post.post_id == post_id).first()
@@ -145,7 +202,7 @@ class PostService:
             posts_with_details = []
             for post, user in posts:
                 # Получаем количество лайков
-                likes_count = db.query(func.count(Like.like_id)).filter(Like.post_id == post.post_id).scalar()
+                likes_count = LikeCounter.get_count(post)
                 
                 # Получаем теги поста
                 tags = db.query(Tag).join(TagForPost).filter(TagForPost.post_id == post.post_id).all()
@@ -166,6 +223,7 @@ class PostService:
                             "child_id": reply.child_id,
                             "user_id": reply.user_id,
                             "media_link": reply.media_link,
+                            "media_variants": reply.media_variants,
                             "creation_date": reply.creation_date,
                             "views_count": reply.views_count,
                             "post_type_id": reply.post_type_id,
@@ -185,6 +243,7 @@ class PostService:
                         "child_id": comment.child_id,
                         "user_id": comment.user_id,
                         "media_link": comment.media_link,
+                        "media_variants": comment.media_variants,
                         "creation_date": comment.creation_date,
                         "views_count": comment.views_count,
                         "post_type_id": comment.post_type_id,
@@ -200,7 +259,9 @@ class PostService:
                     "user_id": post.user_id,
                     "user_name": user.name,
                     "user_image": user.image_link,
+                    "user_image_variants": user.image_variants,
                     "media_link": post.media_link,
+                    "media_variants": post.media_variants,
                     "creation_date": post.creation_date,
                     "views_count": post.views_count,
                     "post_type_id": post.post_type_id,
@@ -217,49 +278,130 @@ class PostService:
             logger.error(f"Error getting posts: {str(e)}")
             raise
     
+    @staticmethod
+    def get_posts_by_ids(db: Session, post_ids: list):
+        """
+        Получает посты с авторами по списку ID одним запросом, сохраняя порядок списка.
+        
+        Отсутствующие (например, удаленные) посты пропускаются.
+        
+        Args:
+            db (Session): Сессия базы данных
+            post_ids (list): ID постов в нужном порядке
+            
+        Returns:
+            list: Список пар (Post, User)
+        """
+        if not post_ids:
+            return []
+        rows = db.query(Post, User).join(User).filter(Post.post_id.in_(post_ids)).all()
+        rows_by_id = {post.post_id: (post, user) for post, user in rows}
+        return [rows_by_id[post_id] for post_id in post_ids if post_id in rows_by_id]
+    
+    @staticmethod
+    def get_popular_posts(db: Session, skip: int = 0, limit: int = 10, viewer_id: int = None):
+        """
+        Получает популярные посты из предвычисленного рейтинга популярности.
+        
+        Args:
+            db (Session): Сессия базы данных
+            skip (int): Сколько постов пропустить
+            limit (int): Максимальное количество постов
+            viewer_id (int): ID просматривающего пользователя для флагов liked_by_viewer
+            
+        Returns:
+            list: Список словарей, соответствующих схеме PostDetail
+        """
+        try:
+            PopularityRanking.ensure_loaded(db)
+            posts = PostService.get_posts_by_ids(db, PopularityRanking.top(skip=skip, limit=limit))
+            return PostService.build_posts_details(db, posts, viewer_id)
+        except Exception as e:
+            logger.error(f"Error getting popular posts: {str(e)}")
+            raise
+    
     @staticmethod
     def get_comments(db: Session, post_id: int, skip: int = 0, limit: int = 100):
         return db.query(Post).filter(Post.child_id == post_id).order_by(Post.creation_date).offset(skip).limit(limit).all()
     
+    @staticmethod
+    def _mark_liked_by_viewer(db: Session, posts_with_details: list, viewer_id: int = None):
+        """
+        Проставляет флаг liked_by_viewer постам и всем вложенным комментариям.
+        
+        Лайки зрителя для всей страницы выбираются одним запросом post_id IN (...).
+        
+        Args:
+            db (Session): Сессия базы данных
+            posts_with_details (list): Список словарей постов с комментариями
+            viewer_id (int): ID пользователя, который просматривает ленту
+        """
+        # Собираем все посты и комментарии страницы в плоский список
+        nodes = []
+        stack = list(posts_with_details)
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.get("comments", []))
+            stack.extend(node.get("replies", []))
+        
+        liked_post_ids = set()
+        if viewer_id is not None and nodes:
+            liked_post_ids = {
+                post_id for (post_id,) in db.query(Like.post_id).filter(
+                    Like.user_id == viewer_id,
+                    Like.post_id.in_({node["post_id"] for node in nodes})
+                ).all()
+            }
+        
+        for node in nodes:
+            node["liked_by_viewer"] = node["post_id"] in liked_post_ids
+        
+        return posts_with_details
+    
     @staticmethod
     async def update_post(db: Session, post_id: int, post_data: PostUpdate, image: UploadFile = None):
+        acquired_link = None
         try:
             db_post = db.query(Post).filter(Post.post_id == post_id).first()
             if not db_post:
                 return None
             
             # Обрабатываем изображение, если оно предоставлено
+            previous_media_link = db_post.media_link
             if image:
-                # Если у поста уже есть изображение, удаляем его
-                if db_post.media_link and db_post.media_link.startswith("/uploads/images/"):
-                    ImageHandler.delete_image(db_post.media_link)
-                
                 # Сохраняем новое изображение и получаем путь к нему
-                success, file_path, error_message = ImageHandler.save_image(image, prefix="post_")
+                success, file_path, error_message = await ImageHandler.save_image(image)
                 if not success:
                     logger.error(f"Ошибка при сохранении изображения для поста {post_id}: {error_message}")
                     raise HTTPException(status_code=400, detail=error_message)
                 
-                # Обновляем ссылку на медиа-контент
+                # Обновляем ссылку на медиа-контент; варианты будут созданы заново
+                acquired_link = file_path
                 db_post.media_link = file_path
+                db_post.media_variants = None
             # Если передали новую ссылку на медиа, обновляем ее
-            elif post_data.media_link is not None:
-                # Если у поста уже есть изображение в нашей системе и его заменяют на внешнюю ссылку, удаляем старое изображение
-                if db_post.media_link and db_post.media_link.startswith("/uploads/images/") and not post_data.media_link.startswith("/uploads/images/"):
-                    ImageHandler.delete_image(db_post.media_link)
+            elif post_data.media_link is not None and post_data.media_link != db_post.media_link:
+                if post_data.media_link.startswith("/uploads/"):
+                    if not ImageHandler.retain(post_data.media_link):
+                        raise HTTPException(status_code=400, detail=f"Загруженный файл {post_data.media_link} не найден")
+                    acquired_link = post_data.media_link
                 db_post.media_link = post_data.media_link
+                db_post.media_variants = None
             
             # Обновляем остальные поля поста
             if post_data.content is not None:
                 db_post.content = post_data.content
-                # Обновляем теги поста при изменении содержания
-                updated_tokens = extract_topic_tokens(post_data.content)
+                # Обновляем теги и эмбеддинг поста при изменении содержания
+                updated_tokens, embedding = analyze_text(post_data.content)
+                PostService._save_post_embedding(db, db_post, embedding)
                 if updated_tokens:
                     # Удаляем старые теги
                     db.query(TagForPost).filter(TagForPost.post_id == post_id).delete()
                     db.commit()
                     
                     # Создаем новые теги
+                    tag_ids = []
                     for token in updated_tokens:
                         # Ищем тэг в БД или создаем новый
                         tag = db.query(Tag).filter(Tag.name == token).first()
@@ -272,6 +414,7 @@ class PostService:
                             db.add(tag)
                             db.commit()
                             db.refresh(tag)
+                        tag_ids.append(tag.tag_id)
                         
                         # Проверяем существование связи между постом и тегом
                         existing_tag_for_post = db.query(TagForPost).filter(
@@ -295,13 +438,28 @@ class PostService:
                         )
                         db.add(tag_for_post)
                         db.commit()
+                    
+                    if db_post.child_id is None and db_post.post_type_id == 1:
+                        TagPostIndex.add_post(post_id, tag_ids)
             
             db.commit()
             db.refresh(db_post)
+            # Ссылку на прежнее изображение снимаем после сохранения новой: если
+            # загружен тот же файл, он не будет удален и записан заново, а счетчик
+            # ссылок вернется к прежнему значению
+            replaced = acquired_link is not None or previous_media_link != db_post.media_link
+            acquired_link = None
+            if replaced and previous_media_link and previous_media_link.startswith("/uploads/"):
+                ImageHandler.delete_image(previous_media_link)
+            if image:
+                ImageVariants.schedule_post(post_id, db_post.media_link)
             logger.info(f"Updated post ID: {post_id}")
             return db_post
         except Exception as e:
             db.rollback()
+            # Изменения не сохранены - снимаем взятую ссылку на файл
+            if acquired_link:
+                ImageHandler.delete_image(acquired_link)
             logger.error(f"Error updating post {post_id}: {str(e)}")
             raise
     
@@ -310,17 +468,36 @@ class PostService:
         try:
             db_post = db.query(Post).filter(Post.post_id == post_id).first()
             if db_post:
-                # Удаляем изображение, если оно хранится в нашей системе
-                if db_post.media_link and db_post.media_link.startswith("/uploads/images/"):
-                    ImageHandler.delete_image(db_post.media_link)
+                media_link = db_post.media_link
                 
                 # Удаляем связанные данные
                 db.query(Like).filter(Like.post_id == post_id).delete()
                 db.query(TagForPost).filter(TagForPost.post_id == post_id).delete()
+                db.query(PostEmbedding).filter(PostEmbedding.post_id == post_id).delete()
+                db.query(PostPopularity).filter(PostPopularity.post_id == post_id).delete()
+                
+                # Вычитаем пост и его лайки из счетчиков профиля автора
+                # (несброшенная дельта горячего поста в счетчики еще не попала)
+                author_id = db_post.user_id
+                db.query(User).filter(User.user_id == author_id).update(
+                    {
+                        User.post_count: User.post_count - 1,
+                        User.received_likes_count: User.received_likes_count - db_post.likes_count
+                    },
+                    synchronize_session=False
+                )
                 
                 # Удаляем пост
                 db.delete(db_post)
                 db.commit()
+                # Ссылку на изображение снимаем только после удаления поста: при
+                # откате пост продолжал бы ссылаться на файл с уменьшенным счетчиком
+                if media_link and media_link.startswith("/uploads/"):
+                    ImageHandler.delete_image(media_link)
+                UserProfileCache.invalidate(author_id)
+                LikeCounter.discard(post_id)
+                TagPostIndex.remove_post(post_id)
+                PostEmbeddingIndex.remove_post(post_id)
                 logger.info(f"Deleted post ID: {post_id}")
                 return True
             return False
@@ -329,6 +506,12 @@ class PostService:
             logger.error(f"Error deleting post {post_id}: {str(e)}")
             raise
     
+    @staticmethod
+    def _invalidate_author_profile(db: Session, post_id: int):
+        """Сбрасывает кэш профиля автора поста (изменилось число полученных им лайков)."""
+        author_id = db.query(Post.user_id).filter(Post.post_id == post_id).scalar()
+        UserProfileCache.invalidate(author_id)
+    
     @staticmethod
     def like_post(db: Session, like_data: LikeCreate):
         try:
@@ -353,48 +536,20 @@ class PostService:
                 user_id=like_data.user_id
             )
             db.add(db_like)
+            LikeCounter.add(db, like_data.post_id, 1)
             db.commit()
             db.refresh(db_like)
+            SeenSetCache.record_like(like_data.user_id, like_data.post_id)
+            PostService._invalidate_author_profile(db, like_data.post_id)
             logger.info(f"User {like_data.user_id} liked post {like_data.post_id}")
             
             # Обновляем все теги пользователя после лайка
             try:
-                # Обновляем теги пользователя на основе всех его лайков
-                # Получаем все посты, которые лайкнул пользователь (включая только что добавленный)
-                liked_posts = db.query(Post).join(Like).filter(Like.user_id == like_data.user_id).all()
-                
-                if liked_posts:
-                    # Получаем теги из всех лайкнутых постов
-                    post_tags = []
-                    for post in liked_posts:
-                        tags = db.query(Tag).join(TagForPost).filter(TagForPost.post_id == post.post_id).all()
-                        post_tags.extend(tags)
-                    
-                    # Подсчитываем частоту тегов
-                    tag_counter = Counter([tag.tag_id for tag in post_tags])
-                    most_common_tags = tag_counter.most_common(10)  # Берем 10 самых популярных тегов
-                    
-                    # Очищаем текущие теги пользователя
-                    db.query(TagForUser).filter(TagForUser.user_id == like_data.user_id).delete()
-                    db.commit()
-                    
-                    # Добавляем новые теги
-                    for tag_id, _ in most_common_tags:
-                        # Получаем максимальное значение id для TagForUser и прибавляем 1
-                        max_tag_user_id = db.query(func.max(TagForUser.id)).scalar() or 0
-                        next_tag_user_id = max_tag_user_id + 1
-                        
-                        # Создаем новую связь между пользователем и тегом
-                        tag_for_user = TagForUser(
-                            id=next_tag_user_id,
-                            user_id=like_data.user_id,
-                            tag_id=tag_id
-                        )
-                        db.add(tag_for_user)
-                        # Фиксируем каждое добавление тега отдельно
-                        db.commit()
-                    
-                    logger.info(f"Updated all user tags for user ID: {like_data.user_id} after liking post ID: {like_data.post_id}")
+                # Пересчитываем теги пользователя на основе всех его лайков
+                # (включая только что добавленный) одним INSERT ... SELECT
+                PostService._replace_user_tags(db, like_data.user_id)
+                db.commit()
+                logger.info(f"Updated all user tags for user ID: {like_data.user_id} after liking post ID: {like_data.post_id}")
             except Exception as e:
                 logger.error(f"Error updating user tags after like: {str(e)}")
                 # Не прерываем основной поток выполнения, если обновление тегов не удалось
@@ -417,7 +572,10 @@ class PostService:
             
             if db_like:
                 db.delete(db_like)
+                LikeCounter.add(db, post_id, -1)
                 db.commit()
+                SeenSetCache.discard(user_id)
+                PostService._invalidate_author_profile(db, post_id)
                 logger.info(f"User {user_id} unliked post {post_id}")
                 return True
             return False
@@ -427,7 +585,7 @@ class PostService:
             raise
     
     @staticmethod
-    def get_post_with_details(db: Session, post_id: int):
+    def get_post_with_details(db: Session, post_id: int, viewer_id: int = None):
         try:
             # Получаем пост со всеми связанными данными
             post = db.query(Post).filter(Post.post_id == post_id).first()
@@ -441,7 +599,7 @@ class PostService:
                 raise ValueError(f"Пользователь с ID {post.user_id} не найден")
             
             # Получаем количество лайков
-            likes_count = db.query(func.count(Like.like_id)).filter(Like.post_id == post_id).scalar()
+            likes_count = LikeCounter.get_count(post)
             
             # Получаем теги поста с информацией о типе тега
             tags = db.query(Tag, TagType).join(TagType).join(TagForPost).filter(TagForPost.post_id == post_id).all()
@@ -476,6 +634,7 @@ class PostService:
                         "child_id": reply.child_id,
                         "user_id": reply.user_id,
                         "media_link": reply.media_link,
+                        "media_variants": reply.media_variants,
                         "creation_date": reply.creation_date,
                         "views_count": reply.views_count,
                         "post_type_id": reply.post_type_id,
@@ -495,6 +654,7 @@ class PostService:
                     "child_id": comment.child_id,
                     "user_id": comment.user_id,
                     "media_link": comment.media_link,
+                    "media_variants": comment.media_variants,
                     "creation_date": comment.creation_date,
                     "views_count": comment.views_count,
                     "post_type_id": comment.post_type_id,
@@ -514,7 +674,9 @@ class PostService:
                 "user_id": post.user_id,
                 "user_name": user.name,
                 "user_image": user.image_link,
+                "user_image_variants": user.image_variants,
                 "media_link": post.media_link,
+                "media_variants": post.media_variants,
                 "creation_date": post.creation_date,
                 "views_count": post.views_count,
                 "post_type_id": post.post_type_id,
@@ -523,6 +685,7 @@ class PostService:
                 "comments": comments_with_replies
             }
             
+            PostService._mark_liked_by_viewer(db, [post_dict], viewer_id)
             return post_dict
         except Exception as e:
             db.rollback()
@@ -549,6 +712,52 @@ class PostService:
             logger.error(f"Error getting user tags for user ID {user_id}: {str(e)}")
             raise
 
+    @staticmethod
+    def _replace_user_tags(db: Session, user_id: int):
+        """
+        Заменяет теги пользователя самыми частыми тегами лайкнутых им постов.
+        
+        Пересчет выполняется на стороне БД: DELETE и один INSERT ... SELECT
+        с GROUP BY/ORDER BY/LIMIT. Теги пользователя без лайков (например,
+        заданные в профиле) не трогаются. Транзакцию фиксирует вызывающий код.
+        
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+        """
+        if db.query(Like.like_id).filter(Like.user_id == user_id).first() is None:
+            logger.info(f"User {user_id} has no liked posts")
+            return
+        
+        weight = func.count(Like.like_id)
+        top_tags = (
+            select(TagForPost.tag_id.label("tag_id"), weight.label("weight"))
+            .join(Like, Like.post_id == TagForPost.post_id)
+            .where(Like.user_id == user_id)
+            .group_by(TagForPost.tag_id)
+            .order_by(weight.desc(), TagForPost.tag_id)
+            .limit(USER_TAGS_LIMIT)
+            .subquery()
+        )
+        
+        previous_tag_ids = {tag_id for (tag_id,) in db.query(TagForUser.tag_id).filter(TagForUser.user_id == user_id)}
+        db.query(TagForUser).filter(TagForUser.user_id == user_id).delete(synchronize_session=False)
+        
+        # ID назначаются так же, как и в остальном коде: max(id) + порядковый номер строки
+        next_id = select(func.coalesce(func.max(TagForUser.id), 0)).scalar_subquery()
+        rows = select(
+            next_id + func.row_number().over(order_by=(top_tags.c.weight.desc(), top_tags.c.tag_id)),
+            literal(user_id),
+            top_tags.c.tag_id,
+            top_tags.c.weight
+        )
+        db.execute(insert(TagForUser).from_select(["id", "user_id", "tag_id", "weight"], rows))
+        
+        # Снимок рекомендаций сбрасывается, только если интересы изменились существенно
+        current_tag_ids = {tag_id for (tag_id,) in db.query(TagForUser.tag_id).filter(TagForUser.user_id == user_id)}
+        RecommendationCache.on_profile_change(db, user_id, previous_tag_ids, current_tag_ids)
+        UserProfileCache.invalidate(user_id)
+
     @staticmethod
     def update_user_tags_from_likes(db: Session, user_id: int):
         """
@@ -565,43 +774,9 @@ class PostService:
                 logger.error(f"Attempt to update tags for non-existent user ID={user_id}")
                 raise ValueError(f"User with ID {user_id} does not exist")
             
-            # Получаем посты, которые лайкнул пользователь
-            liked_posts = db.query(Post).join(Like).filter(Like.user_id == user_id).all()
-            
-            if not liked_posts:
-                logger.info(f"User {user_id} has no liked posts")
-                return
-            
-            # Получаем теги из лайкнутых постов
-            post_tags = []
-            for post in liked_posts:
-                tags = db.query(Tag).join(TagForPost).filter(TagForPost.post_id == post.post_id).all()
-                post_tags.extend(tags)
-            
-            # Подсчитываем частоту тегов
-            tag_counter = Counter([tag.tag_id for tag in post_tags])
-            most_common_tags = tag_counter.most_common(10)  # Берем 10 самых популярных тегов
-            
-            # Очищаем текущие теги пользователя
-            db.query(TagForUser).filter(TagForUser.user_id == user_id).delete()
+            PostService._replace_user_tags(db, user_id)
             db.commit()
             
-            # Добавляем новые теги
-            for tag_id, _ in most_common_tags:
-                # Получаем максимальное значение id для TagForUser и прибавляем 1
-                max_tag_user_id = db.query(func.max(TagForUser.id)).scalar() or 0
-                next_tag_user_id = max_tag_user_id + 1
-                
-                # Создаем новую связь между пользователем и тегом
-                tag_for_user = TagForUser(
-                    id=next_tag_user_id,
-                    user_id=user_id,
-                    tag_id=tag_id
-                )
-                db.add(tag_for_user)
-                # Фиксируем каждое добавление тега отдельно
-                db.commit()
-            
             logger.info(f"Updated tags for user ID: {user_id}")
         except Exception as e:
             db.rollback()
@@ -609,50 +784,77 @@ class PostService:
             raise
 
     @staticmethod
-    def get_recommended_posts(db: Session, user_id: int, skip: int = 0, limit: int = 10):
+    def update_all_user_tags_from_likes(db: Session) -> int:
         """
-        Получает рекомендованные посты для пользователя с учетом его интересов и популярности постов.
+        Пересчитывает теги всех пользователей с лайками за один проход (для ночных задач).
+        
+        Args:
+            db (Session): Сессия базы данных
+            
+        Returns:
+            int: Количество записанных связей пользователь-тег
         """
         try:
-            # Получаем теги пользователя
-            user_tags = db.query(Tag).join(TagForUser).filter(TagForUser.user_id == user_id).all()
-            user_tag_ids = [tag.tag_id for tag in user_tags]
+            weight = func.count(Like.like_id)
+            ranked_tags = (
+                select(
+                    Like.user_id.label("user_id"),
+                    TagForPost.tag_id.label("tag_id"),
+                    weight.label("weight"),
+                    func.row_number().over(
+                        partition_by=Like.user_id,
+                        order_by=(weight.desc(), TagForPost.tag_id)
+                    ).label("tag_rank")
+                )
+                .join(Like, Like.post_id == TagForPost.post_id)
+                .group_by(Like.user_id, TagForPost.tag_id)
+                .subquery()
+            )
             
-            # Получаем посты, которые пользователь уже лайкнул
-            liked_posts = db.query(Like.post_id).filter(Like.user_id == user_id).all()
-            liked_post_ids = [post_id for (post_id,) in liked_posts]
+            # Как и при пересчете одного пользователя, теги пользователей без
+            # лайков (например, заданные в профиле) остаются как есть
+            db.query(TagForUser).filter(
+                TagForUser.user_id.in_(select(Like.user_id).distinct())
+            ).delete(synchronize_session=False)
             
-            # Получаем все посты с тегами и информацией о пользователе
-            posts_query = db.query(Post, User).join(User).join(TagForPost).join(Tag).filter(
-                Post.child_id.is_(None),  # Только основные посты
-                Post.post_type_id == 1,   # Только посты (не комментарии)
-                ~Post.post_id.in_(liked_post_ids)  # Исключаем посты, которые пользователь уже лайкнул
-            )
+            next_id = select(func.coalesce(func.max(TagForUser.id), 0)).scalar_subquery()
+            rows = select(
+                next_id + func.row_number().over(order_by=(ranked_tags.c.user_id, ranked_tags.c.tag_rank)),
+                ranked_tags.c.user_id,
+                ranked_tags.c.tag_id,
+                ranked_tags.c.weight
+            ).where(ranked_tags.c.tag_rank <= USER_TAGS_LIMIT)
+            result = db.execute(insert(TagForUser).from_select(["id", "user_id", "tag_id", "weight"], rows))
+            RecommendationCache.clear(db)
+            db.commit()
+            UserProfileCache.clear()
             
-            # Если у пользователя есть теги, добавляем фильтр по тегам
-            if user_tag_ids:
-                posts_query = posts_query.filter(Tag.tag_id.in_(user_tag_ids))
-            
-            # Получаем посты, упорядоченные по дате создания
-            posts = posts_query.order_by(desc(Post.creation_date)).offset(skip).limit(limit).all()
-            
-            # Если постов с тегами пользователя недостаточно, добавляем популярные посты
-            if len(posts) < limit:
-                remaining_limit = limit - len(posts)
-                popular_posts = db.query(Post, User).join(User).join(Like).filter(
-                    Post.child_id.is_(None),
-                    Post.post_type_id == 1,
-                    ~Post.post_id.in_(liked_post_ids),
-                    ~Post.post_id.in_([p[0].post_id for p in posts])  # Исключаем уже выбранные посты
-                ).group_by(Post.post_id, User.user_id).order_by(func.count(Like.like_id).desc()).limit(remaining_limit).all()
-                
-                posts.extend(popular_posts)
+            logger.info(f"Updated tags for all users: {result.rowcount} user-tag links")
+            return result.rowcount
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error updating tags for all users: {str(e)}")
+            raise
+
+    @staticmethod
+    def build_posts_details(db: Session, posts: list, viewer_id: int = None):
+        """
+        Формирует детальную информацию (лайки, теги, дерево комментариев) для списка постов.
+        
+        Args:
+            db (Session): Сессия базы данных
+            posts (list): Список пар (Post, User) в нужном порядке
+            viewer_id (int): ID просматривающего пользователя для флагов liked_by_viewer
             
+        Returns:
+            list: Список словарей, соответствующих схеме PostDetail
+        """
+        try:
             # Получаем детальную информацию о постах
             posts_with_details = []
             for post, user in posts:
                 # Получаем количество лайков
-                likes_count = db.query(func.count(Like.like_id)).filter(Like.post_id == post.post_id).scalar()
+                likes_count = LikeCounter.get_count(post)
                 
                 # Получаем теги поста с информацией о типе тега
                 tags = db.query(Tag, TagType).join(TagType).join(TagForPost).filter(TagForPost.post_id == post.post_id).all()
@@ -684,6 +886,7 @@ class PostService:
                             "child_id": reply.child_id,
                             "user_id": reply.user_id,
                             "media_link": reply.media_link,
+                            "media_variants": reply.media_variants,
                             "creation_date": reply.creation_date,
                             "views_count": reply.views_count,
                             "post_type_id": reply.post_type_id,
@@ -703,6 +906,7 @@ class PostService:
                         "child_id": comment.child_id,
                         "user_id": comment.user_id,
                         "media_link": comment.media_link,
+                        "media_variants": comment.media_variants,
                         "creation_date": comment.creation_date,
                         "views_count": comment.views_count,
                         "post_type_id": comment.post_type_id,
@@ -718,7 +922,9 @@ class PostService:
                     "user_id": post.user_id,
                     "user_name": user.name,
                     "user_image": user.image_link,
+                    "user_image_variants": user.image_variants,
                     "media_link": post.media_link,
+                    "media_variants": post.media_variants,
                     "creation_date": post.creation_date,
                     "views_count": post.views_count,
                     "post_type_id": post.post_type_id,
@@ -729,10 +935,10 @@ class PostService:
                 
                 posts_with_details.append(post_dict)
             
-            return posts_with_details
+            return PostService._mark_liked_by_viewer(db, posts_with_details, viewer_id)
             
         except Exception as e:
-            logger.error(f"Error getting recommended posts: {str(e)}")
+            logger.error(f"Error building post details: {str(e)}")
             raise
 
     @staticmethod
@@ -749,65 +955,136 @@ class PostService:
             dict: Словарь с подробной информацией о пользователе
         """
         try:
-            # Получаем пользователя
-            user = db.query(User).filter(User.user_id == user_id).first()
-            
-            if not user:
-                return None
-            
-            # Получаем теги пользователя через связь TagForUser с информацией о типе тега
-            user_tags = (
-                db.query(Tag, TagType)
-                .join(TagType)
-                .join(TagForUser)
-                .filter(TagForUser.user_id == user_id)
-                .all()
-            )
+            return PostService.get_users_details(db, [user_id]).get(user_id)
+        except Exception as e:
+            logger.error(f"Error getting user details for user ID {user_id}: {str(e)}")
+            raise
+
+    @staticmethod
+    def get_users_details(db: Session, user_ids: list):
+        """
+        Получает подробную информацию о нескольких пользователях.
+        
+        Профили берутся из кэша, остальные собираются одним запросом: количество
+        постов и полученных лайков берется из счетчиков user_table, а теги
+        (не более USER_TAGS_LIMIT на пользователя) присоединяются внешним
+        соединением. Собранные профили кэшируются на короткое время.
+        
+        Args:
+            db (Session): Сессия базы данных
+            user_ids (list): ID пользователей
             
-            # Преобразуем теги в формат, соответствующий схеме Tag
-            tags = [
-                {
+        Returns:
+            dict: {user_id: словарь с подробной информацией}; несуществующие пользователи пропускаются
+        """
+        details = {}
+        missing_ids = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = UserProfileCache.get(user_id)
+            if cached is not None:
+                details[user_id] = cached
+            else:
+                missing_ids.append(user_id)
+        
+        if not missing_ids:
+            return details
+        
+        rows = (
+            db.query(User, ProfileType.name, Tag, TagType)
+            .outerjoin(ProfileType, ProfileType.type_id == User.type_id)
+            .outerjoin(TagForUser, TagForUser.user_id == User.user_id)
+            .outerjoin(Tag, Tag.tag_id == TagForUser.tag_id)
+            .outerjoin(TagType, TagType.tag_type_id == Tag.tag_type_id)
+            .filter(User.user_id.in_(missing_ids))
+            .order_by(User.user_id, TagForUser.weight.desc(), TagForUser.tag_id)
+            .all()
+        )
+        
+        loaded = {}
+        for user, profile_type_name, tag, tag_type in rows:
+            user_details = loaded.get(user.user_id)
+            if user_details is None:
+                # Создаем словарь с данными пользователя
+                user_details = loaded[user.user_id] = {
+                    "user_id": user.user_id,
+                    "login": user.login,
+                    "name": user.name,
+                    "type_id": user.type_id,
+                    "profile_type": profile_type_name,
+                    "image_link": user.image_link,
+                    "image_variants": user.image_variants,
+                    "description": user.description,
+                    "rating": user.rating,
+                    "tags": [],
+                    "post_count": user.post_count,
+                    "likes_count": user.received_likes_count
+                }
+            if tag is not None:
+                # Преобразуем теги в формат, соответствующий схеме Tag
+                user_details["tags"].append({
                     "tag_id": tag.tag_id,
                     "name": tag.name,
                     "tag_type": {
                         "type_id": tag_type.tag_type_id,
                         "name": tag_type.name
                     }
-                }
-                for tag, tag_type in user_tags
-            ]
+                })
+        
+        for user_id, user_details in loaded.items():
+            UserProfileCache.put(user_id, user_details)
+        details.update(loaded)
+        return details
+
+    @staticmethod
+    def get_users_cards(db: Session, user_ids: list):
+        """
+        Получает краткие карточки пользователей (схема UserCard).
+        
+        Профили из кэша используются как есть, для остальных пользователей
+        выбираются только поля карточки и название типа профиля.
+        
+        Args:
+            db (Session): Сессия базы данных
+            user_ids (list): ID пользователей
             
-            # Получаем количество постов пользователя
-            post_count = db.query(func.count(Post.post_id)).filter(Post.user_id == user_id).scalar()
-            
-            # Получаем количество лайков, которые получили посты пользователя
-            likes_count = db.query(func.count(Like.like_id)).join(Post).filter(Post.user_id == user_id).scalar()
-            
-            # Получаем тип профиля пользователя
-            profile_type = db.query(ProfileType).filter(ProfileType.type_id == user.type_id).first()
-            
-            # Создаем словарь с данными пользователя
-            user_details = {
-                "user_id": user.user_id,
-                "login": user.login,
-                "name": user.name,
-                "type_id": user.type_id,
-                "profile_type": profile_type.name if profile_type else None,
-                "image_link": user.image_link,
-                "description": user.description,
-                "rating": user.rating,
-                "tags": tags,
-                "post_count": post_count,
-                "likes_count": likes_count
+        Returns:
+            dict: {user_id: словарь карточки}; несуществующие пользователи пропускаются
+        """
+        cards = {}
+        missing_ids = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = UserProfileCache.get(user_id)
+            if cached is not None:
+                cards[user_id] = cached
+            else:
+                missing_ids.append(user_id)
+        
+        if not missing_ids:
+            return cards
+        
+        rows = (
+            db.query(
+                User.user_id, User.login, User.name, User.image_link, User.image_variants,
+                User.rating, ProfileType.name
+            )
+            .outerjoin(ProfileType, ProfileType.type_id == User.type_id)
+            .filter(User.user_id.in_(missing_ids))
+            .all()
+        )
+        for user_id, login, name, image_link, image_variants, rating, profile_type_name in rows:
+            cards[user_id] = {
+                "user_id": user_id,
+                "login": login,
+                "name": name,
+                "image_link": image_link,
+                "image_variants": image_variants,
+                "profile_type": profile_type_name,
+                "rating": rating
             }
-            
-            return user_details
-        except Exception as e:
-            logger.error(f"Error getting user details for user ID {user_id}: {str(e)}")
-            raise
+        return cards
 
     @staticmethod
-    def get_posts_with_details(db: Session, skip: int = 0, limit: int = 100):
+    def get_posts_with_details(db: Session, skip: int = 0, limit: int = 100, viewer_id: int = None):
         """
         Получает список постов с детальной информацией о лайках и комментариях.
         """
@@ -822,7 +1099,7 @@ class PostService:
             posts_with_details = []
             for post in posts:
                 # Получаем количество лайков
-                likes_count = db.query(func.count(Like.like_id)).filter(Like.post_id == post.post_id).scalar()
+                likes_count = LikeCounter.get_count(post)
                 
                 # Получаем теги поста с информацией о типе тега
                 tags = db.query(Tag, TagType).join(TagType).join(TagForPost).filter(TagForPost.post_id == post.post_id).all()
@@ -854,6 +1131,7 @@ class PostService:
                             "child_id": reply.child_id,
                             "user_id": reply.user_id,
                             "media_link": reply.media_link,
+                            "media_variants": reply.media_variants,
                             "creation_date": reply.creation_date,
                             "views_count": reply.views_count,
                             "post_type_id": reply.post_type_id,
@@ -873,6 +1151,7 @@ class PostService:
                         "child_id": comment.child_id,
                         "user_id": comment.user_id,
                         "media_link": comment.media_link,
+                        "media_variants": comment.media_variants,
                         "creation_date": comment.creation_date,
                         "views_count": comment.views_count,
                         "post_type_id": comment.post_type_id,
@@ -891,7 +1170,9 @@ class PostService:
                     "user_id": post.user_id,
                     "user_name": user.name,
                     "user_image": user.image_link,
+                    "user_image_variants": user.image_variants,
                     "media_link": post.media_link,
+                    "media_variants": post.media_variants,
                     "creation_date": post.creation_date,
                     "views_count": post.views_count,
                     "post_type_id": post.post_type_id,
@@ -902,7 +1183,7 @@ class PostService:
                 
                 posts_with_details.append(post_dict)
             
-            return posts_with_details
+            return PostService._mark_liked_by_viewer(db, posts_with_details, viewer_id)
             
         except Exception as e:
             logger.error(f"Error getting posts with details: {str(e)}")
@@ -0,0 +1,369 @@
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, desc, select, literal, cast, exists, Float
+from app.models.models import Post, Like, TagForPost, Tag, TagForUser, PostEmbedding
+from app.services.post_service import PostService
+from app.utils.tag_index import TagPostIndex
+from app.utils.seen_set import SeenSetCache
+from app.utils.embedding_index import PostEmbeddingIndex
+from app.utils.popularity import PopularityRanking
+from app.utils.co_like import CoLikeSimilarity
+from app.utils.recommendation_cache import RecommendationCache
+import os
+import time
+import logging
+import numpy as np
+
+# Получаем логгер
+logger = logging.getLogger("app")
+
+
+class RecommendationService:
+    """
+    Рекомендации постов пользователю.
+
+    Итоговая оценка поста считается в БД одним агрегирующим запросом
+    (слагаемое совместных лайков добавляется после него):
+        TAG_WEIGHT * (сумма весов общих тегов / сумма весов тегов пользователя)
+        + RECENCY_WEIGHT * 1 / (1 + возраст_в_часах / RECENCY_HALF_LIFE_HOURS)
+        + LIKES_WEIGHT * лайки / (лайки + LIKES_SATURATION)
+        + CO_LIKE_WEIGHT * схожесть по совместным лайкам (если матрица построена)
+    Все слагаемые лежат в [0, 1], веса настраиваются переменными окружения.
+    """
+
+    TAG_WEIGHT = float(os.getenv("RECOMMENDATION_TAG_WEIGHT", "1.0"))
+    RECENCY_WEIGHT = float(os.getenv("RECOMMENDATION_RECENCY_WEIGHT", "0.5"))
+    LIKES_WEIGHT = float(os.getenv("RECOMMENDATION_LIKES_WEIGHT", "0.3"))
+    # Возраст поста (в часах), при котором вклад новизны падает вдвое
+    RECENCY_HALF_LIFE_HOURS = float(os.getenv("RECOMMENDATION_RECENCY_HALF_LIFE_HOURS", "48"))
+    # Количество лайков, при котором вклад популярности достигает половины
+    LIKES_SATURATION = float(os.getenv("RECOMMENDATION_LIKES_SATURATION", "20"))
+    # Сколько кандидатов из индекса тегов передается на оценку в БД
+    CANDIDATE_POOL = int(os.getenv("RECOMMENDATION_CANDIDATE_POOL", "500"))
+    # Вес схожести по совместным лайкам (нормированной к [0, 1]) в итоговой оценке
+    CO_LIKE_WEIGHT = float(os.getenv("RECOMMENDATION_CO_LIKE_WEIGHT", "0.5"))
+    # Сколько последних лайков пользователя служат затравкой для совместных лайков
+    CO_LIKE_SEEDS = int(os.getenv("RECOMMENDATION_CO_LIKE_SEEDS", "50"))
+    # Сколько постов хранится в кэшированном снимке рекомендаций пользователя
+    SNAPSHOT_SIZE = int(os.getenv("RECOMMENDATION_SNAPSHOT_SIZE", "300"))
+    # Сколько последних лайков пользователя участвует в построении его вектора интересов
+    SEMANTIC_PROFILE_LIKES = int(os.getenv("SEMANTIC_PROFILE_LIKES", "200"))
+
+    @staticmethod
+    def _not_liked_by(user_id: int):
+        """Условие NOT EXISTS (лайк пользователя на пост) для анти-соединения с like_table."""
+        user_like = aliased(Like)
+        return ~exists().where(user_like.post_id == Post.post_id, user_like.user_id == user_id)
+
+    @staticmethod
+    def score_tag_matches(db: Session, user_id: int, candidate_ids: list = None, skip: int = 0, limit: int = 10):
+        """
+        Оценивает посты с общими с пользователем тегами и возвращает их по убыванию оценки.
+
+        Каждый пост возвращается один раз, сколько бы тегов пользователя у него ни было.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+            candidate_ids (list): Если задан, оцениваются только эти посты
+            skip (int): Сколько постов пропустить
+            limit (int): Максимальное количество постов
+
+        Returns:
+            list: Список пар (post_id, score)
+        """
+        user_tags = (
+            select(TagForUser.tag_id, TagForUser.weight)
+            .where(TagForUser.user_id == user_id)
+            .subquery()
+        )
+        total_weight = select(func.sum(TagForUser.weight)).where(TagForUser.user_id == user_id).scalar_subquery()
+
+        age_hours = (literal(time.time()) - func.extract("epoch", Post.creation_date)) / 3600.0
+        likes = cast(Post.likes_count, Float)
+        score = (
+            RecommendationService.TAG_WEIGHT * cast(func.sum(user_tags.c.weight), Float) / total_weight
+            + RecommendationService.RECENCY_WEIGHT / (1.0 + age_hours / RecommendationService.RECENCY_HALF_LIFE_HOURS)
+            + RecommendationService.LIKES_WEIGHT * likes / (likes + RecommendationService.LIKES_SATURATION)
+        ).label("score")
+
+        query = (
+            select(Post.post_id, score)
+            .join(TagForPost, TagForPost.post_id == Post.post_id)
+            .join(user_tags, user_tags.c.tag_id == TagForPost.tag_id)
+            .where(
+                Post.child_id.is_(None),  # Только основные посты
+                Post.post_type_id == 1,   # Только посты (не комментарии)
+                RecommendationService._not_liked_by(user_id)
+            )
+            .group_by(Post.post_id, Post.creation_date, Post.likes_count)
+            .order_by(desc("score"), Post.post_id.desc())
+            .offset(skip)
+            .limit(limit)
+        )
+        if candidate_ids is not None:
+            query = query.where(Post.post_id.in_(candidate_ids))
+
+        return [(post_id, score) for post_id, score in db.execute(query).all()]
+
+    @staticmethod
+    def score_candidates(db: Session, user_id: int, candidate_ids: list, co_like_scores: dict, limit: int = 10):
+        """
+        Оценивает кандидатов с учетом совпадения тегов и схожести по совместным лайкам.
+
+        К оценке из score_tag_matches добавляется CO_LIKE_WEIGHT * (схожесть / максимальная
+        схожесть среди кандидатов), поэтому в выдачу попадают и посты без общих с
+        пользователем тегов (например, посты с одним изображением).
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+            candidate_ids (list): ID постов-кандидатов
+            co_like_scores (dict): Схожесть кандидатов по совместным лайкам {post_id: оценка}
+            limit (int): Максимальное количество постов
+
+        Returns:
+            list: Список пар (post_id, score) по убыванию оценки
+        """
+        user_tags = (
+            select(TagForUser.tag_id, TagForUser.weight)
+            .where(TagForUser.user_id == user_id)
+            .subquery()
+        )
+        total_weight = select(func.sum(TagForUser.weight)).where(TagForUser.user_id == user_id).scalar_subquery()
+        tag_matches = (
+            select(TagForPost.post_id.label("post_id"), func.sum(user_tags.c.weight).label("weight"))
+            .join(user_tags, user_tags.c.tag_id == TagForPost.tag_id)
+            .where(TagForPost.post_id.in_(candidate_ids))
+            .group_by(TagForPost.post_id)
+            .subquery()
+        )
+
+        age_hours = (literal(time.time()) - func.extract("epoch", Post.creation_date)) / 3600.0
+        likes = cast(Post.likes_count, Float)
+        base_score = (
+            RecommendationService.TAG_WEIGHT * func.coalesce(cast(tag_matches.c.weight, Float) / total_weight, 0.0)
+            + RecommendationService.RECENCY_WEIGHT / (1.0 + age_hours / RecommendationService.RECENCY_HALF_LIFE_HOURS)
+            + RecommendationService.LIKES_WEIGHT * likes / (likes + RecommendationService.LIKES_SATURATION)
+        )
+        rows = db.execute(
+            select(Post.post_id, base_score)
+            .outerjoin(tag_matches, tag_matches.c.post_id == Post.post_id)
+            .where(
+                Post.post_id.in_(candidate_ids),
+                Post.child_id.is_(None),  # Только основные посты
+                Post.post_type_id == 1,   # Только посты (не комментарии)
+                RecommendationService._not_liked_by(user_id)
+            )
+        ).all()
+
+        max_co_like = max(co_like_scores.values(), default=0.0) or 1.0
+        scored = [
+            (post_id, score + RecommendationService.CO_LIKE_WEIGHT * co_like_scores.get(post_id, 0.0) / max_co_like)
+            for post_id, score in rows
+        ]
+        return sorted(scored, key=lambda item: (-item[1], -item[0]))[:limit]
+
+    @staticmethod
+    def co_like_candidates(db: Session, user_id: int, exclude, limit: int) -> dict:
+        """
+        Находит посты, похожие по совместным лайкам на последние лайки пользователя.
+
+        Returns:
+            dict: {post_id: суммарная схожесть}
+        """
+        seed_ids = [post_id for (post_id,) in db.query(Like.post_id).filter(
+            Like.user_id == user_id
+        ).order_by(Like.like_id.desc()).limit(RecommendationService.CO_LIKE_SEEDS)]
+        if not seed_ids:
+            return {}
+        return dict(CoLikeSimilarity.score(seed_ids, exclude, limit))
+
+    @staticmethod
+    def rank_post_ids(db: Session, user_id: int, size: int) -> list:
+        """
+        Формирует ранжированный список ID рекомендованных пользователю постов.
+
+        Сначала идут посты с общими тегами по убыванию оценки, затем список
+        дополняется популярными постами. Лайкнутые пользователем посты исключаются.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+            size (int): Максимальная длина списка
+
+        Returns:
+            list: ID постов в порядке ранжирования
+        """
+        # Получаем теги пользователя
+        user_tags = db.query(Tag).join(TagForUser).filter(TagForUser.user_id == user_id).all()
+        user_tag_ids = [tag.tag_id for tag in user_tags]
+
+        # Лайкнутые пользователем посты исключаются на стороне БД через NOT EXISTS,
+        # список его лайков в память не загружается
+        not_liked = RecommendationService._not_liked_by(user_id)
+
+        pool_size = max(RecommendationService.CANDIDATE_POOL, size)
+        seen = SeenSetCache.get(db, user_id)
+        # Кандидаты по совместным лайкам находят посты, у которых нет общих тегов с пользователем
+        co_like_scores = RecommendationService.co_like_candidates(db, user_id, seen, pool_size)
+
+        if user_tag_ids or co_like_scores:
+            # Пул кандидатов берем из инвертированного индекса тегов в памяти,
+            # лайкнутые посты отсеиваем по компактному множеству пользователя,
+            # а оценку и сортировку выполняем в БД
+            candidate_ids = []
+            if user_tag_ids:
+                TagPostIndex.ensure_fresh(db)
+                candidate_ids = TagPostIndex.candidates(user_tag_ids, seen, pool_size)
+
+            if co_like_scores:
+                candidate_ids = list(dict.fromkeys(list(candidate_ids) + list(co_like_scores)))
+                scored = RecommendationService.score_candidates(
+                    db, user_id, candidate_ids, co_like_scores, limit=size
+                )
+            else:
+                scored = RecommendationService.score_tag_matches(
+                    db, user_id, candidate_ids=candidate_ids, limit=size
+                ) if candidate_ids else []
+            ranked_ids = [post_id for post_id, _ in scored]
+        else:
+            # Получаем посты с тегами, от новых к старым
+            ranked_ids = [post_id for (post_id,) in db.query(Post.post_id).filter(
+                Post.child_id.is_(None),  # Только основные посты
+                Post.post_type_id == 1,   # Только посты (не комментарии)
+                Post.post_id.in_(select(TagForPost.post_id)),
+                not_liked  # Исключаем посты, которые пользователь уже лайкнул
+            ).order_by(desc(Post.creation_date)).limit(size).all()]
+
+        # Если постов с тегами пользователя недостаточно, добавляем популярные посты
+        # из предвычисленного рейтинга (чтение O(limit) без агрегации по like_table)
+        if len(ranked_ids) < size:
+            remaining_limit = size - len(ranked_ids)
+            chosen_ids = set(ranked_ids)
+            PopularityRanking.ensure_loaded(db)
+            popular_ids = [
+                post_id
+                for post_id in PopularityRanking.top(
+                    limit=remaining_limit + len(chosen_ids), exclude=seen
+                )
+                if post_id not in chosen_ids  # Исключаем уже выбранные посты
+            ][:remaining_limit]
+
+            if popular_ids:
+                not_liked_ids = {post_id for (post_id,) in db.query(Post.post_id).filter(
+                    Post.post_id.in_(popular_ids),
+                    not_liked
+                ).all()}
+                ranked_ids.extend(post_id for post_id in popular_ids if post_id in not_liked_ids)
+
+        return ranked_ids
+
+    @staticmethod
+    def get_recommended_posts(
+        db: Session,
+        user_id: int,
+        skip: int = 0,
+        limit: int = 10,
+        viewer_id: int = None,
+        snapshot: str = None
+    ):
+        """
+        Получает рекомендованные посты для пользователя с учетом его интересов и популярности постов.
+
+        Ранжированный список вычисляется один раз и кэшируется как снимок, страницы
+        нарезаются из него. Чтобы листать один и тот же снимок, клиент передает
+        полученный токен снимка в следующих запросах. Страницы за концом снимка
+        (длиной SNAPSHOT_SIZE) дополняются текущим ранжированием без повторов.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+            skip (int): Сколько постов пропустить
+            limit (int): Максимальное количество постов
+            viewer_id (int): ID просматривающего пользователя для флага liked_by_viewer
+            snapshot (str): Токен снимка с предыдущей страницы; если снимок устарел, строится новый
+
+        Returns:
+            tuple: (список словарей PostDetail, токен снимка)
+        """
+        try:
+            cached = RecommendationCache.get(db, user_id, snapshot)
+            if cached is None:
+                ranked_ids = RecommendationService.rank_post_ids(db, user_id, RecommendationService.SNAPSHOT_SIZE)
+                token = RecommendationCache.put(db, user_id, ranked_ids)
+            else:
+                token, ranked_ids = cached
+
+            page_ids = list(ranked_ids[skip:skip + limit])
+            if len(page_ids) < limit and len(ranked_ids) >= RecommendationService.SNAPSHOT_SIZE:
+                # Снимок обрезан по SNAPSHOT_SIZE, а не исчерпан: продолжаем текущим ранжированием
+                snapshot_ids = set(ranked_ids)
+                live_ids = [
+                    post_id
+                    for post_id in RecommendationService.rank_post_ids(db, user_id, skip + limit + len(ranked_ids))
+                    if post_id not in snapshot_ids
+                ]
+                start = max(skip - len(ranked_ids), 0)
+                page_ids += live_ids[start:start + limit - len(page_ids)]
+            posts = PostService.get_posts_by_ids(db, page_ids)
+            return PostService.build_posts_details(db, posts, viewer_id), token
+
+        except Exception as e:
+            logger.error(f"Error getting recommended posts: {str(e)}")
+            raise
+
+    @staticmethod
+    def get_user_embedding(db: Session, user_id: int):
+        """
+        Строит вектор интересов пользователя как нормированное среднее эмбеддингов
+        его последних лайкнутых постов.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+
+        Returns:
+            np.ndarray: Нормированный вектор float32 или None, если лайкнутых постов с эмбеддингами нет
+        """
+        recent_likes = (
+            select(Like.post_id)
+            .where(Like.user_id == user_id)
+            .order_by(Like.like_id.desc())
+            .limit(RecommendationService.SEMANTIC_PROFILE_LIKES)
+            .subquery()
+        )
+        rows = db.query(PostEmbedding.vector).filter(PostEmbedding.post_id.in_(select(recent_likes.c.post_id))).all()
+        if not rows:
+            return None
+
+        vectors = np.vstack([PostEmbeddingIndex.from_bytes(vector) for (vector,) in rows])
+        mean = vectors.mean(axis=0)
+        norm = np.linalg.norm(mean)
+        if norm == 0:
+            return None
+        return (mean / norm).astype(np.float32)
+
+    @staticmethod
+    def get_semantic_recommended_posts(db: Session, user_id: int, skip: int = 0, limit: int = 10, viewer_id: int = None):
+        """
+        Получает посты, семантически близкие к лайкнутым пользователем.
+
+        Поиск ближайших соседей выполняется полным перебором по матрице эмбеддингов
+        в памяти. Если у пользователя еще нет лайков с эмбеддингами, возвращаются
+        обычные рекомендации по тегам.
+        """
+        try:
+            user_vector = RecommendationService.get_user_embedding(db, user_id)
+            if user_vector is None:
+                posts, _ = RecommendationService.get_recommended_posts(db, user_id, skip=skip, limit=limit, viewer_id=viewer_id)
+                return posts
+
+            PostEmbeddingIndex.ensure_fresh(db)
+            matches = PostEmbeddingIndex.search(user_vector, SeenSetCache.get(db, user_id), skip + limit)[skip:]
+            posts = PostService.get_posts_by_ids(db, [post_id for post_id, _ in matches])
+
+            return PostService.build_posts_details(db, posts, viewer_id)
+
+        except Exception as e:
+            logger.error(f"Error getting semantic recommended posts: {str(e)}")
+            raise
@@ -1,19 +1,27 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, or_, select, text
 from app.models.models import User
-from app.schemas.post_schemas import UserCreate, UserUpdate, UserUpdateProfile, UserUpdateAvatar
+from app.db.database import SessionLocal
+from app.schemas.post_schemas import UserCreate, UserUpdate, UserUpdateProfile
 from fastapi import UploadFile, HTTPException
 from app.utils.image_handler import ImageHandler
+from app.utils.profile_cache import UserProfileCache
+from app.utils.leaderboard import RatingLeaderboard
+from app.utils.image_variants import ImageVariants
+import json
 import logging
-import tempfile
 import os
 from typing import Optional
 
 logger = logging.getLogger("app")
 
 class UserService:
+    # Установлено ли в БД расширение pg_trgm (проверяется один раз на воркер)
+    _trgm_available = None
+    
     @staticmethod
-    async def create_user(db: Session, user_data: UserCreate):
+    async def create_user(db: Session, user_data: UserCreate, image: UploadFile = None):
+        image_link = None
         try:
             # Проверяем, существует ли пользователь с таким логином
             existing_user = db.query(User).filter(User.login == user_data.login).first()
@@ -24,37 +32,8 @@ class UserService:
             max_id = db.query(func.max(User.user_id)).scalar() or 0
             next_id = max_id + 1
             
-            # Обрабатываем аватар, если он предоставлен
-            image_link = None
-            if user_data.image:
-                # Создаем временный файл для обработки бинарных данных
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(user_data.image)
-                    temp_file.flush()
-                    
-                    # Создаем UploadFile из временного файла
-                    upload_file = UploadFile(
-                        filename="avatar.jpg",
-                        file=open(temp_file.name, "rb")
-                    )
-                    
-                    # Сохраняем изображение и получаем путь к нему
-                    success, file_path, error_message = ImageHandler.save_image(
-                        upload_file, 
-                        prefix="avatar_", 
-                        directory="avatars"
-                    )
-                    
-                    # Закрываем и удаляем временный файл
-                    upload_file.file.close()
-                    os.unlink(temp_file.name)
-                    
-                    if not success:
-                        logger.error(f"Ошибка при сохранении аватара: {error_message}")
-                        raise HTTPException(status_code=400, detail=error_message)
-                    
-                    # Сохраняем ссылку на аватар
-                    image_link = file_path
+            # Сохраняем аватар, если он предоставлен
+            image_link = await UserService._store_avatar(next_id, image) if image else None
             
             # Создаем пользователя
             db_user = User(
@@ -71,36 +50,34 @@ class UserService:
             db.add(db_user)
             db.commit()
             db.refresh(db_user)
+            RatingLeaderboard.update(db_user.user_id, db_user.rating)
+            if image_link:
+                ImageVariants.schedule_avatar(db_user.user_id, image_link)
             
             logger.info(f"Created user with ID: {db_user.user_id}")
             return db_user
             
         except Exception as e:
             db.rollback()
+            if image_link:
+                ImageHandler.delete_image(image_link)
             logger.error(f"Error creating user: {str(e)}")
             raise
     
     @staticmethod
-    async def update_user(db: Session, user_id: int, user_data: UserUpdate):
+    async def update_user(db: Session, user_id: int, user_data: UserUpdate, image: UploadFile = None):
+        new_image_link = None
         try:
             db_user = db.query(User).filter(User.user_id == user_id).first()
             if not db_user:
                 return None
             
-            # Обрабатываем аватар, если он предоставлен
-            if user_data.image:
-                # Если у пользователя уже есть аватар, удаляем его
-                if db_user.image_link and db_user.image_link.startswith("/uploads/avatars/"):
-                    ImageHandler.delete_image(db_user.image_link)
-                
-                # Сохраняем новое изображение и получаем путь к нему
-                success, file_path, error_message = ImageHandler.save_image(user_data.image, prefix="avatar_", directory="avatars")
-                if not success:
-                    logger.error(f"Ошибка при сохранении аватара: {error_message}")
-                    raise HTTPException(status_code=400, detail=error_message)
-                
-                # Обновляем ссылку на аватар
-                db_user.image_link = file_path
+            # Сохраняем новый аватар, если он предоставлен
+            previous_image_link = db_user.image_link
+            if image:
+                new_image_link = await UserService._store_avatar(user_id, image)
+                db_user.image_link = new_image_link
+                db_user.image_variants = None
             
             # Обновляем остальные поля пользователя
             if user_data.name is not None:
@@ -109,14 +86,24 @@ class UserService:
                 db_user.description = user_data.description
             if user_data.rating is not None:
                 db_user.rating = user_data.rating
+                db_user.rating_updated_at = func.now()
             
             db.commit()
             db.refresh(db_user)
+            UserProfileCache.invalidate(user_id)
+            if user_data.rating is not None:
+                RatingLeaderboard.update(user_id, db_user.rating)
+            # Старый аватар удаляем только после успешного сохранения нового
+            if image:
+                UserService._delete_avatar(previous_image_link)
+                ImageVariants.schedule_avatar(user_id, new_image_link)
             logger.info(f"Updated user ID: {user_id}")
             return db_user
             
         except Exception as e:
             db.rollback()
+            if new_image_link:
+                ImageHandler.delete_image(new_image_link)
             logger.error(f"Error updating user {user_id}: {str(e)}")
             raise
     
@@ -124,18 +111,121 @@ class UserService:
     def get_user(db: Session, user_id: int):
         return db.query(User).filter(User.user_id == user_id).first()
     
+    @classmethod
+    def _is_fuzzy(cls, db: Session, mode: str) -> bool:
+        """
+        Можно ли искать по триграммному сходству: нужны PostgreSQL и расширение
+        pg_trgm. Миграция создает его, только если хватает прав, поэтому без него
+        режим fuzzy работает как contains.
+        """
+        if mode != "fuzzy" or db.bind.dialect.name != "postgresql":
+            return False
+        if cls._trgm_available is None:
+            cls._trgm_available = db.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).first() is not None
+            if not cls._trgm_available:
+                logger.warning("Расширение pg_trgm не установлено, поиск fuzzy выполняется по подстроке")
+        return cls._trgm_available
+    
+    @staticmethod
+    def _search_condition(db: Session, query: str, mode: str):
+        """
+        Условие поиска по login и name без учета регистра.
+        
+        prefix - по началу строки (индекс text_pattern_ops),
+        contains - по подстроке (триграммный GIN-индекс pg_trgm),
+        fuzzy - по триграммному сходству (только PostgreSQL с pg_trgm, иначе как contains).
+        """
+        needle = query.lower()
+        login, name = func.lower(User.login), func.lower(User.name)
+        if UserService._is_fuzzy(db, mode):
+            return or_(login.op("%")(needle), name.op("%")(needle))
+        
+        # Экранируем спецсимволы LIKE в поисковой строке
+        escaped = needle.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"{escaped}%" if mode == "prefix" else f"%{escaped}%"
+        return or_(login.like(pattern, escape="\\"), name.like(pattern, escape="\\"))
+    
+    @staticmethod
+    def list_users(db: Session, after_id: int = 0, limit: int = 100, query: str = None, mode: str = "prefix"):
+        """
+        Возвращает страницу каталога пользователей.
+        
+        Страницы нарезаются по ключу (user_id > after_id), а не через OFFSET,
+        поэтому стоимость запроса не растет с номером страницы. В режиме fuzzy
+        результаты упорядочены по сходству и не листаются.
+        
+        Args:
+            db (Session): Сессия базы данных
+            after_id (int): ID последнего пользователя предыдущей страницы
+            limit (int): Максимальное количество пользователей
+            query (str): Строка поиска по login и name
+            mode (str): Режим поиска: prefix, contains или fuzzy
+            
+        Returns:
+            list: Список словарей {id, login, name, image_link}
+        """
+        statement = select(User.user_id, User.login, User.name, User.image_link)
+        if query:
+            statement = statement.where(UserService._search_condition(db, query, mode))
+        
+        if query and UserService._is_fuzzy(db, mode):
+            needle = query.lower()
+            similarity = func.greatest(
+                func.similarity(func.lower(User.login), needle),
+                func.similarity(func.lower(User.name), needle)
+            )
+            statement = statement.order_by(similarity.desc(), User.user_id)
+        else:
+            statement = statement.where(User.user_id > after_id).order_by(User.user_id)
+        
+        return [
+            {"id": user_id, "login": login, "name": name, "image_link": image_link}
+            for user_id, login, name, image_link in db.execute(statement.limit(limit)).all()
+        ]
+    
+    @staticmethod
+    def export_users_ndjson(query: str = None, mode: str = "prefix", batch_size: int = 1000):
+        """
+        Генератор строк NDJSON со всеми пользователями (или найденными по query).
+        
+        Пользователи читаются пачками по ключу в отдельной сессии, поэтому выгрузка
+        не держит в памяти всю таблицу и не зависит от сессии запроса.
+        """
+        db = SessionLocal()
+        try:
+            after_id = 0
+            while True:
+                # В режиме fuzzy выгрузка тоже идет по ключу, без сортировки по сходству
+                batch = UserService.list_users(
+                    db, after_id=after_id, limit=batch_size, query=query,
+                    mode="contains" if mode == "fuzzy" else mode
+                )
+                if not batch:
+                    break
+                yield "".join(json.dumps(user, ensure_ascii=False) + "\n" for user in batch)
+                after_id = batch[-1]["id"]
+                # Не держим транзакцию открытой между пачками
+                db.rollback()
+        finally:
+            db.close()
+    
     @staticmethod
     def delete_user(db: Session, user_id: int):
         try:
             db_user = db.query(User).filter(User.user_id == user_id).first()
             if db_user:
-                # Удаляем аватар, если он существует
-                if db_user.image_link and db_user.image_link.startswith("/uploads/avatars/"):
-                    ImageHandler.delete_image(db_user.image_link)
+                image_link = db_user.image_link
                 
                 # Удаляем пользователя
                 db.delete(db_user)
                 db.commit()
+                # Аватар освобождаем после удаления пользователя: если удаление
+                # откатится, пользователь продолжит ссылаться на файл
+                UserService._delete_avatar(image_link)
+                UserProfileCache.invalidate(user_id)
+                RatingLeaderboard.remove(user_id)
                 logger.info(f"Deleted user ID: {user_id}")
                 return True
             return False
@@ -169,9 +259,13 @@ class UserService:
                 db_user.description = user_data.description
             if user_data.rating is not None:
                 db_user.rating = user_data.rating
+                db_user.rating_updated_at = func.now()
             
             db.commit()
             db.refresh(db_user)
+            UserProfileCache.invalidate(user_id)
+            if user_data.rating is not None:
+                RatingLeaderboard.update(user_id, db_user.rating)
             logger.info(f"Updated user profile ID: {user_id}")
             return db_user
             
@@ -181,135 +275,71 @@ class UserService:
             raise
 
     @staticmethod
-    async def update_user_avatar(db: Session, user_id: int, image: bytes) -> Optional[User]:
+    async def _store_avatar(user_id: int, image: UploadFile) -> str:
         """
-        Обновляет аватар пользователя.
+        Сохраняет загруженный аватар в директорию avatars.
+        
+        Файл копируется частями из загрузки прямо в конечную директорию без
+        чтения целиком в память; размер проверяется по ходу копирования, а
+        одинаковые файлы хранятся один раз.
         
-        Args:
-            db (Session): Сессия базы данных
-            user_id (int): ID пользователя
-            image (bytes): Бинарные данные изображения
-            
         Returns:
-            Optional[User]: Обновленный пользователь или None, если пользователь не найден
-        """
-        try:
-            # Получаем пользователя
-            user = db.query(User).filter(User.user_id == user_id).first()
-            if not user:
-                return None
+            str: Путь к аватару для хранения в БД
             
-            # Создаем временный файл для изображения
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-                temp_file.write(image)
-                temp_file_path = temp_file.name
-            
-            try:
-                # Создаем UploadFile из временного файла
-                upload_file = UploadFile(
-                    filename=f"avatar_{user_id}.png",
-                    file=open(temp_file_path, "rb")
-                )
-                
-                # Сохраняем изображение
-                success, file_path, error_message = ImageHandler.save_image(
-                    upload_file, 
-                    prefix=f"avatar_{user_id}_",
-                    directory="avatars"
-                )
-                
-                # Закрываем файл
-                upload_file.file.close()
-                
-                if not success:
-                    logger.error(f"Ошибка при сохранении аватара пользователя {user_id}: {error_message}")
-                    return None
-                
-                # Удаляем старый аватар, если он существует
-                if user.image_link and user.image_link.startswith("/uploads/avatars/"):
-                    ImageHandler.delete_image(user.image_link)
-                
-                # Обновляем ссылку на аватар
-                user.image_link = file_path
-                db.commit()
-                db.refresh(user)
-                
-                logger.info(f"Обновлен аватар пользователя {user_id}")
-                return user
-                
-            finally:
-                # Удаляем временный файл
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-                    
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка при обновлении аватара пользователя {user_id}: {str(e)}")
-            raise
+        Raises:
+            HTTPException: 400, если файл не прошел проверки
+        """
+        success, file_path, error_message = await ImageHandler.save_image(image, directory="avatars")
+        if not success:
+            logger.error(f"Ошибка при сохранении аватара пользователя {user_id}: {error_message}")
+            raise HTTPException(status_code=400, detail=error_message)
+        return file_path
+    
+    @staticmethod
+    def _delete_avatar(image_link: Optional[str]):
+        if image_link and image_link.startswith("/uploads/avatars/"):
+            ImageHandler.delete_image(image_link)
 
     @staticmethod
-    async def update_avatar(db: Session, user_id: int, image: bytes) -> Optional[User]:
+    async def update_avatar(db: Session, user_id: int, image: UploadFile) -> Optional[User]:
         """
         Обновляет только аватар пользователя.
         
         Args:
             db (Session): Сессия базы данных
             user_id (int): ID пользователя
-            image (bytes): Бинарные данные изображения
+            image (UploadFile): Загруженное изображение
             
         Returns:
             Optional[User]: Обновленный пользователь или None, если пользователь не найден
         """
+        image_link = None
         try:
             # Получаем пользователя
             user = db.query(User).filter(User.user_id == user_id).first()
             if not user:
                 return None
             
-            # Создаем временный файл для изображения
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-                temp_file.write(image)
-                temp_file_path = temp_file.name
+            previous_image_link = user.image_link
+            image_link = await UserService._store_avatar(user_id, image)
             
-            try:
-                # Создаем UploadFile из временного файла
-                upload_file = UploadFile(
-                    filename=f"avatar_{user_id}.png",
-                    file=open(temp_file_path, "rb")
-                )
-                
-                # Сохраняем изображение
-                success, file_path, error_message = ImageHandler.save_image(
-                    upload_file, 
-                    prefix=f"avatar_{user_id}_",
-                    directory="avatars"
-                )
-                
-                # Закрываем файл
-                upload_file.file.close()
-                
-                if not success:
-                    logger.error(f"Ошибка при сохранении аватара пользователя {user_id}: {error_message}")
-                    return None
-                
-                # Удаляем старый аватар, если он существует
-                if user.image_link and user.image_link.startswith("/uploads/avatars/"):
-                    ImageHandler.delete_image(user.image_link)
-                
-                # Обновляем ссылку на аватар
-                user.image_link = file_path
-                db.commit()
-                db.refresh(user)
-                
-                logger.info(f"Обновлен аватар пользователя {user_id}")
-                return user
-                
-            finally:
-                # Удаляем временный файл
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
+            # Обновляем ссылку на аватар
+            user.image_link = image_link
+            user.image_variants = None
+            db.commit()
+            db.refresh(user)
+            UserProfileCache.invalidate(user_id)
+            
+            # Удаляем старый аватар после успешного сохранения нового
+            UserService._delete_avatar(previous_image_link)
+            ImageVariants.schedule_avatar(user_id, image_link)
+            
+            logger.info(f"Обновлен аватар пользователя {user_id}")
+            return user
                     
         except Exception as e:
             db.rollback()
+            if image_link:
+                ImageHandler.delete_image(image_link)
             logger.error(f"Ошибка при обновлении аватара пользователя {user_id}: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
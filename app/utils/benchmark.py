@@ -0,0 +1,312 @@
+"""
+Офлайн-бенчмарк рекомендаций.
+
+Генерирует синтетический корпус (пользователи, теги, посты, лайки) со степенным
+распределением популярности в отдельную локальную базу, откладывает последние
+лайки каждого пользователя и проверяет, насколько хорошо каждая стратегия
+рекомендаций их находит. Для каждой стратегии считаются recall@k, nDCG@k и
+перцентили задержки p50/p95/p99. При одинаковых параметрах и seed корпус
+воспроизводится полностью, поэтому отчеты разных запусков сравнимы.
+
+Запуск:
+    python -m app.utils.benchmark --database-url sqlite:///benchmark.db --output benchmark.json
+
+Внимание: таблицы указанной базы пересоздаются, используйте отдельную базу.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import tempfile
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк стратегий рекомендаций")
+    parser.add_argument("--database-url", default="sqlite:///benchmark.db",
+                        help="База для синтетического корпуса (таблицы будут пересозданы)")
+    parser.add_argument("--users", type=int, default=500, help="Количество пользователей")
+    parser.add_argument("--posts", type=int, default=5000, help="Количество постов")
+    parser.add_argument("--tags", type=int, default=200, help="Количество тегов")
+    parser.add_argument("--likes-per-user", type=float, default=30, help="Среднее количество лайков на пользователя")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Доля последних лайков пользователя, отложенных для проверки")
+    parser.add_argument("--eval-users", type=int, default=200, help="Сколько пользователей участвует в оценке")
+    parser.add_argument("-k", type=int, default=10, help="Длина выдачи для recall@k и nDCG@k")
+    parser.add_argument("--seed", type=int, default=42, help="Seed генератора корпуса")
+    parser.add_argument("--strategies", default="tags,semantic,popular",
+                        help="Стратегии через запятую: tags, semantic, popular")
+    parser.add_argument("--output", help="Путь для JSON-отчета")
+    parser.add_argument("--reset", action="store_true", help="Пересоздать таблицы, даже если в базе уже есть посты")
+    return parser.parse_args(argv)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def _zipf_weights(size: int, exponent: float = 1.1) -> np.ndarray:
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_corpus(args):
+    """
+    Генерирует синтетический корпус в памяти.
+
+    Популярность тегов и постов распределена по Ципфу. У каждого пользователя есть
+    2-4 любимых тега; лайк с вероятностью 0.8 ставится посту с одним из них
+    (чем популярнее пост, тем вероятнее), иначе - случайному популярному посту.
+    Эмбеддинги постов - шумное среднее случайных векторов их тегов.
+
+    Returns:
+        dict: Списки строк для вставки и отложенные лайки {user_id: [post_id, ...]}
+    """
+    rng = np.random.default_rng(args.seed)
+    now = datetime.now()
+    dim = 64
+
+    tag_weights = _zipf_weights(args.tags)
+    tag_vectors = rng.normal(size=(args.tags, dim)).astype(np.float32)
+
+    users = [
+        {"user_id": user_id, "login": f"bench_user_{user_id}", "password": "-", "type_id": 1,
+         "name": f"Пользователь {user_id}", "rating": 0.0}
+        for user_id in range(1, args.users + 1)
+    ]
+    tags = [{"tag_id": tag_id, "name": f"тег_{tag_id}", "tag_type_id": 1} for tag_id in range(1, args.tags + 1)]
+
+    # Порядок постов случаен, популярность не зависит от даты создания
+    post_popularity = rng.permutation(_zipf_weights(args.posts, 0.9))
+    posts, post_tags, embeddings = [], [], []
+    posts_by_tag = {tag_id: [] for tag_id in range(1, args.tags + 1)}
+    link_id = 0
+    for post_id in range(1, args.posts + 1):
+        created = now - timedelta(hours=float(rng.uniform(0, 24 * 30)))
+        post_tag_ids = sorted(set(int(t) + 1 for t in rng.choice(args.tags, size=int(rng.integers(1, 4)), p=tag_weights)))
+        posts.append({"post_id": post_id, "content": " ".join(f"тег_{t}" for t in post_tag_ids), "user_id": int(rng.integers(1, args.users + 1)),
+                      "post_type_id": 1, "creation_date": created, "views_count": 0, "likes_count": 0})
+        for tag_id in post_tag_ids:
+            link_id += 1
+            post_tags.append({"id": link_id, "post_id": post_id, "tag_id": tag_id})
+            posts_by_tag[tag_id].append(post_id)
+        vector = tag_vectors[[t - 1 for t in post_tag_ids]].mean(axis=0) + rng.normal(scale=0.3, size=dim)
+        embeddings.append((post_id, (vector / np.linalg.norm(vector)).astype(np.float32)))
+
+    likes, held_out = [], {}
+    like_id = 0
+    for user in users:
+        user_id = user["user_id"]
+        favourite_tags = [int(t) + 1 for t in rng.choice(args.tags, size=int(rng.integers(2, 5)), replace=False, p=tag_weights)]
+        topical = sorted(set(post_id for tag_id in favourite_tags for post_id in posts_by_tag[tag_id]))
+        count = max(2, int(rng.poisson(args.likes_per_user)))
+        liked = []
+        seen = set()
+        for _ in range(count * 3):
+            if len(liked) >= count:
+                break
+            if topical and rng.random() < 0.8:
+                weights = post_popularity[np.array(topical) - 1]
+                post_id = int(rng.choice(topical, p=weights / weights.sum()))
+            else:
+                post_id = int(rng.choice(args.posts, p=post_popularity)) + 1
+            if post_id not in seen:
+                seen.add(post_id)
+                liked.append(post_id)
+
+        # Последние лайки пользователя откладываются для проверки
+        holdout_size = int(round(len(liked) * args.holdout))
+        train, test = liked[:len(liked) - holdout_size], liked[len(liked) - holdout_size:]
+        if test:
+            held_out[user_id] = test
+        for offset, post_id in enumerate(train):
+            like_id += 1
+            likes.append({"like_id": like_id, "post_id": post_id, "user_id": user_id,
+                          "creation_date": now - timedelta(hours=float(len(train) - offset))})
+
+    return {"users": users, "tags": tags, "posts": posts, "post_tags": post_tags,
+            "likes": likes, "embeddings": embeddings, "held_out": held_out}
+
+
+def load_corpus(db, corpus):
+    """Записывает корпус в базу и пересчитывает производные данные (лайки, теги пользователей, рейтинг)."""
+    from collections import Counter
+    from sqlalchemy import insert
+    from app.models.models import (
+        PostType, TagType, ProfileType, User, Tag, Post, TagForPost, Like, PostEmbedding
+    )
+    from app.services.post_service import PostService
+    from app.utils.popularity import PopularityRanking
+    from app.utils.embedding_index import PostEmbeddingIndex
+    from app.utils.co_like import CoLikeSimilarity
+
+    likes_count = Counter(like["post_id"] for like in corpus["likes"])
+    for post in corpus["posts"]:
+        post["likes_count"] = likes_count.get(post["post_id"], 0)
+
+    db.execute(insert(PostType), [{"post_type_id": 1, "name": "Пост"}, {"post_type_id": 2, "name": "Комментарий"}])
+    db.execute(insert(TagType), [{"tag_type_id": 1, "name": "Тема"}])
+    db.execute(insert(ProfileType), [{"type_id": 1, "name": "Студент"}])
+    db.execute(insert(User), corpus["users"])
+    db.execute(insert(Tag), corpus["tags"])
+    db.execute(insert(Post), corpus["posts"])
+    db.execute(insert(TagForPost), corpus["post_tags"])
+    if corpus["likes"]:
+        db.execute(insert(Like), corpus["likes"])
+    db.execute(insert(PostEmbedding), [
+        {"post_id": post_id, "vector": PostEmbeddingIndex.to_bytes(vector)} for post_id, vector in corpus["embeddings"]
+    ])
+    db.commit()
+
+    PostService.update_all_user_tags_from_likes(db)
+    PopularityRanking.recompute(db)
+    PopularityRanking.load(db)
+
+    # Матрица совместных лайков строится в отдельный каталог, чтобы не затронуть рабочую
+    CoLikeSimilarity.DATA_DIR = tempfile.mkdtemp(prefix="co_like_benchmark_")
+    CoLikeSimilarity.REFRESH_INTERVAL = 0
+    CoLikeSimilarity.build(db, incremental=False)
+
+
+def recall_at_k(recommended, relevant, k: int) -> float:
+    hits = len(set(recommended[:k]) & set(relevant))
+    return hits / len(relevant)
+
+
+def ndcg_at_k(recommended, relevant, k: int) -> float:
+    relevant = set(relevant)
+    dcg = sum(1.0 / math.log2(rank + 2) for rank, post_id in enumerate(recommended[:k]) if post_id in relevant)
+    ideal = sum(1.0 / math.log2(rank + 2) for rank in range(min(len(relevant), k)))
+    return dcg / ideal if ideal else 0.0
+
+
+def _strategies():
+    from app.services.post_service import PostService
+    from app.services.recommendation_service import RecommendationService
+    from app.utils.recommendation_cache import RecommendationCache
+
+    def tags(db, user_id, k):
+        # Снимок сбрасывается, чтобы измерять полное ранжирование, а не чтение из кэша
+        RecommendationCache.invalidate(db, user_id)
+        posts, _ = RecommendationService.get_recommended_posts(db, user_id, limit=k)
+        return posts
+
+    def semantic(db, user_id, k):
+        return RecommendationService.get_semantic_recommended_posts(db, user_id, limit=k)
+
+    def popular(db, user_id, k):
+        return PostService.get_popular_posts(db, limit=k)
+
+    return {"tags": tags, "semantic": semantic, "popular": popular}
+
+
+def evaluate(db, corpus, strategy_names, k: int, eval_users: int, seed: int):
+    """
+    Прогоняет стратегии на пользователях с отложенными лайками.
+
+    Returns:
+        dict: Метрики по стратегиям
+    """
+    strategies = _strategies()
+    user_ids = sorted(corpus["held_out"])
+    user_ids = sorted(random.Random(seed).sample(user_ids, min(eval_users, len(user_ids))))
+
+    results = {}
+    for name in strategy_names:
+        strategy = strategies[name]
+        recalls, ndcgs, latencies = [], [], []
+        for user_id in user_ids:
+            relevant = corpus["held_out"][user_id]
+            started = time.perf_counter()
+            posts = strategy(db, user_id, k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            recommended = [post["post_id"] for post in posts]
+            recalls.append(recall_at_k(recommended, relevant, k))
+            ndcgs.append(ndcg_at_k(recommended, relevant, k))
+        latencies = np.array(latencies)
+        results[name] = {
+            f"recall@{k}": round(float(np.mean(recalls)), 4),
+            f"ndcg@{k}": round(float(np.mean(ndcgs)), 4),
+            "latency_ms": {
+                "p50": round(float(np.percentile(latencies, 50)), 2),
+                "p95": round(float(np.percentile(latencies, 95)), 2),
+                "p99": round(float(np.percentile(latencies, 99)), 2),
+            },
+            "users": len(user_ids),
+        }
+    return results
+
+
+def _print_report(report):
+    k = report["config"]["k"]
+    print(f"\nРевизия: {report['revision']}, seed: {report['config']['seed']}, "
+          f"корпус: {report['corpus']['users']} польз. / {report['corpus']['posts']} постов / "
+          f"{report['corpus']['train_likes']} лайков (+{report['corpus']['held_out_likes']} отложено)")
+    print(f"{'стратегия':<12}{'recall@' + str(k):>12}{'ndcg@' + str(k):>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, metrics in report["results"].items():
+        latency = metrics["latency_ms"]
+        print(f"{name:<12}{metrics[f'recall@{k}']:>12.4f}{metrics[f'ndcg@{k}']:>10.4f}"
+              f"{latency['p50']:>10.2f}{latency['p95']:>10.2f}{latency['p99']:>10.2f}")
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    strategy_names = [name.strip() for name in args.strategies.split(",") if name.strip()]
+
+    # База бенчмарка подставляется до импорта приложения, которое создает engine при импорте
+    os.environ["DATABASE_URL"] = args.database_url
+    from app.db.database import Base, engine, SessionLocal
+    from app.models.models import Post
+
+    unknown = set(strategy_names) - set(_strategies())
+    if unknown:
+        sys.exit(f"Неизвестные стратегии: {', '.join(sorted(unknown))}")
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if db.query(Post.post_id).first() is not None and not args.reset:
+            sys.exit("В базе уже есть посты; укажите отдельную базу или флаг --reset")
+        db.close()
+        Base.metadata.drop_all(bind=engine)
+        Base.metadata.create_all(bind=engine)
+        db = SessionLocal()
+
+        started = time.perf_counter()
+        corpus = generate_corpus(args)
+        load_corpus(db, corpus)
+        print(f"Корпус сгенерирован и загружен за {time.perf_counter() - started:.1f} с")
+
+        report = {
+            "revision": _git_revision(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "reset")},
+            "corpus": {
+                "users": len(corpus["users"]),
+                "posts": len(corpus["posts"]),
+                "train_likes": len(corpus["likes"]),
+                "held_out_likes": sum(len(post_ids) for post_ids in corpus["held_out"].values()),
+            },
+            "results": evaluate(db, corpus, strategy_names, args.k, args.eval_users, args.seed),
+        }
+    finally:
+        db.close()
+
+    _print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен в {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
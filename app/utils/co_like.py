@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app.models.models import Like
+
+logger = logging.getLogger("app")
+
+
+class CoLikeSimilarity:
+    """
+    Матрица схожести постов по совместным лайкам (item-item коллаборативная фильтрация).
+
+    Схожесть постов i и j - косинус их векторов лайков:
+        co(i, j) / sqrt(likes(i) * likes(j)),
+    где co(i, j) - количество пользователей, лайкнувших оба поста. Для каждого поста
+    хранятся только TOP_K самых похожих соседей.
+
+    Матрица строится офлайн-задачей (`python -m app.utils.co_like`) и сохраняется
+    в каталог DATA_DIR в виде .npy-файлов в формате CSR, которые воркеры открывают
+    через memory map, не копируя в память процесса:
+        item_ids.npy  - отсортированные post_id строк
+        indptr.npy    - границы строк
+        neighbors.npy - post_id соседей
+        scores.npy    - схожесть с соседями (float32)
+    Инкрементальное обновление пересчитывает только строки постов с новыми лайками
+    (по like_id выше сохраненного high-water) и их записи в строках соседей.
+    Удаленные лайки учитываются при следующей полной перестройке.
+    """
+
+    DATA_DIR = os.getenv("CO_LIKE_DIR", "data/co_like")
+    # Сколько соседей хранится для каждого поста
+    TOP_K = int(os.getenv("CO_LIKE_TOP_K", "50"))
+    # Как часто воркер проверяет, не появилась ли новая версия матрицы (секунды)
+    REFRESH_INTERVAL = float(os.getenv("CO_LIKE_REFRESH_INTERVAL", "60"))
+    # Сколько строк матрицы считается за один шаг полной перестройки
+    BLOCK_SIZE = 4096
+
+    _lock = threading.Lock()
+    _version: Optional[str] = None
+    _item_ids = np.zeros(0, dtype=np.int64)
+    _indptr = np.zeros(1, dtype=np.int64)
+    _neighbors = np.zeros(0, dtype=np.int64)
+    _scores = np.zeros(0, dtype=np.float32)
+    _checked_at = 0.0
+
+    # ---------- офлайн-построение ----------
+
+    @classmethod
+    def _current_version(cls) -> Optional[str]:
+        try:
+            with open(os.path.join(cls.DATA_DIR, "CURRENT"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def _read(cls, version: str, mmap_mode: Optional[str] = "r"):
+        path = os.path.join(cls.DATA_DIR, version)
+        arrays = tuple(
+            np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ("item_ids", "indptr", "neighbors", "scores")
+        )
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        return arrays, meta
+
+    @classmethod
+    def _write(cls, item_ids, indptr, neighbors, scores, meta: dict) -> str:
+        """Записывает новую версию матрицы и атомарно переключает на нее CURRENT."""
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        path = os.path.join(cls.DATA_DIR, version)
+        os.makedirs(path, exist_ok=True)
+        for name, array in (("item_ids", item_ids), ("indptr", indptr), ("neighbors", neighbors), ("scores", scores)):
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        current_tmp = os.path.join(cls.DATA_DIR, "CURRENT.tmp")
+        with open(current_tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+        previous = cls._current_version()
+        os.replace(current_tmp, os.path.join(cls.DATA_DIR, "CURRENT"))
+
+        # Оставляем предыдущую версию: воркеры могут еще держать ее открытой
+        for name in os.listdir(cls.DATA_DIR):
+            full_path = os.path.join(cls.DATA_DIR, name)
+            if os.path.isdir(full_path) and name not in (version, previous):
+                shutil.rmtree(full_path, ignore_errors=True)
+        return version
+
+    @staticmethod
+    def _top_k(rows: np.ndarray, cols: np.ndarray, values: np.ndarray, k: int):
+        """Оставляет в каждой строке COO-матрицы k записей с наибольшими значениями."""
+        if len(rows) == 0:
+            return rows, cols, values
+        order = np.lexsort((cols, -values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+        rank = np.arange(len(rows)) - np.repeat(group_start, np.diff(np.r_[group_start, len(rows)]))
+        keep = rank < k
+        return rows[keep], cols[keep], values[keep]
+
+    @classmethod
+    def _similarities(cls, db: Session, post_ids: Optional[np.ndarray]):
+        """
+        Считает схожесть постов post_ids со всеми постами (None - все посты).
+
+        Читаются только лайки пользователей, лайкнувших эти посты.
+
+        Returns:
+            tuple: Массивы COO (post_id, post_id соседа, схожесть) без диагонали
+        """
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        likes = select(Like.user_id, Like.post_id)
+        if post_ids is not None:
+            likers = select(Like.user_id).where(Like.post_id.in_(post_ids.tolist())).distinct()
+            likes = likes.where(Like.user_id.in_(likers))
+        rows = db.execute(likes).all()
+        if not rows:
+            return empty
+
+        pairs = np.array(rows, dtype=np.int64)
+        users, user_index = np.unique(pairs[:, 0], return_inverse=True)
+        items, item_index = np.unique(pairs[:, 1], return_inverse=True)
+        matrix = sp.csr_matrix(
+            (np.ones(len(pairs), dtype=np.float32), (user_index, item_index)), shape=(len(users), len(items))
+        )
+        matrix.data[:] = 1.0  # повторные лайки одного поста не учитываются дважды
+        item_matrix = matrix.T.tocsr()
+
+        # Количество лайков у соседей считаем по всей таблице, а не по выбранным пользователям
+        if post_ids is None:
+            degrees = np.asarray(matrix.sum(axis=0)).ravel()
+        else:
+            counts = dict(db.execute(
+                select(Like.post_id, func.count(func.distinct(Like.user_id)))
+                .where(Like.post_id.in_(items.tolist()))
+                .group_by(Like.post_id)
+            ).all())
+            degrees = np.array([counts.get(int(item), 0) for item in items], dtype=np.float32)
+
+        target_rows = np.arange(len(items)) if post_ids is None else np.flatnonzero(np.isin(items, post_ids))
+        result_rows, result_cols, result_values = [], [], []
+        for start in range(0, len(target_rows), cls.BLOCK_SIZE):
+            block = target_rows[start:start + cls.BLOCK_SIZE]
+            co = (item_matrix[block] @ matrix).tocoo()
+            block_rows = block[co.row]
+            mask = block_rows != co.col
+            block_rows, cols, values = block_rows[mask], co.col[mask], co.data[mask]
+            values = (values / np.sqrt(degrees[block_rows] * degrees[cols])).astype(np.float32)
+            if post_ids is None:
+                # При полной перестройке обратные записи не нужны, обрезаем сразу
+                block_rows, cols, values = cls._top_k(block_rows, cols, values, cls.TOP_K)
+            result_rows.append(items[block_rows])
+            result_cols.append(items[cols])
+            result_values.append(values)
+
+        if not result_rows:
+            return empty
+        return np.concatenate(result_rows), np.concatenate(result_cols), np.concatenate(result_values)
+
+    @classmethod
+    def build(cls, db: Session, incremental: bool = True) -> dict:
+        """
+        Строит матрицу схожести и сохраняет новую версию в DATA_DIR.
+
+        Args:
+            db (Session): Сессия базы данных
+            incremental (bool): Пересчитать только посты с новыми лайками, если есть предыдущая версия
+
+        Returns:
+            dict: Метаданные сохраненной версии
+        """
+        started = time.monotonic()
+        high_water = db.query(func.max(Like.like_id)).scalar() or 0
+        previous = cls._current_version() if incremental else None
+
+        if previous is None:
+            rows, cols, values = cls._similarities(db, None)
+            touched = None
+        else:
+            (old_items, old_indptr, old_neighbors, old_scores), old_meta = cls._read(previous, mmap_mode=None)
+            touched = np.array(sorted(post_id for (post_id,) in db.query(Like.post_id).filter(
+                Like.like_id > old_meta["like_high_water"], Like.like_id <= high_water
+            ).distinct()), dtype=np.int64)
+            if len(touched) == 0:
+                logger.info("Матрица совместных лайков актуальна, новых лайков нет")
+                return old_meta
+
+            new_rows, new_cols, new_values = cls._similarities(db, touched)
+            # Старые записи, не связанные с затронутыми постами, сохраняются как есть
+            old_rows = np.repeat(old_items, np.diff(old_indptr))
+            keep = ~np.isin(old_rows, touched) & ~np.isin(old_neighbors, touched)
+            # Схожесть симметрична: новые значения записываем и в строки соседей
+            reverse = ~np.isin(new_cols, touched)
+            rows = np.concatenate([old_rows[keep], new_rows, new_cols[reverse]])
+            cols = np.concatenate([old_neighbors[keep], new_cols, new_rows[reverse]])
+            values = np.concatenate([old_scores[keep], new_values, new_values[reverse]])
+
+        rows, cols, values = cls._top_k(rows, cols, values, cls.TOP_K)
+        item_ids, counts = np.unique(rows, return_counts=True)
+        indptr = np.r_[0, np.cumsum(counts)].astype(np.int64)
+
+        meta = {
+            "like_high_water": int(high_water),
+            "top_k": cls.TOP_K,
+            "items": int(len(item_ids)),
+            "pairs": int(len(cols)),
+            "touched_items": None if touched is None else int(len(touched)),
+            "built_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        version = cls._write(item_ids.astype(np.int64), indptr, cols.astype(np.int64), values.astype(np.float32), meta)
+        logger.info(
+            f"Матрица совместных лайков {version} построена за {time.monotonic() - started:.1f} с: "
+            f"{meta['items']} постов, {meta['pairs']} пар"
+            + ("" if touched is None else f", пересчитано {meta['touched_items']} постов")
+        )
+        return meta
+
+    # ---------- онлайн-оценка ----------
+
+    @classmethod
+    def ensure_fresh(cls):
+        """Открывает актуальную версию матрицы, проверяя CURRENT не чаще раза в REFRESH_INTERVAL."""
+        if time.monotonic() - cls._checked_at < cls.REFRESH_INTERVAL:
+            return
+        cls._checked_at = time.monotonic()
+        version = cls._current_version()
+        if version is None or version == cls._version:
+            return
+        try:
+            (item_ids, indptr, neighbors, scores), _ = cls._read(version)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось открыть матрицу совместных лайков {version}: {str(e)}")
+            return
+        with cls._lock:
+            cls._item_ids, cls._indptr, cls._neighbors, cls._scores = item_ids, indptr, neighbors, scores
+            cls._version = version
+
+    @classmethod
+    def neighbors(cls, post_id: int) -> List[Tuple[int, float]]:
+        """Возвращает соседей поста: пары (post_id, схожесть) по убыванию схожести."""
+        with cls._lock:
+            item_ids, indptr, neighbors, scores = cls._item_ids, cls._indptr, cls._neighbors, cls._scores
+        row = np.searchsorted(item_ids, post_id)
+        if row >= len(item_ids) or item_ids[row] != post_id:
+            return []
+        start, end = indptr[row], indptr[row + 1]
+        return list(zip(neighbors[start:end].tolist(), scores[start:end].tolist()))
+
+    @classmethod
+    def score(cls, seed_post_ids: Iterable[int], exclude, limit: int) -> List[Tuple[int, float]]:
+        """
+        Оценивает посты по сумме схожести с постами-затравками (например, последними лайками пользователя).
+
+        Args:
+            seed_post_ids (Iterable[int]): ID постов-затравок
+            exclude: Множество (поддерживающее `in`) ID постов, которые нужно пропустить
+            limit (int): Максимальное количество результатов
+
+        Returns:
+            List[Tuple[int, float]]: Пары (post_id, оценка) по убыванию оценки
+        """
+        cls.ensure_fresh()
+        seeds = set(seed_post_ids)
+        totals = {}
+        for seed in seeds:
+            for post_id, similarity in cls.neighbors(seed):
+                if post_id in seeds or post_id in exclude:
+                    continue
+                totals[post_id] = totals.get(post_id, 0.0) + similarity
+        return sorted(totals.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Построение матрицы схожести постов по совместным лайкам")
+    parser.add_argument("--full", action="store_true", help="Перестроить матрицу полностью (учитывает удаленные лайки)")
+    args = parser.parse_args(argv)
+
+    from app.db.database import SessionLocal
+    db = SessionLocal()
+    try:
+        meta = CoLikeSimilarity.build(db, incremental=not args.full)
+        print(json.dumps(meta, ensure_ascii=False))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
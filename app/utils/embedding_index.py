@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from typing import Dict, List, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.models.models import Post, PostEmbedding
+
+logger = logging.getLogger("app")
+
+
+class PostEmbeddingIndex:
+    """
+    Матрица эмбеддингов основных постов в памяти воркера для семантического поиска.
+
+    Векторы хранятся построчно в одной матрице float32 (n x dim), уже нормированными,
+    поэтому косинусная близость к запросу считается одним матричным умножением.
+    Индекс прогревается из post_embedding_table, пополняется событиями текущего
+    воркера и периодически догружает посты других воркеров (по post_id). Удаления
+    и правки постов в других воркерах так не видны, поэтому раз в REBUILD_INTERVAL
+    матрица строится заново.
+    """
+
+    # Максимальное количество последних постов в матрице
+    MAX_POSTS = int(os.getenv("EMBEDDING_INDEX_MAX_POSTS", "100000"))
+    # Как часто догружать из БД посты, созданные другими воркерами (секунды)
+    REFRESH_INTERVAL = float(os.getenv("EMBEDDING_INDEX_REFRESH_INTERVAL", "30"))
+    # Как часто перестраивать матрицу целиком (секунды)
+    REBUILD_INTERVAL = float(os.getenv("EMBEDDING_INDEX_REBUILD_INTERVAL", "600"))
+
+    _lock = threading.Lock()
+    _matrix: Optional[np.ndarray] = None
+    _post_ids = np.zeros(0, dtype=np.int64)
+    _rows: Dict[int, int] = {}
+    _size = 0
+    _high_water = 0
+    _loaded = False
+    _refreshed_at = 0.0
+    _rebuilt_at = 0.0
+
+    @staticmethod
+    def to_bytes(vector: np.ndarray) -> bytes:
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> np.ndarray:
+        return np.frombuffer(data, dtype=np.float32)
+
+    @classmethod
+    def _append_locked(cls, post_id: int, vector: np.ndarray):
+        row = cls._rows.get(post_id)
+        if row is not None:
+            cls._matrix[row] = vector
+            return
+
+        if cls._matrix is None:
+            cls._matrix = np.zeros((1024, vector.shape[0]), dtype=np.float32)
+            cls._post_ids = np.zeros(1024, dtype=np.int64)
+        elif cls._size == cls._matrix.shape[0]:
+            if cls._size >= cls.MAX_POSTS:
+                # Вытесняем самую старую десятую часть постов
+                cls._compact_locked(cls._size // 10 or 1)
+            else:
+                capacity = min(cls._matrix.shape[0] * 2, cls.MAX_POSTS)
+                cls._matrix = np.resize(cls._matrix, (capacity, cls._matrix.shape[1]))
+                cls._post_ids = np.resize(cls._post_ids, capacity)
+
+        cls._matrix[cls._size] = vector
+        cls._post_ids[cls._size] = post_id
+        cls._rows[post_id] = cls._size
+        cls._size += 1
+
+    @classmethod
+    def _compact_locked(cls, evicted: int):
+        keep = slice(evicted, cls._size)
+        kept = cls._size - evicted
+        cls._matrix[:kept] = cls._matrix[keep]
+        cls._post_ids[:kept] = cls._post_ids[keep]
+        cls._size = kept
+        cls._rows = {int(post_id): row for row, post_id in enumerate(cls._post_ids[:kept]) if post_id > 0}
+
+    @classmethod
+    def ensure_fresh(cls, db: Session):
+        """
+        Прогревает матрицу при первом обращении, догружает новые посты раз в
+        REFRESH_INTERVAL и перестраивает ее целиком раз в REBUILD_INTERVAL.
+        """
+        now = time.monotonic()
+        rebuild = not cls._loaded or now - cls._rebuilt_at >= cls.REBUILD_INTERVAL
+        if not rebuild and now - cls._refreshed_at < cls.REFRESH_INTERVAL:
+            return
+
+        query = (
+            select(PostEmbedding.post_id, PostEmbedding.vector)
+            .join(Post, Post.post_id == PostEmbedding.post_id)
+            .where(Post.child_id.is_(None), Post.post_type_id == 1)
+        )
+        if rebuild:
+            # Берем только последние MAX_POSTS постов
+            recent = query.order_by(PostEmbedding.post_id.desc()).limit(cls.MAX_POSTS).subquery()
+            query = select(recent.c.post_id, recent.c.vector)
+        else:
+            query = query.where(PostEmbedding.post_id > cls._high_water)
+        rows = sorted(db.execute(query).all(), key=lambda row: row[0])
+
+        if rebuild:
+            # Новую матрицу собираем вне блокировки и подменяем целиком
+            post_ids = np.array([post_id for post_id, _ in rows], dtype=np.int64)
+            matrix = np.stack([cls.from_bytes(data) for _, data in rows]) if rows else None
+            with cls._lock:
+                cls._matrix = matrix
+                cls._post_ids = post_ids
+                cls._rows = {int(post_id): row for row, post_id in enumerate(post_ids)}
+                cls._size = len(rows)
+                cls._high_water = int(post_ids[-1]) if rows else 0
+                cls._loaded = True
+                cls._refreshed_at = cls._rebuilt_at = now
+            return
+
+        with cls._lock:
+            for post_id, data in rows:
+                cls._append_locked(post_id, cls.from_bytes(data))
+                cls._high_water = max(cls._high_water, post_id)
+            cls._loaded = True
+            cls._refreshed_at = time.monotonic()
+
+    @classmethod
+    def add_post(cls, post_id: int, vector: np.ndarray):
+        """Добавляет или обновляет вектор основного поста текущего воркера."""
+        with cls._lock:
+            cls._append_locked(post_id, np.asarray(vector, dtype=np.float32))
+
+    @classmethod
+    def remove_post(cls, post_id: int):
+        """Исключает пост из поиска (строка обнуляется и больше не находится)."""
+        with cls._lock:
+            row = cls._rows.pop(post_id, None)
+            if row is not None:
+                cls._matrix[row] = 0.0
+                cls._post_ids[row] = 0
+
+    @classmethod
+    def get_vectors(cls, post_ids: List[int]) -> np.ndarray:
+        """Возвращает матрицу векторов для постов, которые есть в индексе."""
+        with cls._lock:
+            rows = [cls._rows[post_id] for post_id in post_ids if post_id in cls._rows]
+            if not rows:
+                return np.zeros((0, 0), dtype=np.float32)
+            return cls._matrix[rows].copy()
+
+    @classmethod
+    def search(cls, query: np.ndarray, exclude, limit: int) -> List[tuple]:
+        """
+        Ищет посты, ближайшие к вектору запроса по косинусной близости (полный перебор).
+
+        Args:
+            query (np.ndarray): Нормированный вектор запроса
+            exclude: Множество (поддерживающее `in`) ID постов, которые нужно пропустить
+            limit (int): Максимальное количество результатов
+
+        Returns:
+            List[tuple]: Пары (post_id, similarity) по убыванию близости
+        """
+        with cls._lock:
+            if cls._matrix is None or cls._size == 0:
+                return []
+            scores = cls._matrix[:cls._size] @ query
+            post_ids = cls._post_ids[:cls._size].copy()
+
+        results = []
+        # Берем с запасом, чтобы после отсева исключенных осталось limit постов
+        take = min(len(scores), limit * 2 + 16)
+        while True:
+            top = np.argpartition(-scores, take - 1)[:take] if take < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            results = [
+                (int(post_ids[row]), float(scores[row]))
+                for row in top
+                if post_ids[row] > 0 and int(post_ids[row]) not in exclude
+            ]
+            if len(results) >= limit or take >= len(scores):
+                return results[:limit]
+            take = min(len(scores), take * 4)
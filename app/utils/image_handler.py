@@ -1,33 +1,89 @@
 import os
 import uuid
 import hashlib
-import shutil
-from datetime import datetime
-from typing import Optional, Tuple
+import posixpath
+from typing import Dict, List, Optional, Tuple
 from fastapi import UploadFile
+from PIL import Image, ImageOps
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from app.db.database import SessionLocal
+from app.models.models import MediaFile
+from app.utils.image_sniffer import FORMAT_EXTENSIONS, sniff_image
+from app.utils.media_storage import TRANSCODE_EXTENSIONS, create_storage, is_content_addressed
 import logging
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+class _FileTooLarge(Exception):
+    pass
+
+
+def _parse_dimensions(value: str) -> Tuple[int, int]:
+    """Размеры вида '4096x4096' -> (4096, 4096)."""
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
 class ImageHandler:
     """
     Класс для обработки и сохранения загруженных изображений.
-    Файлы сохраняются с зашифрованным именем для безопасности.
+
+    Хранилище адресуется содержимым: имя файла - SHA-256 его байтов, поэтому
+    одинаковые загрузки хранятся на диске один раз. Количество ссылок на файл
+    из постов и пользователей ведется в media_file_table; файл удаляется, когда
+    уходит последняя ссылка.
+
+    Файлы раскладываются по подкаталогам из первых символов хеша
+    (images/ab/cd/abcd....jpg), чтобы в одном каталоге не скапливались
+    миллионы файлов. Варианты и перекодированные копии лежат рядом с оригиналом.
+
+    Сами файлы хранятся в STORAGE (локальный каталог или S3, см. MEDIA_STORAGE);
+    ключ файла в хранилище - ссылка без префикса /uploads/.
     """
     
     UPLOAD_DIR = "uploads"
+    STORAGE = create_storage(UPLOAD_DIR)
     ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
+    CHUNK_SIZE = 64 * 1024
+    # Наибольшие ширина и высота изображения по поддиректориям uploads: сжатый файл
+    # небольшого размера может разворачиваться в гигапиксели при обработке
+    MAX_DIMENSIONS = {
+        "images": _parse_dimensions(os.getenv("IMAGE_MAX_DIMENSIONS_IMAGES", "8192x8192")),
+        "avatars": _parse_dimensions(os.getenv("IMAGE_MAX_DIMENSIONS_AVATARS", "4096x4096")),
+    }
+    DEFAULT_MAX_DIMENSIONS = (8192, 8192)
+    # Сколько байт начала файла можно прочитать в поисках заголовка с размерами
+    # (в JPEG перед ним бывают EXIF, ICC-профиль и миниатюры)
+    MAX_HEADER_SIZE = 1024 * 1024
+    # Хранить оригинал с метаданными (EXIF, XMP) как есть; иначе метаданные удаляются при загрузке
+    KEEP_ORIGINAL = os.getenv("IMAGE_KEEP_ORIGINAL", "false").lower() in ("1", "true", "yes")
     
     @classmethod
-    def save_image(cls, file: UploadFile, prefix: str = "", directory: str = "images") -> Tuple[bool, Optional[str], Optional[str]]:
+    async def save_image(cls, file: UploadFile, directory: str = "images") -> Tuple[bool, Optional[str], Optional[str]]:
         """
-        Сохраняет загруженное изображение в папку с зашифрованным именем.
+        Сохраняет загруженное изображение под именем, равным хешу его содержимого.
+        
+        Файл читается и записывается частями по CHUNK_SIZE: чтение загрузки и запись
+        на диск выполняются в пуле потоков, поэтому большие файлы не блокируют цикл
+        событий. Хеш считается по ходу записи, а загрузка отклоняется, как только
+        превышен MAX_FILE_SIZE.
+        
+        До записи на диск формат определяется по сигнатуре, а размеры в пикселях -
+        по заголовку изображения (без декодирования); файл сохраняется с расширением
+        своего настоящего формата. Изображения больше MAX_DIMENSIONS для директории
+        отклоняются.
+        
+        Если не задан KEEP_ORIGINAL, EXIF и прочие метаданные удаляются до публикации,
+        и хеш считается по очищенному файлу: опубликованный файл больше не меняется.
+        
+        Если такой файл уже есть, загрузка только увеличивает счетчик ссылок на него.
+        Каждый успешный вызов должен быть уравновешен вызовом delete_image.
         
         Args:
             file (UploadFile): Загруженный файл
-            prefix (str): Префикс для названия файла (например, 'post_', 'user_')
             directory (str): Поддиректория для сохранения файла (например, 'images', 'avatars')
             
         Returns:
@@ -36,15 +92,11 @@ class ImageHandler:
                 - Путь к файлу для хранения в БД (относительный)
                 - Сообщение об ошибке в случае неудачи
         """
+        too_large = f"Файл слишком большой. Максимальный размер: {cls.MAX_FILE_SIZE / (1024 * 1024)}MB"
         try:
-            # Проверяем размер файла
-            file_size = 0
-            file.file.seek(0, 2)  # Перемещаемся в конец файла
-            file_size = file.file.tell()  # Получаем размер
-            file.file.seek(0)  # Возвращаемся в начало
-            
-            if file_size > cls.MAX_FILE_SIZE:
-                return False, None, f"Файл слишком большой. Максимальный размер: {cls.MAX_FILE_SIZE / (1024 * 1024)}MB"
+            # Если размер известен заранее, отклоняем файл без копирования
+            if getattr(file, "size", None) is not None and file.size > cls.MAX_FILE_SIZE:
+                return False, None, too_large
             
             # Получаем расширение файла и проверяем его
             _, ext = os.path.splitext(file.filename)
@@ -53,50 +105,189 @@ class ImageHandler:
             if ext not in cls.ALLOWED_EXTENSIONS:
                 return False, None, f"Недопустимое расширение файла. Разрешены: {', '.join(cls.ALLOWED_EXTENSIONS)}"
             
-            # Генерируем уникальное зашифрованное имя файла
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            unique_id = str(uuid.uuid4())
-            
-            # Создаем хеш на основе имени файла, времени и уникального ID
-            hash_input = f"{file.filename}{timestamp}{unique_id}".encode('utf-8')
-            hashed_name = hashlib.sha256(hash_input).hexdigest()[:16]  # Берем первые 16 символов хеша
-            
-            # Формируем окончательное имя файла
-            filename = f"{prefix}{timestamp}_{hashed_name}{ext}"
+            # Читаем начало файла в память, пока не разберем заголовок изображения
+            head = b""
+            while True:
+                chunk = await file.read(cls.CHUNK_SIZE)
+                head += chunk
+                if len(head) > cls.MAX_FILE_SIZE:
+                    return False, None, too_large
+                try:
+                    sniffed = sniff_image(head)
+                except ValueError as e:
+                    return False, None, str(e)
+                if sniffed is not None:
+                    break
+                if not chunk or len(head) > cls.MAX_HEADER_SIZE:
+                    return False, None, "Не удалось прочитать заголовок изображения"
             
-            # Формируем путь к директории
-            upload_dir = os.path.join(cls.UPLOAD_DIR, directory)
+            image_format, width, height = sniffed
+            max_width, max_height = cls.MAX_DIMENSIONS.get(directory, cls.DEFAULT_MAX_DIMENSIONS)
+            if width > max_width or height > max_height:
+                return False, None, (
+                    f"Изображение слишком большое: {width}x{height}. "
+                    f"Максимальный размер: {max_width}x{max_height}"
+                )
+            ext = FORMAT_EXTENSIONS[image_format]
             
-            # Убедимся, что директория существует
-            os.makedirs(upload_dir, exist_ok=True)
+            # Копируем файл частями во временный файл рядом с хранилищем, считая
+            # хеш и проверяя размер по ходу копирования
+            partial_path = await run_in_threadpool(cls.STORAGE.temp_path, directory)
+            digest = hashlib.sha256()
+            written = 0
+            try:
+                buffer = await run_in_threadpool(open, partial_path, "wb")
+                try:
+                    chunk = head
+                    while chunk:
+                        written += len(chunk)
+                        if written > cls.MAX_FILE_SIZE:
+                            raise _FileTooLarge()
+                        digest.update(chunk)
+                        await run_in_threadpool(buffer.write, chunk)
+                        chunk = await file.read(cls.CHUNK_SIZE)
+                finally:
+                    await run_in_threadpool(buffer.close)
+                
+                content_hash = digest.hexdigest()
+                if not cls.KEEP_ORIGINAL and await run_in_threadpool(strip_metadata, partial_path, image_format):
+                    content_hash, written = await run_in_threadpool(_file_digest, partial_path)
+                
+                filename = f"{content_hash}{ext}"
+                key = f"{directory}/{cls.shard_dir(filename)}/{filename}"
+                relative_path = f"/uploads/{key}"
+                await run_in_threadpool(cls._publish, partial_path, key, relative_path, written)
+            except _FileTooLarge:
+                os.remove(partial_path)
+                return False, None, too_large
+            except Exception:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
             
-            # Полный путь для сохранения файла
-            file_path = os.path.join(upload_dir, filename)
-            
-            # Сохраняем файл
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            # Формируем относительный путь для сохранения в БД
-            relative_path = f"/uploads/{directory}/{filename}"
-            
-            logger.info(f"Изображение сохранено: {file_path}")
             return True, relative_path, None
             
         except Exception as e:
             logger.error(f"Ошибка при сохранении изображения: {str(e)}")
             return False, None, f"Ошибка при сохранении изображения: {str(e)}"
     
+    @classmethod
+    def _publish(cls, partial_path: str, key: str, relative_path: str, size: int):
+        """Учитывает ссылку на файл и публикует временный файл в хранилище, если такого файла еще нет."""
+        # Сначала фиксируем ссылку, затем публикуем: удаление последней ссылки
+        # держит блокировку строки, пока удаляет файл. Уже сохраненному файлу
+        # хранилище обновляет время изменения, чтобы его не удалил сборщик мусора
+        cls._acquire(relative_path, size)
+        try:
+            published = cls.STORAGE.publish(partial_path, key)
+        except Exception:
+            # Файл не опубликован - снимаем взятую ссылку, иначе строка без файла
+            # останется в media_file_table навсегда
+            cls.delete_image(relative_path)
+            raise
+        if published:
+            logger.info(f"Изображение сохранено: {key}")
+        else:
+            logger.info(f"Изображение уже есть в хранилище: {key}")
+    
+    @staticmethod
+    def _acquire(link: str, size: Optional[int] = None):
+        """Увеличивает счетчик ссылок на файл, создавая запись при первой ссылке."""
+        db = SessionLocal()
+        try:
+            for _ in range(2):
+                updated = db.query(MediaFile).filter(MediaFile.link == link).update(
+                    {MediaFile.ref_count: MediaFile.ref_count + 1}, synchronize_session=False
+                )
+                if not updated:
+                    db.add(MediaFile(link=link, size=size, ref_count=1))
+                try:
+                    db.commit()
+                    return
+                except IntegrityError:
+                    # Запись одновременно создал другой запрос - повторяем увеличение
+                    db.rollback()
+            raise RuntimeError(f"Не удалось учесть ссылку на файл {link}")
+        finally:
+            db.close()
+    
+    @classmethod
+    def retain(cls, file_path: str) -> bool:
+        """
+        Учитывает еще одну ссылку на уже сохраненный файл (например, если клиент
+        передал в media_link путь к загруженному ранее изображению).
+        
+        Returns:
+            bool: True, если файл есть в хранилище
+        """
+        if not file_path or not file_path.startswith("/uploads/"):
+            return False
+        db = SessionLocal()
+        try:
+            updated = db.query(MediaFile).filter(MediaFile.link == file_path).update(
+                {MediaFile.ref_count: MediaFile.ref_count + 1}, synchronize_session=False
+            )
+            db.commit()
+            if updated:
+                # Как и при повторной загрузке: сборщик мусора не трогает недавно измененные файлы
+                cls.STORAGE.touch(cls.storage_key(file_path))
+            return bool(updated)
+        finally:
+            db.close()
+    
+    @staticmethod
+    def shard_dir(filename: str) -> str:
+        """
+        Подкаталог файла вида 'ab/cd'.
+        
+        Для файлов, названных хешем содержимого, берутся первые символы имени; для
+        файлов со старыми именами - первые символы SHA-256 от имени.
+        """
+        stem = os.path.splitext(filename)[0]
+        key = stem if is_content_addressed(filename) else hashlib.sha256(filename.encode("utf-8")).hexdigest()
+        return f"{key[:2]}/{key[2:4]}"
+    
+    @staticmethod
+    def storage_key(link: str) -> str:
+        """
+        Ключ файла в хранилище для ссылки вида /uploads/....
+        
+        Raises:
+            ValueError: Если ссылка указывает за пределы uploads
+        """
+        key = posixpath.normpath(link[len("/uploads/"):])
+        if not link.startswith("/uploads/") or key in (".", "..") or key.startswith(("../", "/")):
+            raise ValueError(f"Путь вне директории uploads: {link}")
+        return key
+    
+    @classmethod
+    def local_path(cls, link: str) -> str:
+        """Путь файла в локальном каталоге хранилища (для S3 - в кэше на чтение)."""
+        return cls.STORAGE.path(cls.storage_key(link))
+    
+    @classmethod
+    def link_for(cls, path: str) -> str:
+        """Ссылка вида /uploads/... для файла в локальном каталоге хранилища."""
+        return "/uploads/" + cls.STORAGE.key(path)
+    
+    @staticmethod
+    def variant_path(path: str, width) -> str:
+        """Путь уменьшенного варианта изображения: <имя>_w<ширина><расширение>."""
+        stem, ext = os.path.splitext(path)
+        return f"{stem}_w{width}{ext}"
+    
     @classmethod
     def delete_image(cls, file_path: str) -> bool:
         """
-        Удаляет изображение по указанному пути.
+        Снимает одну ссылку на изображение; файл и его уменьшенные варианты
+        удаляются, когда уходит последняя ссылка. Файлы, не учтенные в
+        media_file_table, не удаляются.
         
         Args:
             file_path (str): Путь к файлу (относительный, начинающийся с '/uploads/')
             
         Returns:
-            bool: True если удаление успешно, False в противном случае
+            bool: True если ссылка снята успешно, False в противном случае
         """
         try:
             # Проверяем, начинается ли путь с /uploads/
@@ -104,23 +295,164 @@ class ImageHandler:
                 logger.error(f"Попытка удалить файл вне директории uploads: {file_path}")
                 return False
             
-            # Получаем имя файла и директорию
-            directory = file_path.split("/")[2]  # Получаем 'images' или 'avatars'
-            filename = os.path.basename(file_path)
+            key = cls.storage_key(file_path)
             
-            # Полный путь к файлу
-            full_path = os.path.join(cls.UPLOAD_DIR, directory, filename)
-            
-            # Проверяем существование файла
-            if not os.path.exists(full_path):
-                logger.warning(f"Файл не найден: {full_path}")
+            db = SessionLocal()
+            try:
+                media = db.query(MediaFile).filter(MediaFile.link == file_path).with_for_update().first()
+                if media is None:
+                    # Файлы, не учтенные в media_file_table (варианты, перекодированные
+                    # копии, чужие пути), по ссылке из поста не удаляются
+                    logger.warning(f"Файл не учтен в media_file_table, не удаляем: {file_path}")
+                    return False
+                if media.ref_count > 1:
+                    media.ref_count -= 1
+                    db.commit()
+                    return True
+                db.delete(media)
+                
+                # Последняя ссылка: удаляем файл, его уменьшенные варианты
+                # и перекодированные копии, пока строка заблокирована
+                removed = cls.STORAGE.delete_with_derived(key)
+                db.commit()
+            finally:
+                db.close()
+            if not removed:
+                logger.warning(f"Файл не найден: {key}")
                 return False
-            
-            # Удаляем файл
-            os.remove(full_path)
-            logger.info(f"Изображение удалено: {full_path}")
+            logger.info(f"Изображение удалено: {key}")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка при удалении изображения: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
+
+
+# Параметры сохранения вариантов по формату исходного изображения
+_VARIANT_SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+    "WEBP": {"quality": 80},
+}
+
+def transcoded_path(path: str, image_format: str) -> str:
+    """Путь перекодированной копии файла: <имя файла>.<формат>, например a.jpg.webp."""
+    return f"{path}{TRANSCODE_EXTENSIONS[image_format]}"
+
+
+def _has_metadata(image: Image.Image) -> bool:
+    return bool(image.getexif()) or any(key in image.info for key in ("xmp", "XML:com.adobe.xmp", "comment"))
+
+
+def _file_digest(path: str) -> Tuple[str, int]:
+    """SHA-256 и размер файла."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ImageHandler.CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def strip_metadata(path: str, image_format: str) -> bool:
+    """
+    Пересохраняет изображение без EXIF и прочих метаданных (цветовой профиль
+    остается), применив ориентацию из EXIF. Анимированные изображения не трогаются.
+
+    Returns:
+        bool: True, если файл был пересохранен
+    """
+    with Image.open(path) as original:
+        if getattr(original, "is_animated", False) or not _has_metadata(original):
+            return False
+        icc_profile = original.info.get("icc_profile")
+        image = ImageOps.exif_transpose(original)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    save_options = dict(_VARIANT_SAVE_OPTIONS.get(image_format, {}))
+    if icc_profile:
+        save_options["icc_profile"] = icc_profile
+    _save_atomic(image, path, image_format, **save_options)
+    return True
+
+
+def _save_atomic(image: Image.Image, path: str, image_format: str, **options):
+    # Временное имя уникально: один и тот же файл могут обрабатывать два процесса
+    partial_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        image.save(partial_path, format=image_format, **options)
+        os.replace(partial_path, path)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+def generate_image_variants(
+    path: str,
+    widths: List[int],
+    square: bool = False,
+    transcode_formats: List[str] = (),
+    transcode_quality: int = 80,
+) -> Dict[int, str]:
+    """
+    Создает уменьшенные и перекодированные варианты изображения рядом с оригиналом.
+
+    Функция выполняется в отдельном процессе, поэтому зависит только от Pillow.
+    Изображения не увеличиваются; анимированные изображения пропускаются.
+    Варианты сохраняются без EXIF и прочих метаданных (цветовой профиль остается).
+    Уже созданные файлы не пересоздаются: тот же файл мог быть загружен раньше.
+
+    Args:
+        path (str): Путь к оригиналу на диске
+        widths (List[int]): Ширины вариантов в пикселях
+        square (bool): Обрезать до квадрата (для аватаров)
+        transcode_formats (List[str]): Форматы Pillow ('WEBP', 'AVIF'), в которые
+            дополнительно перекодируются оригинал и каждый вариант
+        transcode_quality (int): Качество перекодирования
+
+    Returns:
+        Dict[int, str]: {ширина: путь к варианту на диске}
+    """
+    variants = {}
+    with Image.open(path) as original:
+        if getattr(original, "is_animated", False):
+            return variants
+        image_format = original.format
+        icc_profile = original.info.get("icc_profile")
+        image = ImageOps.exif_transpose(original)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+    save_options = dict(_VARIANT_SAVE_OPTIONS.get(image_format, {}))
+    transcode_options = {"quality": transcode_quality}
+    if icc_profile:
+        save_options["icc_profile"] = icc_profile
+        transcode_options["icc_profile"] = icc_profile
+    formats = [transcode_format for transcode_format in transcode_formats if transcode_format != image_format]
+
+    def save_transcoded(picture: Image.Image, picture_path: str):
+        for transcode_format in formats:
+            copy_path = transcoded_path(picture_path, transcode_format)
+            if not os.path.exists(copy_path):
+                _save_atomic(picture, copy_path, transcode_format, **transcode_options)
+
+    save_transcoded(image, path)
+
+    for width in sorted(set(widths)):
+        if square:
+            if min(image.size) < width:
+                continue
+            variant = ImageOps.fit(image, (width, width), Image.LANCZOS)
+        else:
+            if image.width <= width:
+                continue
+            variant = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+        variant_path = ImageHandler.variant_path(path, width)
+        if not os.path.exists(variant_path):
+            _save_atomic(variant, variant_path, image_format, **save_options)
+        save_transcoded(variant, variant_path)
+        variants[width] = variant_path
+    return variants
@@ -0,0 +1,118 @@
+from typing import Optional, Tuple
+
+# Расширение, под которым сохраняется файл каждого распознанного формата
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+
+# Маркеры начала кадра JPEG (SOF0-SOF15 без DHT, JPG и DAC), в которых записаны размеры
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Маркеры без поля длины
+_JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+
+def _invalid(image_format: str) -> ValueError:
+    return ValueError(f"Поврежденный заголовок изображения {image_format}")
+
+
+def _sniff_jpeg(data: bytes) -> Optional[Tuple[int, int]]:
+    position = 2
+    while True:
+        if position >= len(data):
+            return None
+        if data[position] != 0xFF:
+            raise _invalid("JPEG")
+        # Перед маркером может быть любое число байтов-заполнителей 0xFF
+        while position < len(data) and data[position] == 0xFF:
+            position += 1
+        if position >= len(data):
+            return None
+        marker = data[position]
+        position += 1
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            # Конец файла или начало данных скана раньше заголовка кадра
+            raise _invalid("JPEG")
+        if position + 2 > len(data):
+            return None
+        length = int.from_bytes(data[position:position + 2], "big")
+        if length < 2:
+            raise _invalid("JPEG")
+        if marker in _JPEG_SOF_MARKERS:
+            if position + 7 > len(data):
+                return None
+            height = int.from_bytes(data[position + 3:position + 5], "big")
+            width = int.from_bytes(data[position + 5:position + 7], "big")
+            return width, height
+        position += length
+
+
+def _sniff_png(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 24:
+        return None
+    if data[12:16] != b"IHDR":
+        raise _invalid("PNG")
+    return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+
+
+def _sniff_gif(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 10:
+        return None
+    return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+
+
+def _sniff_webp(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+        # Кадр VP8 с потерями: 14-битные ширина и высота после стартового кода
+        return int.from_bytes(data[26:28], "little") & 0x3FFF, int.from_bytes(data[28:30], "little") & 0x3FFF
+    if chunk == b"VP8L" and data[20] == 0x2F:
+        # Без потерь: ширина-1 и высота-1 упакованы по 14 бит
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        # Расширенный формат (анимация, альфа-канал): 24-битные размеры холста
+        return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    raise _invalid("WEBP")
+
+
+def sniff_image(data: bytes) -> Optional[Tuple[str, int, int]]:
+    """
+    Определяет формат изображения по сигнатуре и читает его размеры из заголовка,
+    не декодируя пиксели.
+
+    Args:
+        data (bytes): Начало файла
+
+    Returns:
+        Optional[Tuple[str, int, int]]: (формат, ширина, высота) или None, если
+            для разбора заголовка нужно больше данных
+
+    Raises:
+        ValueError: Если данные не похожи на изображение поддерживаемого формата
+            или его заголовок поврежден
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        image_format, size = "JPEG", _sniff_jpeg(data)
+    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
+        image_format, size = "PNG", _sniff_png(data)
+    elif data.startswith((b"GIF87a", b"GIF89a")):
+        image_format, size = "GIF", _sniff_gif(data)
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        image_format, size = "WEBP", _sniff_webp(data)
+    elif len(data) < 12 and (
+        data.startswith(b"RIFF")
+        or any(signature.startswith(data) for signature in (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"RIFF"))
+    ):
+        # Сигнатура еще не прочитана целиком
+        return None
+    else:
+        raise ValueError("Файл не является изображением поддерживаемого формата")
+
+    if size is None:
+        return None
+    width, height = size
+    if not width or not height:
+        raise _invalid(image_format)
+    return image_format, width, height
@@ -0,0 +1,165 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List
+from PIL import features
+from app.db.database import SessionLocal
+from app.models.models import Post, User
+from app.utils.image_handler import ImageHandler, TRANSCODE_EXTENSIONS, generate_image_variants
+from app.utils.media_storage import original_name
+from app.utils.profile_cache import UserProfileCache
+
+logger = logging.getLogger("app")
+
+
+def _parse_widths(value: str) -> List[int]:
+    return [int(width) for width in value.split(",") if width.strip()]
+
+
+def _parse_formats(value: str) -> List[str]:
+    formats = []
+    for name in (name.strip().upper() for name in value.split(",")):
+        if not name:
+            continue
+        if name not in TRANSCODE_EXTENSIONS or not features.check(name.lower()):
+            logger.warning(f"Формат {name} не поддерживается, перекодирование в него отключено")
+            continue
+        formats.append(name)
+    return formats
+
+
+def _process_image(link: str, widths: List[int], square: bool, transcode_formats: List[str],
+                   transcode_quality: int) -> Dict[int, str]:
+    """
+    Выполняется в процессе пула: получает оригинал из хранилища в локальный
+    каталог, создает варианты и сохраняет в хранилище все новые файлы рядом
+    с оригиналом.
+
+    Returns:
+        Dict[int, str]: {ширина: ссылка на вариант}
+    """
+    storage = ImageHandler.STORAGE
+    path = storage.fetch(ImageHandler.storage_key(link))
+    if path is None:
+        return {}
+    directory, name = os.path.split(path)
+
+    def siblings() -> Dict[str, int]:
+        return {
+            entry.name: entry.stat().st_mtime_ns
+            for entry in os.scandir(directory)
+            if not entry.name.endswith(".part") and original_name(entry.name) == name
+        }
+
+    before = siblings()
+    variants = generate_image_variants(path, widths, square, transcode_formats, transcode_quality)
+    for filename, mtime in siblings().items():
+        if before.get(filename) != mtime:
+            file_path = os.path.join(directory, filename)
+            storage.put(storage.key(file_path), file_path)
+    return {width: ImageHandler.link_for(variant_path) for width, variant_path in variants.items()}
+
+
+class ImageVariants:
+    """
+    Фоновая генерация уменьшенных вариантов загруженных изображений.
+
+    Варианты создаются Pillow в пуле процессов (не блокируя воркер приложения),
+    после чего их ссылки записываются рядом с оригиналом: в post_table.media_variants
+    или user_table.image_variants в виде {"ширина": "/uploads/..."}.
+    Пока варианты не готовы, клиенты используют оригинал.
+
+    Там же оригинал и варианты перекодируются в TRANSCODE_FORMATS (копии рядом
+    с файлом: a.jpg.webp), которые /uploads отдает клиентам, принимающим формат.
+    """
+
+    # Ширины вариантов по поддиректориям uploads (пустая строка отключает варианты)
+    WIDTHS = {
+        "images": _parse_widths(os.getenv("IMAGE_VARIANTS_IMAGES", "320,1080")),
+        "avatars": _parse_widths(os.getenv("IMAGE_VARIANTS_AVATARS", "64")),
+    }
+    # Варианты аватаров обрезаются до квадрата
+    SQUARE_DIRECTORIES = {"avatars"}
+    WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
+    # Форматы перекодирования в порядке предпочтения (пустая строка отключает перекодирование)
+    TRANSCODE_FORMATS = _parse_formats(os.getenv("IMAGE_TRANSCODE_FORMATS", "webp"))
+    TRANSCODE_QUALITY = int(os.getenv("IMAGE_TRANSCODE_QUALITY", "80"))
+
+    _lock = threading.Lock()
+    _executor = None
+
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        with cls._lock:
+            if cls._executor is None:
+                # spawn: дочерние процессы не наследуют соединения с БД и потоки воркера
+                cls._executor = ProcessPoolExecutor(
+                    max_workers=cls.WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+            return cls._executor
+
+    @classmethod
+    def _schedule(cls, link: str, record: Callable[[Dict[str, str]], None]):
+        if not link or not link.startswith("/uploads/"):
+            return
+        directory = link.split("/")[2]
+        widths = cls.WIDTHS.get(directory)
+        if directory not in cls.WIDTHS or not (widths or cls.TRANSCODE_FORMATS):
+            return
+
+        future = cls._get_executor().submit(
+            _process_image, link, widths, directory in cls.SQUARE_DIRECTORIES,
+            cls.TRANSCODE_FORMATS, cls.TRANSCODE_QUALITY,
+        )
+
+        def on_done(done):
+            try:
+                variants = {str(width): variant_link for width, variant_link in done.result().items()}
+                if variants:
+                    record(variants)
+            except Exception as e:
+                logger.error(f"Ошибка при создании вариантов изображения {link}: {str(e)}")
+
+        future.add_done_callback(on_done)
+
+    @classmethod
+    def schedule_post(cls, post_id: int, media_link: str):
+        """Ставит в очередь создание вариантов изображения поста."""
+        def record(variants):
+            db = SessionLocal()
+            try:
+                # Условие по media_link защищает от записи вариантов уже замененного изображения
+                db.query(Post).filter(Post.post_id == post_id, Post.media_link == media_link).update(
+                    {Post.media_variants: variants}, synchronize_session=False
+                )
+                db.commit()
+            finally:
+                db.close()
+
+        cls._schedule(media_link, record)
+
+    @classmethod
+    def schedule_avatar(cls, user_id: int, image_link: str):
+        """Ставит в очередь создание вариантов аватара пользователя."""
+        def record(variants):
+            db = SessionLocal()
+            try:
+                db.query(User).filter(User.user_id == user_id, User.image_link == image_link).update(
+                    {User.image_variants: variants}, synchronize_session=False
+                )
+                db.commit()
+            finally:
+                db.close()
+            UserProfileCache.invalidate(user_id)
+
+        cls._schedule(image_link, record)
+
+    @classmethod
+    def shutdown(cls):
+        """Дожидается завершения поставленных задач и останавливает пул процессов."""
+        with cls._lock:
+            executor, cls._executor = cls._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
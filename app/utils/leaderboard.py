@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sortedcontainers import SortedList
+from sqlalchemy.orm import Session
+from app.models.models import User
+
+logger = logging.getLogger("app")
+
+
+class RatingLeaderboard:
+    """
+    Рейтинг пользователей в памяти воркера.
+
+    Пользователи хранятся в отсортированном списке ключей (-rating, user_id),
+    поэтому страница топа читается срезом, а место пользователя находится
+    бинарным поиском за O(log n). Пользователи с одинаковым рейтингом делят
+    одно место («1, 2, 2, 4»).
+
+    Список загружается из БД целиком один раз при первом обращении, обновляется
+    при изменении рейтинга в текущем воркере, а изменения других воркеров
+    догружаются раз в REFRESH_INTERVAL по индексу user_table.rating_updated_at.
+    Удаленные в других воркерах пользователи убираются, когда их не находит
+    построение страницы рейтинга (см. remove).
+    """
+
+    # Как часто догружать изменения рейтинга из БД (секунды)
+    REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", "60"))
+    # Запас при догрузке: транзакция могла зафиксироваться позже, чем выставила время изменения
+    REFRESH_OVERLAP = timedelta(seconds=60)
+
+    _lock = threading.Lock()
+    _entries = SortedList()
+    _ratings: Dict[int, float] = {}
+    _loaded_at: Optional[float] = None
+    _updated_since: Optional[datetime] = None
+
+    @classmethod
+    def load(cls, db: Session):
+        """Загружает рейтинги всех пользователей из БД."""
+        rows = db.query(User.user_id, User.rating, User.rating_updated_at).all()
+        entries = SortedList((-rating, user_id) for user_id, rating, _ in rows)
+        with cls._lock:
+            cls._entries = entries
+            cls._ratings = {user_id: rating for user_id, rating, _ in rows}
+            cls._updated_since = max((updated_at for _, _, updated_at in rows), default=None)
+            cls._loaded_at = time.monotonic()
+
+    @classmethod
+    def refresh(cls, db: Session):
+        """Догружает пользователей, чей рейтинг изменился после прошлой загрузки."""
+        query = db.query(User.user_id, User.rating, User.rating_updated_at)
+        if cls._updated_since is not None:
+            query = query.filter(User.rating_updated_at > cls._updated_since - cls.REFRESH_OVERLAP)
+        rows = query.all()
+        for user_id, rating, _ in rows:
+            cls.update(user_id, rating)
+        with cls._lock:
+            cls._updated_since = max(
+                [updated_at for _, _, updated_at in rows] + ([cls._updated_since] if cls._updated_since else []),
+                default=None
+            )
+            cls._loaded_at = time.monotonic()
+
+    @classmethod
+    def ensure_fresh(cls, db: Session):
+        if cls._loaded_at is None:
+            cls.load(db)
+        elif time.monotonic() - cls._loaded_at >= cls.REFRESH_INTERVAL:
+            cls.refresh(db)
+
+    @classmethod
+    def update(cls, user_id: int, rating: float):
+        """Учитывает новый рейтинг пользователя (вызывается после коммита изменения)."""
+        with cls._lock:
+            if cls._loaded_at is None:
+                return
+            previous = cls._ratings.get(user_id)
+            if previous == rating:
+                return
+            if previous is not None:
+                cls._entries.discard((-previous, user_id))
+            cls._entries.add((-rating, user_id))
+            cls._ratings[user_id] = rating
+
+    @classmethod
+    def remove(cls, user_id: int):
+        """Убирает удаленного пользователя из рейтинга."""
+        with cls._lock:
+            previous = cls._ratings.pop(user_id, None)
+            if previous is not None:
+                cls._entries.discard((-previous, user_id))
+
+    @classmethod
+    def _rank_locked(cls, rating: float) -> int:
+        # Место = количество пользователей с рейтингом строго выше + 1
+        return cls._entries.bisect_left((-rating, 0)) + 1
+
+    @classmethod
+    def top(cls, skip: int = 0, limit: int = 10) -> List[Tuple[int, int, float]]:
+        """
+        Возвращает страницу рейтинга.
+
+        Returns:
+            List[Tuple[int, int, float]]: Тройки (место, user_id, рейтинг)
+        """
+        with cls._lock:
+            return [
+                (cls._rank_locked(-negative_rating), user_id, -negative_rating)
+                for negative_rating, user_id in cls._entries[skip:skip + limit]
+            ]
+
+    @classmethod
+    def rank(cls, user_id: int) -> Optional[Tuple[int, float, int]]:
+        """
+        Возвращает место пользователя в рейтинге.
+
+        Returns:
+            Optional[Tuple[int, float, int]]: (место, рейтинг, всего пользователей) или None
+        """
+        with cls._lock:
+            rating = cls._ratings.get(user_id)
+            if rating is None:
+                return None
+            return cls._rank_locked(rating), rating, len(cls._entries)
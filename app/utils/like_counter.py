@@ -0,0 +1,179 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Tuple
+from sqlalchemy import event, bindparam, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.db.database import SessionLocal
+from app.models.models import Post, User
+
+logger = logging.getLogger("app")
+
+
+class LikeCounter:
+    """
+    Слой счетчиков лайков поверх денормализованных post_table.likes_count
+    и user_table.received_likes_count (лайки, полученные постами автора).
+
+    Для обычных постов счетчик обновляется в той же транзакции, что и лайк.
+    Для «горячих» постов (частота лайков выше порога) изменения копятся
+    в памяти воркера и периодически сбрасываются в БД одним пакетным UPDATE,
+    поэтому конкуренция за строку поста не растет вместе с частотой лайков.
+    При чтении сохраненное значение объединяется с еще не сброшенной дельтой.
+    """
+
+    # Порог частоты лайков (лайков в секунду), после которого пост считается горячим
+    HOT_RATE_THRESHOLD = float(os.getenv("HOT_LIKE_RATE_THRESHOLD", "2"))
+    # Интервал сброса накопленных дельт в БД (секунды)
+    FLUSH_INTERVAL = float(os.getenv("LIKE_COUNTER_FLUSH_INTERVAL", "2"))
+    # Постоянная времени экспоненциально затухающей оценки частоты (секунды)
+    RATE_WINDOW = 10.0
+
+    _lock = threading.Lock()
+    # post_id -> накопленная, но еще не сброшенная в БД дельта
+    _pending: Dict[int, int] = {}
+    # post_id -> (оценка числа лайков за RATE_WINDOW, время последнего лайка)
+    _rates: Dict[int, Tuple[float, float]] = {}
+    _flush_task = None
+
+    @classmethod
+    def _register_hit(cls, post_id: int) -> bool:
+        """Учитывает лайк в оценке частоты и возвращает True, если пост горячий."""
+        now = time.monotonic()
+        with cls._lock:
+            rate, last_seen = cls._rates.get(post_id, (0.0, now))
+            rate = rate * math.exp(-(now - last_seen) / cls.RATE_WINDOW) + 1.0
+            cls._rates[post_id] = (rate, now)
+        return rate / cls.RATE_WINDOW >= cls.HOT_RATE_THRESHOLD
+
+    @classmethod
+    def add(cls, db: Session, post_id: int, delta: int):
+        """
+        Изменяет счетчик лайков поста в рамках текущей транзакции сессии.
+
+        Для холодного поста выполняется UPDATE likes_count = likes_count + delta
+        (и такой же UPDATE счетчика полученных лайков автора).
+        Для горячего поста дельта попадает в память воркера только после
+        успешного коммита сессии и сбрасывается в БД фоновой задачей.
+
+        Args:
+            db (Session): Сессия базы данных
+            post_id (int): ID поста
+            delta (int): Изменение счетчика (+1 для лайка, -1 для снятия лайка)
+        """
+        if cls._register_hit(post_id):
+            deltas = db.info.setdefault("like_counter_deltas", {})
+            deltas[post_id] = deltas.get(post_id, 0) + delta
+            return
+
+        db.query(Post).filter(Post.post_id == post_id).update(
+            {Post.likes_count: Post.likes_count + delta},
+            synchronize_session=False
+        )
+        db.query(User).filter(User.user_id == cls._author_of(post_id)).update(
+            {User.received_likes_count: User.received_likes_count + delta},
+            synchronize_session=False
+        )
+
+    @staticmethod
+    def _author_of(post_id):
+        """Подзапрос автора поста (post_id может быть значением или bindparam)."""
+        return select(Post.user_id).where(Post.post_id == post_id).scalar_subquery()
+
+    @classmethod
+    def get_count(cls, post: Post) -> int:
+        """Возвращает число лайков поста: сохраненное значение плюс несброшенная дельта."""
+        with cls._lock:
+            pending = cls._pending.get(post.post_id, 0)
+        return (post.likes_count or 0) + pending
+
+    @classmethod
+    def discard(cls, post_id: int):
+        """Забывает накопленную дельту удаленного поста."""
+        with cls._lock:
+            cls._pending.pop(post_id, None)
+            cls._rates.pop(post_id, None)
+
+    @classmethod
+    def flush(cls):
+        """Сбрасывает накопленные дельты в БД одним пакетным UPDATE."""
+        with cls._lock:
+            pending, cls._pending = cls._pending, {}
+            # Забываем посты, которые давно перестали быть горячими
+            now = time.monotonic()
+            cls._rates = {
+                post_id: (rate, last_seen)
+                for post_id, (rate, last_seen) in cls._rates.items()
+                if now - last_seen < cls.RATE_WINDOW * 5
+            }
+
+        updates = [{"b_post_id": post_id, "b_delta": delta} for post_id, delta in pending.items() if delta]
+        if not updates:
+            return
+
+        post_table = Post.__table__
+        statement = (
+            post_table.update()
+            .where(post_table.c.post_id == bindparam("b_post_id"))
+            .values(likes_count=post_table.c.likes_count + bindparam("b_delta"))
+        )
+        # Счетчик полученных лайков автора обновляется в той же транзакции
+        user_table = User.__table__
+        author_statement = (
+            user_table.update()
+            .where(user_table.c.user_id == cls._author_of(bindparam("b_post_id")))
+            .values(received_likes_count=user_table.c.received_likes_count + bindparam("b_delta"))
+        )
+        db = SessionLocal()
+        try:
+            db.execute(statement, updates)
+            db.execute(author_statement, updates)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при сбросе счетчиков лайков: {str(e)}")
+            # Возвращаем дельты, чтобы не потерять их до следующей попытки
+            with cls._lock:
+                for post_id, delta in pending.items():
+                    cls._pending[post_id] = cls._pending.get(post_id, 0) + delta
+        finally:
+            db.close()
+
+    @classmethod
+    async def _flush_loop(cls):
+        while True:
+            await asyncio.sleep(cls.FLUSH_INTERVAL)
+            await run_in_threadpool(cls.flush)
+
+    @classmethod
+    def start(cls):
+        """Запускает фоновую задачу периодического сброса счетчиков."""
+        if cls._flush_task is None:
+            cls._flush_task = asyncio.get_event_loop().create_task(cls._flush_loop())
+
+    @classmethod
+    async def stop(cls):
+        """Останавливает фоновую задачу и сбрасывает оставшиеся дельты."""
+        if cls._flush_task is not None:
+            cls._flush_task.cancel()
+            cls._flush_task = None
+        await run_in_threadpool(cls.flush)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_like_counter_deltas(session):
+    deltas = session.info.pop("like_counter_deltas", None)
+    if not deltas:
+        return
+    with LikeCounter._lock:
+        for post_id, delta in deltas.items():
+            LikeCounter._pending[post_id] = LikeCounter._pending.get(post_id, 0) + delta
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_like_counter_deltas(session):
+    session.info.pop("like_counter_deltas", None)
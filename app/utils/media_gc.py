@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from array import array
+from collections import defaultdict
+from typing import Dict, List
+import numpy as np
+from sqlalchemy.orm import Session
+from app.db.database import SessionLocal
+from app.models.models import MediaFile, Post, User
+from app.utils.image_handler import ImageHandler
+from app.utils.media_storage import original_name
+
+logger = logging.getLogger("app")
+
+
+def _link_key(link: str) -> int:
+    return int.from_bytes(hashlib.blake2b(link.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class ReferencedLinks:
+    """
+    Множество ссылок на загруженные файлы из БД в компактном виде.
+
+    Хранятся только 64-битные хеши ссылок в отсортированном массиве numpy
+    (8 байт на ссылку); поиск - бинарный. Совпадение хешей разных ссылок
+    приводит лишь к тому, что файл не будет удален.
+    """
+
+    def __init__(self, keys: np.ndarray):
+        self._keys = keys
+
+    @classmethod
+    def load(cls, db: Session, batch_size: int = 10000) -> "ReferencedLinks":
+        keys = array("Q")
+        for column in (Post.media_link, User.image_link):
+            rows = db.query(column).filter(column.like("/uploads/%")).yield_per(batch_size)
+            keys.extend(_link_key(link) for (link,) in rows)
+        return cls(np.unique(np.frombuffer(keys, dtype=np.uint64)))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, link: str) -> bool:
+        key = np.uint64(_link_key(link))
+        position = np.searchsorted(self._keys, key)
+        return bool(position < len(self._keys) and self._keys[position] == key)
+
+
+class MediaGarbageCollector:
+    """
+    Удаление файлов из uploads, на которые не ссылается ни один пост или пользователь.
+
+    Файл считается мусором, если ссылка на его оригинал (для вариантов и
+    перекодированных копий - на файл, рядом с которым они лежат) не встречается
+    в post_table.media_link и user_table.image_link, и он не менялся дольше
+    GRACE_PERIOD: так не удаляются файлы загрузок, чьи посты еще не сохранены.
+    Брошенные временные файлы (.part) старше GRACE_PERIOD тоже удаляются.
+
+    Локальное хранилище обходится параллельно по подкаталогам первого уровня,
+    S3 - постраничным списком объектов.
+    """
+
+    GRACE_PERIOD = float(os.getenv("MEDIA_GC_GRACE_PERIOD", str(24 * 3600)))
+    WORKERS = int(os.getenv("MEDIA_GC_WORKERS", "8"))
+
+    @classmethod
+    def find_garbage(cls, referenced: ReferencedLinks, grace_period: float = None, workers: int = None):
+        """
+        Обходит хранилище (локальный каталог - параллельно) и возвращает мусорные
+        файлы: (ключ, ссылка на оригинал или None для .part, размер, mtime).
+        """
+        cutoff = time.time() - (cls.GRACE_PERIOD if grace_period is None else grace_period)
+        garbage = []
+        for key, size, mtime in ImageHandler.STORAGE.iter_files(workers or cls.WORKERS):
+            if mtime > cutoff:
+                continue
+            directory, filename = key.rsplit("/", 1) if "/" in key else ("", key)
+            if filename.endswith(".part"):
+                garbage.append((key, None, size, mtime))
+                continue
+            link = f"/uploads/{directory}/{original_name(filename)}"
+            if link not in referenced:
+                garbage.append((key, link, size, mtime))
+        return garbage
+
+    @classmethod
+    def _delete_group(cls, link: str, keys: List[str], cutoff: float) -> int:
+        """
+        Удаляет файлы одного оригинала под блокировкой его строки в media_file_table.
+
+        Повторная загрузка того же файла сначала фиксирует ссылку в media_file_table,
+        а пост сохраняется позже, поэтому файл, на который в строке уже есть ссылки,
+        не удаляется. Время изменения оригинала после блокировки тоже проверяется еще раз.
+        """
+        storage = ImageHandler.STORAGE
+        db = SessionLocal()
+        try:
+            media = db.query(MediaFile).filter(MediaFile.link == link).with_for_update().first()
+            if media is not None and media.ref_count > 0:
+                return 0
+            mtime = storage.mtime(ImageHandler.storage_key(link))
+            if mtime is not None and mtime > cutoff:
+                return 0
+            storage.delete(keys)
+            if media is not None:
+                db.delete(media)
+            db.commit()
+            return len(keys)
+        finally:
+            db.close()
+
+    @classmethod
+    def collect(cls, db: Session, dry_run: bool = False, grace_period: float = None, workers: int = None) -> Dict:
+        """
+        Находит и (если не dry_run) удаляет мусорные файлы.
+
+        Returns:
+            Dict: Отчет: количество ссылок в БД, число и объем мусорных файлов, список файлов
+        """
+        grace_period = cls.GRACE_PERIOD if grace_period is None else grace_period
+        started = time.monotonic()
+        referenced = ReferencedLinks.load(db)
+        # Не держим транзакцию открытой, пока обходим диск
+        db.rollback()
+        garbage = cls.find_garbage(referenced, grace_period, workers)
+
+        report = {
+            "dry_run": dry_run,
+            "referenced_links": len(referenced),
+            "garbage_files": len(garbage),
+            "garbage_bytes": sum(size for _, _, size, _ in garbage),
+            "files": [
+                {"key": key, "size": size, "age_hours": round((time.time() - mtime) / 3600, 1)}
+                for key, _, size, mtime in garbage
+            ],
+        }
+        if not dry_run:
+            cutoff = time.time() - grace_period
+            groups = defaultdict(list)
+            for key, link, _, _ in garbage:
+                groups[link].append(key)
+            removed = 0
+            for link, keys in groups.items():
+                try:
+                    if link is None:
+                        # Временные файлы ни к чему не относятся и удаляются без блокировки
+                        ImageHandler.STORAGE.delete(keys)
+                        removed += len(keys)
+                    else:
+                        removed += cls._delete_group(link, keys, cutoff)
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении файлов {link}: {str(e)}")
+            report["removed_files"] = removed
+        report["elapsed_seconds"] = round(time.monotonic() - started, 2)
+        logger.info(
+            f"Сборка мусора в uploads: мусорных файлов {report['garbage_files']} "
+            f"({report['garbage_bytes']} байт), удалено {report.get('removed_files', 0)}"
+        )
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Удаление файлов из uploads, на которые нет ссылок в БД")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, какие файлы будут удалены")
+    parser.add_argument(
+        "--grace-hours", type=float, default=MediaGarbageCollector.GRACE_PERIOD / 3600,
+        help="Не трогать файлы, изменявшиеся за последние N часов"
+    )
+    parser.add_argument("--workers", type=int, default=MediaGarbageCollector.WORKERS, help="Потоков обхода диска")
+    parser.add_argument("--output", help="Сохранить полный отчет в JSON-файл")
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        report = MediaGarbageCollector.collect(db, args.dry_run, args.grace_hours * 3600, args.workers)
+    finally:
+        db.close()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    summary = {key: value for key, value in report.items() if key != "files"}
+    print(json.dumps(summary, ensure_ascii=False))
+    if args.dry_run and not args.output:
+        for item in report["files"]:
+            print(f"{item['key']}\t{item['size']}\t{item['age_hours']}ч")
+
+
+if __name__ == "__main__":
+    main()
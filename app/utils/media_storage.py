@@ -0,0 +1,374 @@
+import os
+import re
+import glob
+import uuid
+import logging
+import mimetypes
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("app")
+
+# Расширения перекодированных копий (a.jpg -> a.jpg.webp) по имени формата Pillow
+TRANSCODE_EXTENSIONS = {"WEBP": ".webp", "AVIF": ".avif"}
+# Уменьшенный вариант: <имя>_w<ширина><расширение>
+_VARIANT_NAME = re.compile(r"(.+)_w\d+(\.[^.]+)")
+# Имя файла, адресованного содержимым: SHA-256 в шестнадцатеричном виде
+_CONTENT_NAME = re.compile(r"[0-9a-f]{64}")
+# Файлы с хешем содержимого в имени не меняются: клиентам и CDN незачем их перепроверять
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def original_name(filename: str) -> str:
+    """Имя оригинала для файла из uploads: вариант и перекодированная копия лежат рядом с ним."""
+    for suffix in TRANSCODE_EXTENSIONS.values():
+        stripped = filename[:-len(suffix)]
+        if filename.endswith(suffix) and os.path.splitext(stripped)[1]:
+            filename = stripped
+            break
+    match = _VARIANT_NAME.fullmatch(filename)
+    return match.group(1) + match.group(2) if match else filename
+
+
+def is_content_addressed(filename: str) -> bool:
+    """Файл - оригинал с хешем содержимого в имени или его вариант либо перекодированная копия."""
+    return bool(_CONTENT_NAME.fullmatch(os.path.splitext(original_name(filename))[0]))
+
+
+class MediaStorage(ABC):
+    """
+    Хранилище загруженных файлов.
+
+    Ключ файла - путь относительно uploads с прямыми слешами: images/ab/cd/<хеш>.jpg.
+    У каждого хранилища есть локальный каталог root, из которого файлы читаются
+    (для локального хранилища это сами файлы, для удаленного - кэш на чтение)
+    и в котором готовятся новые файлы перед публикацией.
+
+    Операции с файлами абстрактные: хранилище без какой-либо из них нельзя
+    создать, и ошибка проявляется при запуске, а не посреди запроса.
+    """
+
+    root: str
+    # Отдавать клиентам перенаправление на url(key) вместо самого файла
+    redirects = False
+
+    def path(self, key: str) -> str:
+        """Локальный путь файла в root."""
+        return os.path.join(self.root, *key.split("/"))
+
+    def key(self, path: str) -> str:
+        """Ключ для локального пути внутри root."""
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def temp_path(self, directory: str) -> str:
+        """Путь для временного файла в root, из которого его можно атомарно опубликовать."""
+        staging = os.path.join(self.root, directory)
+        os.makedirs(staging, exist_ok=True)
+        return os.path.join(staging, f"{uuid.uuid4().hex}.part")
+
+    @abstractmethod
+    def publish(self, temp_path: str, key: str) -> bool:
+        """
+        Публикует временный файл под ключом, если такого файла еще нет; иначе
+        обновляет время изменения существующего, а временный удаляет.
+
+        Returns:
+            bool: True, если файл был записан
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, path: str):
+        """Сохраняет в хранилище файл, созданный в root (варианты изображений)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def fetch(self, key: str) -> Optional[str]:
+        """Локальный путь файла (для удаленного хранилища - после загрузки в кэш) или None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def touch(self, key: str) -> bool:
+        """Обновляет время изменения файла. Returns: False, если файла нет."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def mtime(self, key: str) -> Optional[float]:
+        """Время изменения файла или None, если файла нет."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, keys: List[str]):
+        """Удаляет файлы; отсутствующие пропускаются."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_with_derived(self, key: str) -> List[str]:
+        """Удаляет файл вместе с его вариантами и перекодированными копиями. Returns: удаленные ключи."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_files(self, workers: int = 8) -> Iterator[Tuple[str, int, float]]:
+        """Все файлы хранилища: (ключ, размер, время изменения)."""
+        raise NotImplementedError
+
+    def url(self, key: str) -> Optional[str]:
+        """Прямая ссылка на файл для перенаправления клиента (если хранилище ее поддерживает)."""
+        return None
+
+
+class LocalStorage(MediaStorage):
+    """Файлы в локальном каталоге (по умолчанию uploads)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def publish(self, temp_path: str, key: str) -> bool:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # Сборщик мусора не удаляет недавно измененные файлы
+            os.utime(path)
+        except FileNotFoundError:
+            os.replace(temp_path, path)
+            return True
+        os.remove(temp_path)
+        return False
+
+    def put(self, key: str, path: str):
+        target = self.path(key)
+        if os.path.abspath(path) != os.path.abspath(target):
+            os.replace(path, target)
+
+    def fetch(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def touch(self, key: str) -> bool:
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def mtime(self, key: str) -> Optional[float]:
+        try:
+            return os.stat(self.path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def delete(self, keys: List[str]):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def delete_with_derived(self, key: str) -> List[str]:
+        path = self.path(key)
+        if not os.path.exists(path):
+            return []
+        os.remove(path)
+        stem, ext = os.path.splitext(path)
+        derived = glob.glob(f"{glob.escape(path)}.*") + glob.glob(f"{glob.escape(stem)}_w*{glob.escape(ext)}*")
+        for derived_path in derived:
+            os.remove(derived_path)
+        return [key] + [self.key(derived_path) for derived_path in derived]
+
+    def _scan(self, directory: str, filenames) -> List[Tuple[str, int, float]]:
+        files = []
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((self.key(path), stat_result.st_size, stat_result.st_mtime))
+        return files
+
+    def _scan_tree(self, root: str) -> List[Tuple[str, int, float]]:
+        files = []
+        for directory, _, filenames in os.walk(root):
+            files.extend(self._scan(directory, filenames))
+        return files
+
+    def iter_files(self, workers: int = 8) -> Iterator[Tuple[str, int, float]]:
+        # Каждый подкаталог первого уровня обходится отдельной задачей;
+        # файлы старой плоской структуры проверяются одной задачей
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for directory in sorted(os.listdir(self.root)):
+                directory_path = os.path.join(self.root, directory)
+                if not os.path.isdir(directory_path):
+                    continue
+                flat_files = []
+                for entry in os.scandir(directory_path):
+                    if entry.is_dir():
+                        futures.append(executor.submit(self._scan_tree, entry.path))
+                    else:
+                        flat_files.append(entry.name)
+                futures.append(executor.submit(self._scan, directory_path, flat_files))
+            for future in futures:
+                yield from future.result()
+
+
+class S3Storage(MediaStorage):
+    """
+    Файлы в S3-совместимом объектном хранилище (AWS S3, MinIO и т.п.).
+
+    Локальный каталог root служит кэшем на чтение: /uploads отдает файлы из
+    него, скачивая отсутствующие при первом обращении, а варианты изображений
+    создаются в нем и затем выгружаются в хранилище. Кэш не ограничен по размеру;
+    старые файлы из него можно удалять в любой момент (например, по atime).
+    Учетные данные берутся boto3 из стандартных переменных окружения AWS_*.
+    """
+
+    def __init__(self, bucket: str, cache_dir: str, endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, redirects: bool = False, url_ttl: int = 3600):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("Для MEDIA_STORAGE=s3 установите пакет boto3")
+        self._client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None)
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.root = cache_dir
+        self.redirects = redirects
+        self.url_ttl = url_ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _is_missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    @staticmethod
+    def _extra_args(key: str) -> dict:
+        extra_args = {}
+        content_type = mimetypes.guess_type(key)[0]
+        if content_type:
+            extra_args["ContentType"] = content_type
+        # Заголовок отдается и при перенаправлении клиентов прямо в хранилище
+        if is_content_addressed(key.rsplit("/", 1)[-1]):
+            extra_args["CacheControl"] = IMMUTABLE_CACHE_CONTROL
+        return extra_args
+
+    def publish(self, temp_path: str, key: str) -> bool:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        created = not self.touch(key)
+        if created:
+            # upload_file передает большие файлы по частям (multipart), не читая целиком в память
+            self._client.upload_file(temp_path, self.bucket, key, ExtraArgs=self._extra_args(key))
+        # Загруженный файл сразу попадает в кэш на чтение
+        os.replace(temp_path, path)
+        return created
+
+    def put(self, key: str, path: str):
+        self._client.upload_file(path, self.bucket, key, ExtraArgs=self._extra_args(key))
+
+    def fetch(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        if os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            self._client.download_file(self.bucket, key, partial_path)
+        except self._client_error as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            if self._is_missing(e):
+                return None
+            raise
+        os.replace(partial_path, path)
+        return path
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self._client_error as e:
+            if self._is_missing(e):
+                return False
+            raise
+
+    def touch(self, key: str) -> bool:
+        # Объекты неизменяемы: время изменения обновляется копированием объекта в себя
+        try:
+            self._client.copy_object(
+                Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE", **self._extra_args(key)
+            )
+            return True
+        except self._client_error as e:
+            if self._is_missing(e):
+                return False
+            raise
+
+    def mtime(self, key: str) -> Optional[float]:
+        try:
+            return self._client.head_object(Bucket=self.bucket, Key=key)["LastModified"].timestamp()
+        except self._client_error as e:
+            if self._is_missing(e):
+                return None
+            raise
+
+    def delete_with_derived(self, key: str) -> List[str]:
+        directory, filename = key.rsplit("/", 1)
+        stem = os.path.splitext(filename)[0]
+        keys = [
+            item["Key"]
+            for page in self._client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=f"{directory}/{stem}")
+            for item in page.get("Contents", [])
+            if original_name(item["Key"].rsplit("/", 1)[1]) == filename
+        ]
+        self.delete(keys)
+        return keys
+
+    def delete(self, keys: List[str]):
+        # delete_objects принимает не больше 1000 ключей за запрос
+        for start in range(0, len(keys), 1000):
+            self._client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]], "Quiet": True}
+            )
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def iter_files(self, workers: int = 8) -> Iterator[Tuple[str, int, float]]:
+        for page in self._client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["Size"], item["LastModified"].timestamp()
+
+    def url(self, key: str) -> Optional[str]:
+        return self._client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=self.url_ttl
+        )
+
+
+def create_storage(upload_dir: str = "uploads") -> MediaStorage:
+    """Создает хранилище по переменной окружения MEDIA_STORAGE (local или s3)."""
+    backend = os.getenv("MEDIA_STORAGE", "local").lower()
+    if backend == "local":
+        return LocalStorage(upload_dir)
+    if backend == "s3":
+        return S3Storage(
+            bucket=os.environ["MEDIA_S3_BUCKET"],
+            cache_dir=os.getenv("MEDIA_CACHE_DIR", "media_cache"),
+            endpoint_url=os.getenv("MEDIA_S3_ENDPOINT_URL"),
+            region=os.getenv("MEDIA_S3_REGION"),
+            redirects=os.getenv("MEDIA_S3_REDIRECT", "false").lower() in ("1", "true", "yes"),
+            url_ttl=int(os.getenv("MEDIA_S3_URL_TTL", "3600")),
+        )
+    raise ValueError(f"Неизвестное хранилище MEDIA_STORAGE={backend}")
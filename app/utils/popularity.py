@@ -0,0 +1,172 @@
+import os
+import math
+import asyncio
+import logging
+import threading
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import List
+from sqlalchemy import func, select, insert, literal, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.db.database import SessionLocal
+from app.models.models import Post, Like, PostPopularity
+
+logger = logging.getLogger("app")
+
+
+class PopularityRanking:
+    """
+    Предвычисленный рейтинг популярных основных постов.
+
+    Рейтинг пересчитывается периодически одним INSERT ... SELECT в post_popularity_table:
+    каждый лайк за последние WINDOW_HOURS часов дает вклад 0.5 ** (возраст / HALF_LIFE_HOURS).
+    Каждый воркер держит копию рейтинга в памяти в виде массива post_id по убыванию
+    популярности, поэтому чтение страницы рейтинга стоит O(limit).
+    """
+
+    # Окно, за которое учитываются лайки (часы)
+    WINDOW_HOURS = float(os.getenv("POPULARITY_WINDOW_HOURS", "168"))
+    # Период полураспада вклада лайка (часы)
+    HALF_LIFE_HOURS = float(os.getenv("POPULARITY_HALF_LIFE_HOURS", "24"))
+    # Как часто пересчитывать рейтинг (секунды)
+    REFRESH_INTERVAL = float(os.getenv("POPULARITY_REFRESH_INTERVAL", "300"))
+    # Сколько постов хранится в рейтинге
+    MAX_POSTS = int(os.getenv("POPULARITY_MAX_POSTS", "1000"))
+
+    # Ключ advisory-блокировки, чтобы рейтинг пересчитывал только один воркер
+    REFRESH_LOCK_KEY = 7310453
+
+    _lock = threading.Lock()
+    _post_ids = array("q")
+    _loaded = False
+    _refresh_task = None
+
+    @classmethod
+    def recompute(cls, db: Session):
+        """
+        Пересчитывает post_popularity_table в одной транзакции.
+
+        Args:
+            db (Session): Сессия базы данных
+        """
+        now = datetime.now(timezone.utc)
+        age_hours = (literal(now.timestamp()) - func.extract("epoch", Like.creation_date)) / 3600.0
+        score = func.sum(func.exp(-age_hours * math.log(2) / cls.HALF_LIFE_HOURS))
+        scored = (
+            select(Like.post_id.label("post_id"), score.label("score"))
+            .join(Post, Post.post_id == Like.post_id)
+            .where(
+                Post.child_id.is_(None),
+                Post.post_type_id == 1,
+                Like.creation_date >= now - timedelta(hours=cls.WINDOW_HOURS)
+            )
+            .group_by(Like.post_id)
+            .order_by(score.desc(), Like.post_id.desc())
+            .limit(cls.MAX_POSTS)
+            .subquery()
+        )
+        rows = select(
+            scored.c.post_id,
+            scored.c.score,
+            func.row_number().over(order_by=(scored.c.score.desc(), scored.c.post_id.desc())),
+            literal(now)
+        )
+
+        db.query(PostPopularity).delete(synchronize_session=False)
+        db.execute(insert(PostPopularity).from_select(["post_id", "score", "rank", "refreshed_at"], rows))
+        db.commit()
+
+    @classmethod
+    def load(cls, db: Session):
+        """Загружает рейтинг из post_popularity_table в память воркера."""
+        post_ids = array("q", (post_id for (post_id,) in db.query(PostPopularity.post_id).order_by(PostPopularity.rank)))
+        with cls._lock:
+            cls._post_ids = post_ids
+            cls._loaded = True
+
+    @classmethod
+    def ensure_loaded(cls, db: Session):
+        if not cls._loaded:
+            cls.load(db)
+
+    @classmethod
+    def refresh(cls):
+        """
+        Пересчитывает рейтинг, если он устарел, и перезагружает его в память.
+
+        В PostgreSQL пересчет выполняет только воркер, получивший advisory-блокировку,
+        остальные просто перечитывают таблицу.
+        """
+        db = SessionLocal()
+        try:
+            refreshed_at = db.query(func.max(PostPopularity.refreshed_at)).scalar()
+            is_stale = refreshed_at is None or (
+                datetime.now(timezone.utc) - refreshed_at.replace(tzinfo=refreshed_at.tzinfo or timezone.utc)
+            ).total_seconds() >= cls.REFRESH_INTERVAL
+            if is_stale:
+                acquired = True
+                if db.bind.dialect.name == "postgresql":
+                    acquired = db.execute(
+                        text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": cls.REFRESH_LOCK_KEY}
+                    ).scalar()
+                if acquired:
+                    cls.recompute(db)
+                    logger.info("Рейтинг популярных постов пересчитан")
+                else:
+                    db.rollback()
+            cls.load(db)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при обновлении рейтинга популярных постов: {str(e)}")
+        finally:
+            db.close()
+
+    @classmethod
+    def top(cls, skip: int = 0, limit: int = 10, exclude=None) -> List[int]:
+        """
+        Возвращает ID популярных постов по убыванию популярности.
+
+        Args:
+            skip (int): Сколько постов пропустить (после исключений)
+            limit (int): Максимальное количество постов
+            exclude: Множество (поддерживающее `in`) ID постов, которые нужно пропустить
+
+        Returns:
+            List[int]: ID постов
+        """
+        with cls._lock:
+            post_ids = cls._post_ids
+        if not exclude:
+            return post_ids[skip:skip + limit].tolist()
+
+        result = []
+        for post_id in post_ids:
+            if post_id in exclude:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            result.append(post_id)
+            if len(result) >= limit:
+                break
+        return result
+
+    @classmethod
+    async def _refresh_loop(cls):
+        while True:
+            await run_in_threadpool(cls.refresh)
+            await asyncio.sleep(cls.REFRESH_INTERVAL)
+
+    @classmethod
+    def start(cls):
+        """Запускает фоновую задачу периодического обновления рейтинга."""
+        if cls._refresh_task is None:
+            cls._refresh_task = asyncio.get_event_loop().create_task(cls._refresh_loop())
+
+    @classmethod
+    def stop(cls):
+        """Останавливает фоновую задачу обновления рейтинга."""
+        if cls._refresh_task is not None:
+            cls._refresh_task.cancel()
+            cls._refresh_task = None
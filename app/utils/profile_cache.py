@@ -0,0 +1,36 @@
+import os
+from typing import Optional
+from app.utils.ttl_cache import TTLCache
+
+
+class UserProfileCache:
+    """
+    Кэш профилей пользователей (ответов GET /users/{user_id}) в памяти воркера.
+
+    Запись сбрасывается при изменении профиля, постов пользователя, лайков его постов
+    и его тегов интересов. Изменения, сделанные другими воркерами, видны не позже
+    чем через TTL секунд, поэтому TTL держим коротким.
+    """
+
+    TTL = float(os.getenv("PROFILE_CACHE_TTL", "10"))
+    MAX_USERS = int(os.getenv("PROFILE_CACHE_MAX_USERS", "10000"))
+
+    _profiles = TTLCache(MAX_USERS, TTL)
+
+    @classmethod
+    def get(cls, user_id: int) -> Optional[dict]:
+        return cls._profiles.get(user_id)
+
+    @classmethod
+    def put(cls, user_id: int, profile: dict):
+        cls._profiles.set(user_id, profile)
+
+    @classmethod
+    def invalidate(cls, *user_ids: int):
+        for user_id in user_ids:
+            if user_id is not None:
+                cls._profiles.pop(user_id)
+
+    @classmethod
+    def clear(cls):
+        cls._profiles.clear()
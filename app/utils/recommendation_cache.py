@@ -0,0 +1,98 @@
+import os
+import secrets
+import logging
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.models.models import RecommendationSnapshot
+
+logger = logging.getLogger("app")
+
+
+class RecommendationCache:
+    """
+    Снимки ранжированных рекомендаций пользователей в recommendation_snapshot_table.
+
+    Для пользователя хранится снимок: токен и компактный массив post_id в порядке
+    ранжирования. Страницы рекомендаций нарезаются из снимка, поэтому выдача не
+    «съезжает» между страницами при появлении новых постов, а ранжирование не
+    пересчитывается на каждый запрос. Снимки лежат в БД, а не в памяти воркера:
+    следующую страницу может обслужить любой воркер. Снимок живет TTL секунд или
+    до существенного изменения тегов интересов пользователя.
+    """
+
+    TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "300"))
+    # Снимок сбрасывается, если сходство Жаккара старых и новых тегов ниже порога
+    PROFILE_CHANGE_THRESHOLD = float(os.getenv("RECOMMENDATION_PROFILE_CHANGE_THRESHOLD", "0.7"))
+
+    @classmethod
+    def get(cls, db: Session, user_id: int, snapshot: Optional[str] = None) -> Optional[Tuple[str, array]]:
+        """
+        Возвращает снимок рекомендаций пользователя.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+            snapshot (Optional[str]): Токен снимка, полученный клиентом с предыдущей страницей
+
+        Returns:
+            Optional[Tuple[str, array]]: (токен, массив post_id) или None, если снимка нет,
+            он устарел или токен не совпадает
+        """
+        entry = db.query(RecommendationSnapshot).filter(
+            RecommendationSnapshot.user_id == user_id,
+            RecommendationSnapshot.created_at > datetime.now(timezone.utc) - timedelta(seconds=cls.TTL)
+        ).first()
+        if entry is None or (snapshot is not None and entry.token != snapshot):
+            return None
+        post_ids = array("q")
+        post_ids.frombytes(entry.post_ids)
+        return entry.token, post_ids
+
+    @classmethod
+    def put(cls, db: Session, user_id: int, post_ids: Iterable[int]) -> str:
+        """Сохраняет новый снимок рекомендаций пользователя и возвращает его токен."""
+        token = secrets.token_urlsafe(8)
+        values = {
+            RecommendationSnapshot.token: token,
+            RecommendationSnapshot.post_ids: array("q", post_ids).tobytes(),
+            RecommendationSnapshot.created_at: datetime.now(timezone.utc),
+        }
+        for _ in range(2):
+            updated = db.query(RecommendationSnapshot).filter(
+                RecommendationSnapshot.user_id == user_id
+            ).update(values, synchronize_session=False)
+            if not updated:
+                db.add(RecommendationSnapshot(user_id=user_id, **{column.key: value for column, value in values.items()}))
+            try:
+                db.commit()
+                return token
+            except IntegrityError:
+                # Снимок одновременно создал другой запрос - перезаписываем его
+                db.rollback()
+        raise RuntimeError(f"Не удалось сохранить снимок рекомендаций пользователя {user_id}")
+
+    @classmethod
+    def invalidate(cls, db: Session, user_id: int):
+        """Удаляет снимок пользователя (в транзакции вызывающего кода)."""
+        db.query(RecommendationSnapshot).filter(
+            RecommendationSnapshot.user_id == user_id
+        ).delete(synchronize_session=False)
+
+    @classmethod
+    def clear(cls, db: Session):
+        """Удаляет все снимки (в транзакции вызывающего кода)."""
+        db.query(RecommendationSnapshot).delete(synchronize_session=False)
+
+    @classmethod
+    def on_profile_change(cls, db: Session, user_id: int, previous_tag_ids: set, current_tag_ids: set):
+        """Сбрасывает снимок пользователя, если его теги интересов существенно изменились."""
+        union = previous_tag_ids | current_tag_ids
+        if not union:
+            return
+        similarity = len(previous_tag_ids & current_tag_ids) / len(union)
+        if similarity < cls.PROFILE_CHANGE_THRESHOLD:
+            cls.invalidate(db, user_id)
+            logger.info(f"Снимок рекомендаций пользователя {user_id} сброшен: теги изменились (сходство {similarity:.2f})")
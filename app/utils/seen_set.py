@@ -0,0 +1,122 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.models.models import Like
+
+logger = logging.getLogger("app")
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    """Перемешивание splitmix64 для получения независимых хешей целого числа."""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+class SeenSet:
+    """
+    Компактное множество просмотренных (лайкнутых) постов на основе фильтра Блума.
+
+    Проверка может дать ложноположительный ответ с вероятностью около error_rate,
+    но никогда не дает ложноотрицательный. Около 10 бит на элемент при 1% ошибок.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 64)
+        self.bit_count = int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / self.capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: int):
+        first = _mix64(item)
+        second = _mix64(first) | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, item: int):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: int) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SeenSetCache:
+    """
+    Кэш SeenSet лайкнутых постов по пользователям в памяти воркера (LRU с TTL).
+
+    Множество строится потоковым чтением like_table один раз, затем пополняется
+    событиями лайков. Снятие лайка сбрасывает множество пользователя, так как
+    из фильтра Блума нельзя удалять элементы.
+    """
+
+    # Максимальное количество пользователей в кэше
+    MAX_USERS = int(os.getenv("SEEN_SET_MAX_USERS", "10000"))
+    # Время жизни множества, после которого оно перестраивается (секунды)
+    TTL = float(os.getenv("SEEN_SET_TTL", "600"))
+    # Запас емкости фильтра относительно текущего числа лайков
+    GROWTH_FACTOR = 2
+
+    _lock = threading.Lock()
+    _entries: "OrderedDict[int, tuple]" = OrderedDict()
+
+    @classmethod
+    def get(cls, db: Session, user_id: int) -> SeenSet:
+        """
+        Возвращает множество лайкнутых пользователем постов, строя его при необходимости.
+
+        Args:
+            db (Session): Сессия базы данных
+            user_id (int): ID пользователя
+
+        Returns:
+            SeenSet: Множество ID лайкнутых постов
+        """
+        now = time.monotonic()
+        with cls._lock:
+            entry = cls._entries.get(user_id)
+            if entry is not None and now - entry[1] < cls.TTL:
+                cls._entries.move_to_end(user_id)
+                return entry[0]
+
+        likes_count = db.query(func.count(Like.like_id)).filter(Like.user_id == user_id).scalar() or 0
+        seen = SeenSet(likes_count * cls.GROWTH_FACTOR)
+        for (post_id,) in db.query(Like.post_id).filter(Like.user_id == user_id).yield_per(5000):
+            seen.add(post_id)
+
+        with cls._lock:
+            cls._entries[user_id] = (seen, now)
+            cls._entries.move_to_end(user_id)
+            while len(cls._entries) > cls.MAX_USERS:
+                cls._entries.popitem(last=False)
+        return seen
+
+    @classmethod
+    def record_like(cls, user_id: int, post_id: int):
+        """Добавляет лайк в закэшированное множество пользователя."""
+        with cls._lock:
+            entry = cls._entries.get(user_id)
+            if entry is None:
+                return
+            seen = entry[0]
+            if seen.count >= seen.capacity:
+                # Фильтр переполнен, точность падает: перестроим при следующем обращении
+                del cls._entries[user_id]
+                return
+            seen.add(post_id)
+
+    @classmethod
+    def discard(cls, user_id: int):
+        """Сбрасывает закэшированное множество пользователя."""
+        with cls._lock:
+            cls._entries.pop(user_id, None)
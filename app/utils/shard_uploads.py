@@ -0,0 +1,195 @@
+import os
+import json
+import logging
+import argparse
+from typing import Dict, Iterator, Optional, Tuple
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+from app.models.models import MediaFile, Post, User
+from app.utils.image_handler import ImageHandler
+from app.utils.media_storage import LocalStorage, original_name
+
+logger = logging.getLogger("app")
+
+
+def sharded_link(link: Optional[str]) -> Optional[str]:
+    """Ссылка на файл в разложенной по подкаталогам структуре; прочие ссылки не меняются."""
+    if not link or not link.startswith("/uploads/"):
+        return link
+    parts = link.split("/")
+    # Плоская ссылка: ['', 'uploads', <директория>, <имя файла>]
+    if len(parts) != 4:
+        return link
+    _, _, directory, filename = parts
+    return f"/uploads/{directory}/{ImageHandler.shard_dir(original_name(filename))}/{filename}"
+
+
+def _flat_files() -> Iterator[Tuple[str, str]]:
+    """Файлы, лежащие прямо в директориях uploads: пары (путь, путь в подкаталоге)."""
+    root = ImageHandler.UPLOAD_DIR
+    for directory in sorted(os.listdir(root)):
+        directory_path = os.path.join(root, directory)
+        if not os.path.isdir(directory_path):
+            continue
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.endswith(".part"):
+                    continue
+                shard = ImageHandler.shard_dir(original_name(entry.name))
+                yield entry.path, os.path.join(directory_path, shard, entry.name)
+
+
+def link_files(dry_run: bool = False) -> int:
+    """
+    Этап 1: создает для каждого файла жесткую ссылку в его подкаталоге.
+
+    Старые ссылки продолжают работать, пока в БД не записаны новые.
+    """
+    linked = 0
+    for path, target in _flat_files():
+        if os.path.exists(target):
+            continue
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(path, target)
+        linked += 1
+    return linked
+
+
+def _rewrite_variants(variants: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    if not variants:
+        return variants
+    return {width: sharded_link(link) for width, link in variants.items()}
+
+
+def rewrite_links(db: Session, batch_size: int = 1000, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Этап 2: переписывает ссылки в post_table, user_table и media_file_table.
+
+    Строки читаются пачками по первичному ключу, а обновляются одним
+    executemany на пачку, каждая пачка фиксируется отдельно.
+    """
+    posts = Post.__table__
+    users = User.__table__
+    media_files = MediaFile.__table__
+    update_post = posts.update().where(posts.c.post_id == bindparam("row_id")).values(
+        media_link=bindparam("link"), media_variants=bindparam("variants")
+    )
+    update_user = users.update().where(users.c.user_id == bindparam("row_id")).values(
+        image_link=bindparam("link"), image_variants=bindparam("variants")
+    )
+    update_media_file = media_files.update().where(media_files.c.link == bindparam("old_link")).values(
+        link=bindparam("new_link")
+    )
+    # Строка с новой ссылкой уже может существовать (файл загрузили заново после
+    # выкладки) - тогда переносим в нее счетчик ссылок и удаляем старую строку
+    merge_media_file = media_files.update().where(media_files.c.link == bindparam("new_link")).values(
+        ref_count=media_files.c.ref_count + bindparam("old_ref_count")
+    )
+    delete_media_file = media_files.delete().where(media_files.c.link == bindparam("old_link"))
+
+    def rewrite(table_name, key_column, link_column, variants_column, statement):
+        updated = 0
+        last_key = None
+        while True:
+            query = db.query(key_column, link_column, variants_column).filter(link_column.like("/uploads/%"))
+            if last_key is not None:
+                query = query.filter(key_column > last_key)
+            rows = query.order_by(key_column).limit(batch_size).all()
+            if not rows:
+                return updated
+            last_key = rows[-1][0]
+            params = [
+                {"row_id": key, "link": sharded_link(link), "variants": _rewrite_variants(variants)}
+                for key, link, variants in rows
+                if sharded_link(link) != link
+            ]
+            if params and not dry_run:
+                db.execute(statement, params)
+                db.commit()
+            updated += len(params)
+            logger.info(f"{table_name}: переписано ссылок {updated}")
+
+    counts = {
+        "posts": rewrite("post_table", Post.post_id, Post.media_link, Post.media_variants, update_post),
+        "users": rewrite("user_table", User.user_id, User.image_link, User.image_variants, update_user),
+    }
+
+    # Ссылки в media_file_table - первичный ключ, поэтому идем по нему же
+    updated = 0
+    last_link = ""
+    while True:
+        links = [
+            link for (link,) in db.query(MediaFile.link)
+            .filter(MediaFile.link > last_link).order_by(MediaFile.link).limit(batch_size)
+        ]
+        if not links:
+            break
+        last_link = links[-1]
+        params = [{"old_link": link, "new_link": sharded_link(link)} for link in links if sharded_link(link) != link]
+        if params and not dry_run:
+            # Блокируем старые и новые строки, чтобы счетчики не изменились до переноса
+            ref_counts = dict(
+                db.query(MediaFile.link, MediaFile.ref_count)
+                .filter(MediaFile.link.in_([link for param in params for link in (param["old_link"], param["new_link"])]))
+                .with_for_update()
+            )
+            params = [param for param in params if param["old_link"] in ref_counts]
+            merged = [
+                {**param, "old_ref_count": ref_counts[param["old_link"]]}
+                for param in params if param["new_link"] in ref_counts
+            ]
+            moved = [param for param in params if param["new_link"] not in ref_counts]
+            if merged:
+                db.execute(merge_media_file, merged)
+                db.execute(delete_media_file, merged)
+            if moved:
+                db.execute(update_media_file, moved)
+            db.commit()
+        updated += len(params)
+    counts["media_files"] = updated
+    return counts
+
+
+def remove_flat_files(dry_run: bool = False) -> int:
+    """Этап 3: удаляет файлы из плоских директорий, у которых уже есть копия в подкаталоге."""
+    removed = 0
+    for path, target in _flat_files():
+        if not os.path.exists(target) and not dry_run:
+            logger.warning(f"Файл не перенесен, оставляем на месте: {path}")
+            continue
+        if not dry_run:
+            os.remove(path)
+        removed += 1
+    return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Перенос загруженных файлов в подкаталоги по хешу и перезапись ссылок на них в БД. "
+                    "Запускать после выкладки версии, которая сохраняет файлы в подкаталоги."
+    )
+    parser.add_argument("--batch-size", type=int, default=1000, help="Размер пачки обновлений в БД")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать, ничего не меняя")
+    parser.add_argument(
+        "--keep-flat", action="store_true",
+        help="Не удалять старые файлы (например, пока кэши воркеров еще отдают старые ссылки)"
+    )
+    args = parser.parse_args(argv)
+    if not isinstance(ImageHandler.STORAGE, LocalStorage):
+        parser.error("перенос выполняется только для локального хранилища (MEDIA_STORAGE=local)")
+
+    from app.db.database import SessionLocal
+    report = {"linked_files": link_files(args.dry_run)}
+    db = SessionLocal()
+    try:
+        report["rewritten_links"] = rewrite_links(db, args.batch_size, args.dry_run)
+    finally:
+        db.close()
+    if not args.keep_flat:
+        report["removed_flat_files"] = remove_flat_files(args.dry_run)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
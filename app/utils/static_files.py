@@ -0,0 +1,135 @@
+import os
+import mimetypes
+from typing import Optional, Sequence, Set
+from fastapi.concurrency import run_in_threadpool
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, RedirectResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+from app.utils.image_handler import ImageHandler, transcoded_path
+from app.utils.media_storage import IMMUTABLE_CACHE_CONTROL, LocalStorage, MediaStorage, is_content_addressed
+from app.utils.ttl_cache import TTLCache
+
+# Не во всех системных таблицах MIME есть новые форматы изображений
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+# MIME-типы, по которым клиент сообщает о поддержке формата в заголовке Accept
+FORMAT_MIME_TYPES = {"AVIF": "image/avif", "WEBP": "image/webp"}
+
+# Расширения изображений, для которых могут существовать перекодированные копии
+_NEGOTIABLE_EXTENSIONS = ImageHandler.ALLOWED_EXTENSIONS
+
+
+def _accepted_types(scope: Scope) -> Set[str]:
+    """MIME-типы из заголовка Accept с ненулевым q."""
+    accepted = set()
+    for part in Headers(scope=scope).get("accept", "").split(","):
+        media_type, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.strip().lower())
+    return accepted
+
+
+class NegotiatedStaticFiles(StaticFiles):
+    """
+    Раздача загруженных файлов с выбором формата по заголовку Accept.
+
+    Если клиент принимает один из форматов formats (в порядке предпочтения) и
+    рядом с запрошенным изображением есть его перекодированная копия
+    (a.jpg -> a.jpg.webp), отдается копия. Ответы на запросы изображений
+    содержат Vary: Accept, чтобы кэши не отдавали копию клиентам без поддержки формата.
+
+    Для удаленного хранилища storage файлы отдаются из его локального кэша
+    (отсутствующие скачиваются при первом запросе) или, если хранилище
+    настроено на перенаправления, клиент получает 307 на прямую ссылку.
+    Результаты проверки наличия файлов в удаленном хранилище кэшируются на EXISTS_TTL.
+
+    Файлы с хешем содержимого в имени отдаются с Cache-Control: immutable и
+    ETag из имени и размера файла, остальные - с обязательной перепроверкой.
+    Запросы Range и отдачу через sendfile (расширение ASGI http.response.pathsend,
+    если сервер его поддерживает) выполняет FileResponse.
+    """
+
+    EXISTS_TTL = float(os.getenv("MEDIA_EXISTS_CACHE_TTL", "60"))
+    # Для файлов со старыми именами, которые могли перезаписываться на месте
+    CACHE_CONTROL = "public, no-cache"
+
+    def __init__(self, *args, formats: Sequence[str] = (), storage: Optional[MediaStorage] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.formats = list(formats)
+        self.storage = None if isinstance(storage, LocalStorage) else storage
+        self._exists = TTLCache(100000, self.EXISTS_TTL)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        filename = os.path.basename(full_path)
+        if is_content_addressed(filename):
+            # Хеш уже есть в имени, а опубликованный файл не меняется: ETag - само имя
+            headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": f'"{filename}"'}
+        else:
+            headers = {"Cache-Control": self.CACHE_CONTROL}
+        response = FileResponse(full_path, status_code=status_code, headers=headers, stat_result=stat_result)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    async def _remote_exists(self, key: str) -> bool:
+        exists = self._exists.get(key)
+        if exists is None:
+            if self.storage.redirects:
+                exists = await run_in_threadpool(self.storage.exists, key)
+            else:
+                exists = await run_in_threadpool(self.storage.fetch, key) is not None
+            self._exists.set(key, exists)
+        return exists
+
+    async def _get_file(self, path: str, scope: Scope) -> Response:
+        if self.storage is None:
+            return await super().get_response(path, scope)
+        try:
+            key = ImageHandler.storage_key("/uploads/" + path.replace(os.sep, "/"))
+        except ValueError:
+            raise HTTPException(status_code=404)
+        if self.storage.redirects:
+            if not await self._remote_exists(key):
+                raise HTTPException(status_code=404)
+            url = await run_in_threadpool(self.storage.url, key)
+            return RedirectResponse(url, status_code=307)
+        # Файл из кэша на чтение мог быть удален при его очистке - скачиваем снова
+        if not os.path.exists(self.storage.path(key)):
+            self._exists.pop(key)
+            if not await self._remote_exists(key):
+                raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        negotiable = bool(self.formats) and os.path.splitext(path)[1].lower() in _NEGOTIABLE_EXTENSIONS
+        if not negotiable:
+            return await self._get_file(path, scope)
+
+        accepted = _accepted_types(scope)
+        response = None
+        for image_format in self.formats:
+            if FORMAT_MIME_TYPES[image_format] not in accepted:
+                continue
+            try:
+                response = await self._get_file(transcoded_path(path, image_format), scope)
+                break
+            except HTTPException as exc:
+                # Копии еще нет (или формат не создавался) - пробуем следующий
+                if exc.status_code != 404:
+                    raise
+        if response is None:
+            response = await self._get_file(path, scope)
+        response.headers["Vary"] = "Accept"
+        return response
@@ -0,0 +1,163 @@
+import os
+import time
+import heapq
+import bisect
+import logging
+import threading
+from array import array
+from typing import Dict, Iterable, List, Set
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app.models.models import Post, TagForPost
+
+logger = logging.getLogger("app")
+
+
+class TagPostIndex:
+    """
+    Инвертированный индекс тег -> последние основные посты в памяти воркера.
+
+    Для каждого тега хранится отсортированный массив post_id (array('q'))
+    длиной не более WINDOW. Индекс прогревается одним запросом к БД,
+    пополняется событиями создания/изменения постов в текущем воркере и
+    периодически догружает связи тегов, созданные другими воркерами
+    (по возрастающему tags_for_post_table.id). Удаления и смену тегов в других
+    воркерах так не увидеть, поэтому раз в REBUILD_INTERVAL индекс строится заново.
+    """
+
+    # Максимальное количество последних постов в списке одного тега
+    WINDOW = int(os.getenv("TAG_INDEX_WINDOW", "1000"))
+    # Как часто догружать из БД посты, созданные другими воркерами (секунды)
+    REFRESH_INTERVAL = float(os.getenv("TAG_INDEX_REFRESH_INTERVAL", "30"))
+    # Как часто перестраивать индекс целиком (секунды)
+    REBUILD_INTERVAL = float(os.getenv("TAG_INDEX_REBUILD_INTERVAL", "600"))
+
+    _lock = threading.Lock()
+    _postings: Dict[int, array] = {}
+    _post_tags: Dict[int, Set[int]] = {}
+    _link_high_water = 0
+    _loaded = False
+    _refreshed_at = 0.0
+    _rebuilt_at = 0.0
+
+    @classmethod
+    def _add_link(cls, tag_id: int, post_id: int):
+        posting = cls._postings.get(tag_id)
+        if posting is None:
+            posting = cls._postings[tag_id] = array("q")
+        position = bisect.bisect_left(posting, post_id)
+        if position < len(posting) and posting[position] == post_id:
+            return
+        posting.insert(position, post_id)
+        cls._post_tags.setdefault(post_id, set()).add(tag_id)
+        if len(posting) > cls.WINDOW:
+            for evicted_id in posting[:len(posting) - cls.WINDOW]:
+                evicted_tags = cls._post_tags.get(evicted_id)
+                if evicted_tags is not None:
+                    evicted_tags.discard(tag_id)
+                    if not evicted_tags:
+                        del cls._post_tags[evicted_id]
+            del posting[:len(posting) - cls.WINDOW]
+
+    @classmethod
+    def _remove_post_locked(cls, post_id: int):
+        for tag_id in cls._post_tags.pop(post_id, ()):
+            posting = cls._postings.get(tag_id)
+            if posting is None:
+                continue
+            position = bisect.bisect_left(posting, post_id)
+            if position < len(posting) and posting[position] == post_id:
+                del posting[position]
+
+    @classmethod
+    def _load_links(cls, db: Session, after_link_id: int = None):
+        """Загружает связи тег-пост основных постов (все или с id больше after_link_id)."""
+        links = (
+            select(TagForPost.id, TagForPost.tag_id, TagForPost.post_id)
+            .join(Post, Post.post_id == TagForPost.post_id)
+            .where(Post.child_id.is_(None), Post.post_type_id == 1)
+        )
+        if after_link_id is None:
+            # При прогреве берем только последние WINDOW постов каждого тега
+            ranked = links.add_columns(
+                func.row_number().over(
+                    partition_by=TagForPost.tag_id,
+                    order_by=TagForPost.post_id.desc()
+                ).label("post_rank")
+            ).subquery()
+            rows = db.execute(
+                select(ranked.c.id, ranked.c.tag_id, ranked.c.post_id).where(ranked.c.post_rank <= cls.WINDOW)
+            ).all()
+            # Учитываем и связи, не попавшие в окно, чтобы не перечитывать их при догрузке
+            high_water = db.query(func.max(TagForPost.id)).scalar() or 0
+        else:
+            rows = db.execute(links.where(TagForPost.id > after_link_id)).all()
+            high_water = max((link_id for link_id, _, _ in rows), default=after_link_id)
+
+        with cls._lock:
+            if after_link_id is None:
+                cls._postings = {}
+                cls._post_tags = {}
+                cls._rebuilt_at = time.monotonic()
+            for _, tag_id, post_id in rows:
+                cls._add_link(tag_id, post_id)
+            cls._link_high_water = max(cls._link_high_water, high_water)
+            cls._refreshed_at = time.monotonic()
+
+    @classmethod
+    def ensure_fresh(cls, db: Session):
+        """
+        Прогревает индекс при первом обращении, догружает новые связи раз в
+        REFRESH_INTERVAL и перестраивает его целиком раз в REBUILD_INTERVAL.
+        """
+        if not cls._loaded:
+            cls._load_links(db)
+            cls._loaded = True
+            logger.info(f"Индекс тегов прогрет: {len(cls._postings)} тегов, {len(cls._post_tags)} постов")
+        elif time.monotonic() - cls._rebuilt_at >= cls.REBUILD_INTERVAL:
+            cls._load_links(db)
+        elif time.monotonic() - cls._refreshed_at >= cls.REFRESH_INTERVAL:
+            cls._load_links(db, after_link_id=cls._link_high_water)
+
+    @classmethod
+    def add_post(cls, post_id: int, tag_ids: Iterable[int]):
+        """Регистрирует основной пост, созданный или перетегированный в текущем воркере."""
+        with cls._lock:
+            cls._remove_post_locked(post_id)
+            for tag_id in tag_ids:
+                cls._add_link(tag_id, post_id)
+
+    @classmethod
+    def remove_post(cls, post_id: int):
+        """Удаляет пост из всех списков индекса."""
+        with cls._lock:
+            cls._remove_post_locked(post_id)
+
+    @classmethod
+    def candidates(cls, tag_ids: Iterable[int], exclude: Set[int], limit: int) -> List[int]:
+        """
+        Возвращает ID постов с хотя бы одним из тегов, от новых к старым, без повторов.
+
+        Args:
+            tag_ids (Iterable[int]): Теги пользователя
+            exclude (Set[int]): ID постов, которые нужно пропустить
+            limit (int): Максимальное количество кандидатов
+
+        Returns:
+            List[int]: ID постов-кандидатов
+        """
+        with cls._lock:
+            postings = [cls._postings[tag_id][::-1] for tag_id in tag_ids if tag_id in cls._postings]
+
+        result = []
+        previous_id = None
+        for post_id in heapq.merge(*postings, reverse=True):
+            if post_id == previous_id:
+                continue
+            previous_id = post_id
+            if post_id in exclude:
+                continue
+            result.append(post_id)
+            if len(result) >= limit:
+                break
+        return result
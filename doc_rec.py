@@ -8,6 +8,8 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from app.db.database import get_db
 from app.models.models import User, DocumentEvaluation
+from app.utils.leaderboard import RatingLeaderboard
+from app.utils.profile_cache import UserProfileCache
 import math
 import time
 from typing import Optional
@@ -293,6 +295,8 @@ async def evaluate_document_api(
                 # Обновляем рейтинг пользователя
                 user.rating = new_rating
                 db.commit()
+                RatingLeaderboard.update(user_id, new_rating)
+                UserProfileCache.invalidate(user_id)
                 
                 # Добавляем информацию о рейтинге в результат
                 result['previous_rating'] = old_rating
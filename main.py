@@ -6,7 +6,6 @@ from sqlalchemy.exc import SQLAlchemyError
 from pydantic import ValidationError
 import doc_rec
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 import os
 
 from app.utils.exception_handlers import (
@@ -16,6 +15,13 @@ from app.utils.exception_handlers import (
 )
 from app.utils.middleware import LoggingMiddleware
 from app.db.database import Base, engine
+from app.db.migrations import apply_migrations
+from app.utils.like_counter import LikeCounter
+from app.utils.popularity import PopularityRanking
+from app.utils.image_handler import ImageHandler
+from app.utils.image_variants import ImageVariants
+from app.utils.static_files import NegotiatedStaticFiles
+from starlette.concurrency import run_in_threadpool
 
 # Создаем директории для загрузки файлов, если они не существуют
 os.makedirs("uploads/images", exist_ok=True)
@@ -32,7 +38,15 @@ app = FastAPI(
 )
 
 # Монтируем статические файлы
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Для изображений отдается перекодированная копия (WebP/AVIF), если клиент ее принимает;
+# при хранении в S3 файлы отдаются из локального кэша или перенаправлением
+app.mount(
+    "/uploads",
+    NegotiatedStaticFiles(
+        directory=ImageHandler.STORAGE.root, formats=ImageVariants.TRANSCODE_FORMATS, storage=ImageHandler.STORAGE
+    ),
+    name="uploads",
+)
 
 # Настройка CORS для всех доменов
 app.add_middleware(
@@ -41,6 +55,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Разрешаем все методы
     allow_headers=["*"],  # Разрешаем все заголовки
+    # Служебные заголовки пагинации должны быть доступны браузерным клиентам
+    expose_headers=["X-Recommendation-Snapshot", "X-Next-After-Id"],
 )
 
 # Добавляем middleware для логирования
@@ -55,6 +71,20 @@ app.add_exception_handler(Exception, general_exception_handler)
 app.include_router(routes.router)
 app.include_router(doc_rec.router)  # Добавляем маршруты для оценки документов
 
+@app.on_event("startup")
+async def on_startup():
+    """Применяем миграции схемы и запускаем фоновые задачи"""
+    apply_migrations(engine)
+    LikeCounter.start()
+    PopularityRanking.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Останавливаем фоновые задачи, сбрасываем накопленные счетчики лайков и дожидаемся вариантов изображений"""
+    PopularityRanking.stop()
+    await LikeCounter.stop()
+    await run_in_threadpool(ImageVariants.shutdown)
+
 # Простой эндпоинт для проверки состояния сервера
 @app.get("/health", tags=["Система"])
 async def health_check():
@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+import pytest
+
+# База для тестов задается до импорта приложения: движок создается при импорте app.db.database
+_DB_DIR = tempfile.mkdtemp(prefix="threadai-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+
+from app.db.database import Base, SessionLocal, engine  # noqa: E402
+from app.models.models import PostType, ProfileType, TagType  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """Сессия чистой SQLite-базы со справочниками типов постов, тегов и профилей."""
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    session.add_all([PostType(post_type_id=1, name="post"), TagType(tag_type_id=1, name="topic"),
+                     ProfileType(type_id=1, name="student")])
+    session.commit()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine)
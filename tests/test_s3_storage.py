@@ -0,0 +1,91 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from app.utils.media_storage import IMMUTABLE_CACHE_CONTROL, S3Storage, create_storage
+
+BUCKET = "media"
+KEY = "images/ab/cd/" + "ab" * 32 + ".jpg"
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """S3Storage поверх moto - локальной подмены S3."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        yield S3Storage(BUCKET, str(tmp_path / "cache"))
+
+
+def _temp_file(storage, data: bytes) -> str:
+    path = storage.temp_path("images")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_publish_uploads_once_and_caches_locally(storage):
+    assert storage.publish(_temp_file(storage, b"image"), KEY) is True
+    head = storage._client.head_object(Bucket=BUCKET, Key=KEY)
+    assert head["CacheControl"] == IMMUTABLE_CACHE_CONTROL
+    assert head["ContentType"] == "image/jpeg"
+    assert open(storage.path(KEY), "rb").read() == b"image"
+
+    # Повторная загрузка того же содержимого только обновляет время изменения
+    assert storage.publish(_temp_file(storage, b"image"), KEY) is False
+    assert storage.exists(KEY)
+    assert storage.mtime(KEY) is not None
+
+
+def test_fetch_downloads_missing_files_into_cache(storage):
+    storage.publish(_temp_file(storage, b"image"), KEY)
+    os.remove(storage.path(KEY))
+
+    assert open(storage.fetch(KEY), "rb").read() == b"image"
+    assert storage.fetch("images/00/00/missing.jpg") is None
+    assert not storage.exists("images/00/00/missing.jpg")
+    assert storage.mtime("images/00/00/missing.jpg") is None
+    assert storage.touch("images/00/00/missing.jpg") is False
+
+
+def test_delete_with_derived_removes_variants_and_copies(storage):
+    storage.publish(_temp_file(storage, b"image"), KEY)
+    derived = [KEY[:-4] + "_w320.jpg", KEY + ".webp"]
+    for key in derived:
+        path = storage.path(key)
+        with open(path, "wb") as f:
+            f.write(b"variant")
+        storage.put(key, path)
+    other = "images/ab/cd/" + "ab" * 31 + "cd.jpg"
+    storage.publish(_temp_file(storage, b"other"), other)
+
+    assert sorted(storage.delete_with_derived(KEY)) == sorted([KEY] + derived)
+    assert [key for key, _, _ in storage.iter_files()] == [other]
+    assert not os.path.exists(storage.path(KEY))
+
+
+def test_url_is_presigned(storage):
+    storage.publish(_temp_file(storage, b"image"), KEY)
+
+    url = storage.url(KEY)
+
+    assert KEY in url and "Signature" in url
+
+
+def test_create_storage_selects_s3(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("MEDIA_STORAGE", "s3")
+    monkeypatch.setenv("MEDIA_S3_BUCKET", BUCKET)
+    monkeypatch.setenv("MEDIA_S3_REGION", "us-east-1")
+    monkeypatch.setenv("MEDIA_S3_REDIRECT", "true")
+    monkeypatch.setenv("MEDIA_CACHE_DIR", str(tmp_path / "cache"))
+    with mock_aws():
+        storage = create_storage()
+
+    assert isinstance(storage, S3Storage)
+    assert storage.bucket == BUCKET and storage.redirects
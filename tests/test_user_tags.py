@@ -0,0 +1,42 @@
+from app.models.models import Like, Post, Tag, TagForPost, TagForUser, User
+from app.services.post_service import PostService
+
+
+def _seed(db):
+    db.add_all([
+        User(user_id=1, login="liker", password="x", type_id=1, name="Liker"),
+        User(user_id=2, login="reader", password="x", type_id=1, name="Reader"),
+        Tag(tag_id=1, name="python", tag_type_id=1),
+        Tag(tag_id=2, name="math", tag_type_id=1),
+    ])
+    db.flush()
+    db.add(Post(post_id=1, content="post", user_id=1, post_type_id=1))
+    db.flush()
+    db.add_all([
+        TagForPost(id=1, post_id=1, tag_id=1),
+        Like(like_id=1, post_id=1, user_id=1),
+        # Теги из профиля пользователя без лайков
+        TagForUser(id=1, user_id=2, tag_id=2),
+    ])
+    db.commit()
+
+
+def _user_tags(db, user_id):
+    return {tag_id for (tag_id,) in db.query(TagForUser.tag_id).filter(TagForUser.user_id == user_id)}
+
+
+def test_update_user_tags_keeps_tags_of_user_without_likes(db):
+    _seed(db)
+
+    PostService.update_user_tags_from_likes(db, 2)
+
+    assert _user_tags(db, 2) == {2}
+
+
+def test_update_all_user_tags_keeps_tags_of_users_without_likes(db):
+    _seed(db)
+
+    PostService.update_all_user_tags_from_likes(db)
+
+    assert _user_tags(db, 1) == {1}
+    assert _user_tags(db, 2) == {2}
@@ -15,49 +15,83 @@ morph_vocab = MorphVocab()
 emb = NewsEmbedding()
 morph_tagger = NewsMorphTagger(emb)
 
-def extract_topic_tokens(text, max_tokens=10):
+# Части речи, леммы которых участвуют в вычислении эмбеддинга текста
+EMBEDDING_POS = {'NOUN', 'ADJ', 'VERB', 'PROPN'}
+
+def _topic_tokens(lemmas, max_tokens):
+    """Выбирает самые важные леммы по TF-IDF (или по частоте, если TF-IDF не построить)."""
+    if not lemmas:
+        return []
+    
+    vectorizer = TfidfVectorizer(max_features=1000)
+    try:
+        tfidf_matrix = vectorizer.fit_transform([' '.join(lemmas)])
+        feature_names = vectorizer.get_feature_names_out()
+        
+        # Получение весов TF-IDF
+        tfidf_scores = tfidf_matrix.toarray()[0]
+        
+        # Сортировка токенов по важности
+        sorted_indices = np.argsort(tfidf_scores)[::-1]
+        return [feature_names[i] for i in sorted_indices[:max_tokens]]
+    except ValueError:
+        # Если не удалось создать матрицу TF-IDF, возвращаем самые частые токены
+        return [token for token, _ in Counter(lemmas).most_common(max_tokens)]
+
+def _mean_embedding(lemmas):
+    """Возвращает нормированное среднее векторов Navec для лемм или None, если ни одной нет в словаре."""
+    vectors = [emb.get(lemma) for lemma in lemmas]
+    vectors = [vector for vector in vectors if vector is not None]
+    if not vectors:
+        return None
+    
+    mean = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+    norm = np.linalg.norm(mean)
+    if norm == 0:
+        return None
+    return (mean / norm).astype(np.float32)
+
+def analyze_text(text, max_tokens=10):
     """
-    Извлекает тематические токены из текста.
+    Извлекает тематические токены и эмбеддинг текста за один морфологический разбор.
     
     Args:
         text (str): Исходный текст
         max_tokens (int): Максимальное количество возвращаемых токенов
         
     Returns:
-        list: Список тематических токенов
+        tuple: (список тематических токенов, нормированный вектор float32 или None)
     """
     # Создаем документ и применяем морфологический анализ
     doc = Doc(text)
     doc.segment(segmenter)
     doc.tag_morph(morph_tagger)
     
-    # Извлекаем существительные и прилагательные
-    tokens = []
+    topic_lemmas = []
+    embedding_lemmas = []
     for token in doc.tokens:
-        if token.pos in ['NOUN', 'ADJ']:  # существительные и прилагательные
+        if token.pos in EMBEDDING_POS:
             token.lemmatize(morph_vocab)
-            tokens.append(token.lemma.lower())
+            lemma = token.lemma.lower()
+            embedding_lemmas.append(lemma)
+            if token.pos in ['NOUN', 'ADJ']:  # существительные и прилагательные
+                topic_lemmas.append(lemma)
     
-    # Использование TF-IDF для определения важности слов
-    if tokens:
-        vectorizer = TfidfVectorizer(max_features=1000)
-        try:
-            tfidf_matrix = vectorizer.fit_transform([' '.join(tokens)])
-            feature_names = vectorizer.get_feature_names_out()
-            
-            # Получение весов TF-IDF
-            tfidf_scores = tfidf_matrix.toarray()[0]
-            
-            # Сортировка токенов по важности
-            sorted_indices = np.argsort(tfidf_scores)[::-1]
-            top_tokens = [feature_names[i] for i in sorted_indices[:max_tokens]]
-            
-            return top_tokens
-        except ValueError:
-            # Если не удалось создать матрицу TF-IDF, возвращаем самые частые токены
-            return [token for token, _ in Counter(tokens).most_common(max_tokens)]
+    return _topic_tokens(topic_lemmas, max_tokens), _mean_embedding(embedding_lemmas)
+
+def extract_topic_tokens(text, max_tokens=10):
+    """
+    Извлекает тематические токены из текста.
     
-    return []
+    Args:
+        text (str): Исходный текст
+        max_tokens (int): Максимальное количество возвращаемых токенов
+        
+    Returns:
+        list: Список тематических токенов
+    """
+    tokens, _ = analyze_text(text, max_tokens)
+    return tokens
 
 def process_post(posts):
     """